@@ -1,10 +1,16 @@
 # app.py (修正版)
 
 import streamlit as st
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 import database
 import os
+from datetime import datetime, timedelta
 import config # config.pyをインポート
+from image_cache import ImageCache
+from embedding_index import EmbeddingIndex
+import retention
+from detector_service import DetectorClient, ServiceError
+from vision import draw_tracked_objects
 
 # --- アプリの基本設定 ---
 st.set_page_config(page_title="忘れ物捜索アプリ", layout="wide")
@@ -13,6 +19,33 @@ st.write("過去にカメラが認識した物体を検索できます。")
 # サイドバーに管理機能を追加
 st.sidebar.title("管理メニュー")
 
+
+@st.cache_resource
+def get_image_cache():
+    """表示用画像のキャッシュ（再実行しても作り直さない）"""
+    return ImageCache()
+
+
+@st.cache_resource
+def get_embedding_index():
+    """見た目の類似検索用の埋め込み（ファイルが伸びていれば検索時に読み直す）"""
+    return EmbeddingIndex()
+
+
+@st.cache_resource
+def get_detector_client():
+    """推論サービスのクライアント（モデルはサービス側の1つだけを使う）"""
+    return DetectorClient()
+
+
+@st.cache_data(ttl=config.SEARCH_CACHE_TTL, show_spinner=False)
+def load_page(keyword, after, start, end, label):
+    """検索結果の1ページ分（同じ条件ならSEARCH_CACHE_TTL秒はDBを読まない）"""
+    rows, next_cursor = database.search_page(keyword, after=after, start=start, end=end, label=label)
+    # sqlite3.Row はキャッシュできないので辞書にする
+    return [dict(row) for row in rows], next_cursor
+
+
 if st.sidebar.button("データベースをクリアする"):
     # ボタンが押されたら、確認のための状態をセッションに保存
     st.session_state.confirm_delete = True
@@ -26,6 +59,11 @@ if 'confirm_delete' in st.session_state and st.session_state.confirm_delete:
     with col1:
         if st.button("はい、削除します", type="primary"):
             success, message = database.clear_db()
+            # 削除した画像の検索結果・表示用画像も消す
+            load_page.clear()
+            get_image_cache().clear()
+            get_embedding_index().clear()
+            st.session_state.pop('similar_to', None)
             if success:
                 st.success(message)
             else:
@@ -44,62 +82,189 @@ if 'confirm_delete' in st.session_state and st.session_state.confirm_delete:
             st.rerun() 
 
 
+st.sidebar.markdown("---") # 区切り線
+
+# --- 古い履歴の整理（保持ポリシー） ---
+st.sidebar.subheader("古い履歴の整理")
+# 保存した自動整理の設定があればそれを、無ければ config の値を初期値にする
+saved_retention = retention.load_settings() or {}
+
+def retention_default(key, config_value):
+    value = saved_retention.get(key)
+    return int((config_value if value is None else value) or 0)
+
+retention_defaults = {
+    'enabled': saved_retention.get('enabled', config.RETENTION_SCHEDULE_ENABLED),
+    'max_age_days': retention_default('max_age_days', config.RETENTION_MAX_AGE_DAYS),
+    'keep_per_label': retention_default('keep_per_label', config.RETENTION_KEEP_PER_LABEL),
+    'disk_quota_mb': retention_default('disk_quota_mb', config.RETENTION_DISK_QUOTA_MB),
+}
+max_age_days = st.sidebar.number_input("この日数より古い記録を削除", min_value=0, value=retention_defaults['max_age_days'])
+keep_per_label = st.sidebar.number_input("ラベルごとに残す件数", min_value=0, value=retention_defaults['keep_per_label'])
+disk_quota_mb = st.sidebar.number_input("画像の合計容量の上限(MB)", min_value=0, value=retention_defaults['disk_quota_mb'])
+auto_retention = st.sidebar.checkbox("検出中に自動で整理する", value=retention_defaults['enabled'])
+st.sidebar.caption(
+    "0の項目は適用しません。自動で整理する場合は、次に検出を起動した時から"
+    f"{config.RETENTION_INTERVAL_SEC // 60}分ごとに上の設定で古い記録を削除します。"
+)
+retention_policy = {
+    'enabled': auto_retention, 'max_age_days': max_age_days,
+    'keep_per_label': keep_per_label, 'disk_quota_mb': disk_quota_mb,
+}
+if retention_policy != retention_defaults:
+    # 変更した時だけ保存する（検出プロセスの RetentionScheduler が読む）
+    retention.save_settings(**retention_policy)
+if st.sidebar.button("今すぐ整理する"):
+    with st.spinner("古い記録を削除しています..."):
+        # 0の項目は apply_retention の中で「適用しない」として扱われる
+        result = retention.apply_retention(max_age_days, keep_per_label, disk_quota_mb)
+    load_page.clear()
+    st.sidebar.success(
+        f"{result['rows']}件の記録と{result['files']}個の画像を削除しました"
+        f"（{result['freed_bytes'] / 1024 / 1024:.1f} MB）。"
+    )
+
 st.sidebar.markdown("---") # 区切り線
 # --- 検索フォーム ---
 search_term = st.text_input("探している物体のキーワードを入力してください（例: key, cup）", "")
 
+# 絞り込み（検出日の範囲・対象物）
+col_start, col_end, col_label = st.columns(3)
+with col_start:
+    start_date = st.date_input("この日から", value=None)
+with col_end:
+    end_date = st.date_input("この日まで", value=None)
+with col_label:
+    label_filter = st.selectbox("対象物", ["（すべて）"] + config.WHITELIST_KEYWORDS)
+
 if st.button("検索する"):
-    if search_term:
-        # ★★★ 修正点1: データベースからBBOXの座標も取得する ★★★
-        # database.pyのsearch_for_objectを改造して、bbox_coordsも返すようにします。
-        # 今回は一時的にapp.py側で直接DBにアクセスして実装します。
-        conn = database.sqlite3.connect(config.DB_NAME)
-        conn.row_factory = database.sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT timestamp, label, image_path, bbox_coords FROM detections WHERE label LIKE ? ORDER BY timestamp DESC", 
-            ('%' + search_term + '%',)
-        )
-        results = cursor.fetchall()
-        conn.close()
+    if search_term or label_filter != "（すべて）":
+        # 検索条件をセッションに保存し、1ページ目から表示する
+        st.session_state.search = {
+            'keyword': search_term,
+            'start': datetime.combine(start_date, datetime.min.time()) if start_date else None,
+            'end': datetime.combine(end_date + timedelta(days=1), datetime.min.time()) if end_date else None,
+            'label': None if label_filter == "（すべて）" else label_filter,
+        }
+        # 各ページの先頭カーソル（1ページ目はNone）
+        st.session_state.page_cursors = [None]
+    else:
+        st.info("検索キーワードを入力してください。")
+
+# --- 見た目が似ている記録（検索結果の「似ている記録を探す」から） ---
+if st.session_state.get('similar_to') is not None:
+    similar_to = st.session_state.similar_to
+    st.markdown("---")
+    st.subheader("見た目が似ている記録")
+    embedding_index = get_embedding_index()
+    query = embedding_index.vector_for(similar_to)
+    if query is None:
+        st.warning("この記録には見た目の情報が保存されていません。")
+    else:
+        # 保存済みの埋め込み同士を比べるだけなので、モデルは使わない
+        # 削除済みの記録の分を見越して多めに取り、DBに残っているものだけを表示する
+        hits = embedding_index.search(query, k=config.SIMILAR_TOP_K * 2, exclude_ids={similar_to})
+        scores = dict(hits)
+        similar_rows = database.get_detections([i for i, _ in hits])[:config.SIMILAR_TOP_K]
+        if not similar_rows:
+            st.info("似ている記録は見つかりませんでした。")
+        columns = st.columns(4)
+        for n, row in enumerate(similar_rows):
+            with columns[n % len(columns)]:
+                caption = f"{row['label']}（{row['timestamp']}、類似度 {scores[row['id']]:.2f}）"
+                if row['crop_path'] and os.path.exists(row['crop_path']):
+                    st.image(row['crop_path'], caption=caption, use_column_width='always')
+                elif os.path.exists(row['image_path']):
+                    bbox = [row[key] * row['image_scale'] for key in ('x1', 'y1', 'x2', 'y2')]
+                    st.image(get_image_cache().annotated(row['image_path'], bbox, row['label']),
+                             caption=caption, use_column_width='always')
+                else:
+                    st.caption(caption)
+    if st.button("閉じる", key="close_similar"):
+        st.session_state.pop('similar_to', None)
+        st.rerun()
+
+if st.session_state.get('search'):
+    search = st.session_state.search
+    page_cursors = st.session_state.page_cursors
+
+    # ★★★ 修正点1: 1ページ分だけをデータベースから読み込む ★★★
+    # search_pageはBBOXの座標(x1, y1, x2, y2)も返します。
+    results, next_cursor = load_page(
+        search['keyword'], page_cursors[-1], search['start'], search['end'], search['label'],
+    )
+    image_cache = get_image_cache()
+
+    if not results and len(page_cursors) == 1:
+        st.warning("その物体は見つかりませんでした。")
+    else:
+        title = search['keyword'] or search['label']
+        st.success(f"「{title}」の検索結果: {len(page_cursors)}ページ目（{len(results)}件）")
         
-        if not results:
-            st.warning("その物体は見つかりませんでした。")
-        else:
-            st.success(f"「{search_term}」の検索結果: {len(results)}件")
-            
-            # --- ★★★ 修正点2: BBOX表示のチェックボックスを追加 ★★★
-            show_bbox = st.checkbox("検出した位置（バウンディングボックス）を表示する", value=True)
+        # --- ★★★ 修正点2: BBOX表示のチェックボックスを追加 ★★★
+        show_bbox = st.checkbox("検出した位置（バウンディングボックス）を表示する", value=True)
+        
+        # 検索結果を表示
+        for row in results:
+            st.markdown("---")
             
-            # 検索結果を表示
-            for row in results:
-                st.markdown("---")
-                
-                if os.path.exists(row['image_path']):
-                    image = Image.open(row['image_path'])
-                    
-                    # チェックボックスがONの場合のみBBOXを描画
+            if os.path.exists(row['image_path']):
+                # 表示用の縮小画像はキャッシュから取り出す（無い場合だけ作る）
+                try:
                     if show_bbox:
-                        draw = ImageDraw.Draw(image)
-                        try:
-                            # DBからBBOX座標を文字列として取得し、数値のリストに変換
-                            bbox_str = row['bbox_coords']
-                            bbox = [float(coord) for coord in bbox_str.split(',')]
-                            
-                            # BBOXを描画
-                            draw.rectangle(bbox, outline='lime', width=5)
-                            
-                            # ラベルも描画
-                            font = ImageFont.truetype("meiryo.ttc", 32)
-                            draw.text((bbox[0], bbox[1] - 40), row['label'], fill='lime', font=font)
-                        except (ValueError, TypeError, IOError):
-                            st.error("BBOXの描画に失敗しました。")
-
-                    # --- ★★★ 修正点3: 画像を大きく表示 ★★★
-                    # st.imageを中央のメインカラムに配置して大きく表示
-                    st.image(image, caption=f"検出日時: {row['timestamp']}", use_column_width='always')
-                    
-                else:
-                    st.error(f"画像ファイルが見つかりません: {row['image_path']}")
-    else:
-        st.info("検索キーワードを入力してください。")
\ No newline at end of file
+                        # チェックボックスがONの場合はBBOXを描いた画像
+                        # BBOXは元のフレームの座標なので、保存画像の縮小率に合わせる
+                        bbox = [row[key] * row['image_scale'] for key in ('x1', 'y1', 'x2', 'y2')]
+                        image_path = image_cache.annotated(row['image_path'], bbox, row['label'])
+                    else:
+                        image_path = image_cache.thumbnail(row['image_path'])
+                except (ValueError, TypeError, OSError):
+                    st.error("BBOXの描画に失敗しました。")
+                    image_path = row['image_path']
+
+                # --- ★★★ 修正点3: 画像を大きく表示 ★★★
+                # st.imageを中央のメインカラムに配置して大きく表示
+                st.image(image_path, caption=f"検出日時: {row['timestamp']}", use_column_width='always')
+                # 切り出し画像を保存している場合は、物体の拡大画像も表示
+                if row['crop_path'] and os.path.exists(row['crop_path']):
+                    st.image(row['crop_path'], caption=f"{row['label']}（拡大）")
+                # 見た目の埋め込みで、ラベルの言い回しが違う記録も探す
+                if config.EMBEDDING_INDEX_ENABLED and st.button("似ている記録を探す", key=f"similar_{row['id']}"):
+                    st.session_state.similar_to = row['id']
+                    st.rerun()
+                
+            else:
+                st.error(f"画像ファイルが見つかりません: {row['image_path']}")
+
+        # --- ページ送り ---
+        st.markdown("---")
+        col_prev, col_next = st.columns(2)
+        with col_prev:
+            if len(page_cursors) > 1 and st.button("← 前のページ"):
+                page_cursors.pop()
+                st.rerun()
+        with col_next:
+            if next_cursor is not None and st.button("次のページ →"):
+                page_cursors.append(next_cursor)
+                st.rerun()
+
+st.markdown("---")
+# --- その場で解析（推論サービスを使う） ---
+with st.expander("画像をその場で解析する"):
+    st.caption("`python detector_service.py` で起動した推論サービスを使います（このアプリではモデルを読み込みません）。")
+    uploaded = st.file_uploader("解析する画像", type=['jpg', 'jpeg', 'png'])
+    if uploaded is not None and st.button("解析する"):
+        image = Image.open(uploaded).convert('RGB')
+        try:
+            with st.spinner("解析しています..."):
+                detections = get_detector_client().detect(image)
+        except ServiceError as e:
+            st.error(f"推論サービスを使えませんでした: {e}")
+        else:
+            if detections:
+                # 描画の色分けのために通し番号を付ける
+                objects = [dict(det, id=i) for i, det in enumerate(detections)]
+                st.image(draw_tracked_objects(image, objects), use_column_width='always')
+                st.write("、".join(det['label'] for det in detections))
+            else:
+                st.info("ホワイトリストの物体は見つかりませんでした。")
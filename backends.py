@@ -0,0 +1,409 @@
+# backends.py
+# VLM_Detector の推論バックエンド（モデルの読み込み方・実行方法）を切り替えるためのモジュール
+#
+#   eager   : そのままのPyTorch（これまでと同じ）
+#   int8    : 全結合層を動的int8量子化したPyTorch（CPU向け）
+#   compile : torch.compile で最適化したPyTorch
+#   onnx    : 画像エンコーダ(DaViT)をONNX Runtimeで実行し、文章生成はPyTorchで行う
+#
+# どれを使うかは config.INFERENCE_BACKEND で選びます。
+# 結果がeagerと一致するかは `python backends.py --backend int8` で確認できます。
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+from transformers import AutoProcessor, AutoModelForCausalLM
+
+import config
+
+# ONNXへ書き出す時のopset（キャッシュのファイル名にも含める）
+ONNX_OPSET = 17
+# ONNXの入力の型 → NumPyの型
+ONNX_INPUT_TYPES = {'tensor(float)': np.float32, 'tensor(float16)': np.float16}
+
+
+def select_device_and_dtype():
+    """使用するデバイスとデータ型を決める"""
+    dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
+        dtype = torch.bfloat16
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return device, dtype
+
+
+def snapshot_dir(model_id, dtype):
+    """ローカルに保存するモデルのスナップショットの場所（モデルとデータ型ごと）"""
+    name = f"{model_id.replace('/', '__')}-{str(dtype).replace('torch.', '')}"
+    return os.path.join(config.MODEL_SNAPSHOT_DIR, name)
+
+
+def load_model_and_processor(model_id, dtype):
+    """モデルとプロセッサを読み込む
+
+    config.MODEL_SNAPSHOT_DIR が設定されていれば、初回に使うデータ型のままsafetensorsで保存しておき、
+    次回からはそこから読み込む（ネットワークへの問い合わせ・データ型の変換をせず、mmapで読める）。
+    """
+    if not config.MODEL_SNAPSHOT_DIR:
+        model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=dtype, trust_remote_code=True)
+        processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+        return model, processor
+
+    snapshot = snapshot_dir(model_id, dtype)
+    if os.path.exists(os.path.join(snapshot, 'model.safetensors')):
+        model = AutoModelForCausalLM.from_pretrained(
+            snapshot, torch_dtype=dtype, trust_remote_code=True, local_files_only=True, low_cpu_mem_usage=True
+        )
+        processor = AutoProcessor.from_pretrained(snapshot, trust_remote_code=True, local_files_only=True)
+        return model, processor
+
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=dtype, trust_remote_code=True)
+    processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+    print(f"モデルのスナップショットを保存します: {snapshot}")
+    save_snapshot(model, processor, snapshot)
+    return model, processor
+
+
+def save_snapshot(model, processor, snapshot):
+    """書きかけのスナップショットを読まないよう、プロセスごとの一時フォルダに保存してから置き換える"""
+    parent = os.path.dirname(snapshot) or '.'
+    os.makedirs(parent, exist_ok=True)
+    # 以前に落ちたプロセスの書きかけを片付ける（古い固定名と、1時間以上更新の無い一時フォルダ）
+    shutil.rmtree(snapshot + '.tmp', ignore_errors=True)
+    for stale in glob.glob(glob.escape(snapshot) + '.*.tmp'):
+        try:
+            if time.time() - os.path.getmtime(stale) > 3600:
+                shutil.rmtree(stale, ignore_errors=True)
+        except OSError:
+            pass
+
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(snapshot) + '.', suffix='.tmp', dir=parent)
+    try:
+        model.save_pretrained(tmp_dir, safe_serialization=True, max_shard_size='10GB')
+        processor.save_pretrained(tmp_dir)
+        try:
+            os.replace(tmp_dir, snapshot)
+        except OSError:
+            # 別のプロセスが先に保存し終えていれば、それを使う
+            if not os.path.exists(os.path.join(snapshot, 'model.safetensors')):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class EagerBackend:
+    """PyTorchのモデルをそのまま使うバックエンド"""
+
+    name = 'eager'
+
+    def __init__(self, model_id=None, dtype=None):
+        self.model_id = model_id or config.MODEL_ID
+        self.device, self.dtype = select_device_and_dtype()
+        # dtype を指定した場合は自動選択より優先する（benchmark.py で比較するため）
+        if dtype is not None:
+            self.dtype = dtype
+        self.model, self.processor = load_model_and_processor(self.model_id, self.dtype)
+        self.model.to(self.device)
+        self.model.eval()
+        self.optimize()
+
+    def optimize(self):
+        """読み込み後の最適化（eagerでは何もしない）"""
+
+    def encode_image(self, pixel_values):
+        """画像エンコーダを実行して画像特徴量を返す"""
+        return self.model._encode_image(pixel_values)
+
+    def generate(self, input_ids, pixel_values, attention_mask=None, image_index=None,
+                 return_image_features=False, **generate_kwargs):
+        """文章生成を行う
+
+        attention_mask : 長さの違うプロンプトをパディングして束ねた場合のテキスト側のマスク
+        image_index    : input_ids の各行が pixel_values の何枚目の画像に対応するか。
+                         同じ画像に複数のプロンプトを投げる時、画像エンコーダを1回で済ませるために使う
+        return_image_features : Trueなら (生成結果, 画像ごとの画像特徴量) を返す（embedding_index.py で使う）
+        """
+        with torch.inference_mode():
+            padded = attention_mask is not None and not bool(attention_mask.all())
+            if not padded and image_index is None and not return_image_features:
+                return self.model.generate(input_ids=input_ids, pixel_values=pixel_values, **generate_kwargs)
+            image_features = per_image_features = self.encode_image(pixel_values)
+            if image_index is not None:
+                image_features = image_features[torch.as_tensor(image_index, device=image_features.device)]
+            generated_ids = self._generate_from_features(
+                image_features, input_ids, attention_mask if padded else None, **generate_kwargs
+            )
+            return (generated_ids, per_image_features) if return_image_features else generated_ids
+
+    def _generate_from_features(self, image_features, input_ids, attention_mask=None, **generate_kwargs):
+        """画像特徴量とプロンプトを結合して、言語モデルで文章を生成する"""
+        inputs_embeds = self.model.get_input_embeddings()(input_ids)
+        inputs_embeds, full_mask = self.model._merge_input_ids_with_image_features(image_features, inputs_embeds)
+        if attention_mask is not None:
+            # 画像トークンは全て有効、テキスト側はパディングを無視する
+            num_image_tokens = image_features.shape[1]
+            full_mask = torch.cat(
+                [full_mask[:, :num_image_tokens], attention_mask.to(full_mask.dtype)], dim=1
+            )
+            generate_kwargs['attention_mask'] = full_mask
+        return self.model.generate(input_ids=input_ids, inputs_embeds=inputs_embeds, **generate_kwargs)
+
+
+class QuantizedBackend(EagerBackend):
+    """全結合層(nn.Linear)を動的int8量子化するCPU向けバックエンド"""
+
+    name = 'int8'
+
+    def optimize(self):
+        if self.device.type != 'cpu':
+            print("int8バックエンドはCPU専用です。量子化せずに実行します。")
+            return
+        self.model = torch.ao.quantization.quantize_dynamic(
+            self.model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+
+class CompiledBackend(EagerBackend):
+    """torch.compile で画像エンコーダと言語モデルを最適化するバックエンド
+
+    Florence-2 は vision_tower.forward_features_unpool() と language_model.generate() を直接呼ぶので、
+    モジュールを包むのではなく、実際に呼ばれるメソッドをその場で差し替える
+    （generate の各ステップは language_model.forward を通る）。
+    """
+
+    name = 'compile'
+
+    def optimize(self):
+        vision_tower = self.model.vision_tower
+        vision_tower.forward_features_unpool = torch.compile(vision_tower.forward_features_unpool)
+        language_model = self.model.language_model
+        language_model.forward = torch.compile(language_model.forward, dynamic=True)
+
+
+class _VisionEncoder(torch.nn.Module):
+    """ONNXへ書き出すための、画像 → 画像特徴量 の部分だけを持つモジュール"""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model._encode_image(pixel_values)
+
+
+class OnnxBackend(EagerBackend):
+    """画像エンコーダをONNX Runtimeで実行するバックエンド
+
+    Florence-2の文章生成(ビームサーチ)はPyTorchのgenerateに任せ、
+    毎回同じ形で呼ばれる画像エンコーダだけをONNXに書き出して高速化します。
+    CPUでは言語モデル側も動的int8量子化します。
+    """
+
+    name = 'onnx'
+
+    def optimize(self):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("onnxバックエンドには onnxruntime が必要です: pip install onnxruntime")
+
+        # 書き出した時のデータ型・opsetが違うファイルは使い回さない
+        dtype_name = str(self.dtype).replace('torch.', '')
+        onnx_path = os.path.join(
+            config.ONNX_CACHE_DIR,
+            f"{self.model_id.replace('/', '__')}_vision_{dtype_name}_opset{ONNX_OPSET}.onnx",
+        )
+        if not os.path.exists(onnx_path):
+            self._export_vision_encoder(onnx_path)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if config.ONNX_NUM_THREADS:
+            options.intra_op_num_threads = config.ONNX_NUM_THREADS
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        # 書き出した時の入力の型（float32 / float16）に合わせて渡す
+        input_type = self.session.get_inputs()[0].type
+        if input_type not in ONNX_INPUT_TYPES:
+            raise ValueError(f"ONNXの入力の型 {input_type} には対応していません（{onnx_path}）")
+        self.input_dtype = ONNX_INPUT_TYPES[input_type]
+
+        if self.device.type == 'cpu':
+            self.model.language_model = torch.ao.quantization.quantize_dynamic(
+                self.model.language_model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+    def _export_vision_encoder(self, onnx_path):
+        print(f"画像エンコーダをONNXへ書き出します: {onnx_path}")
+        os.makedirs(os.path.dirname(onnx_path), exist_ok=True)
+        size = self.processor.image_processor.size
+        dummy = torch.zeros(1, 3, size['height'], size['width'], dtype=self.dtype, device=self.device)
+        torch.onnx.export(
+            _VisionEncoder(self.model), (dummy,), onnx_path,
+            input_names=['pixel_values'], output_names=['image_features'],
+            dynamic_axes={'pixel_values': {0: 'batch'}, 'image_features': {0: 'batch'}},
+            opset_version=ONNX_OPSET,
+        )
+
+    def encode_image(self, pixel_values):
+        image_features = self.session.run(
+            ['image_features'], {'pixel_values': pixel_values.float().cpu().numpy().astype(self.input_dtype, copy=False)}
+        )[0]
+        return torch.from_numpy(image_features).to(self.device, self.dtype)
+
+    def generate(self, input_ids, pixel_values, attention_mask=None, image_index=None,
+                 return_image_features=False, **generate_kwargs):
+        with torch.inference_mode():
+            image_features = per_image_features = self.encode_image(pixel_values)
+            if image_index is not None:
+                image_features = image_features[torch.as_tensor(image_index, device=image_features.device)]
+            padded = attention_mask is not None and not bool(attention_mask.all())
+            generated_ids = self._generate_from_features(
+                image_features, input_ids, attention_mask if padded else None, **generate_kwargs
+            )
+            return (generated_ids, per_image_features) if return_image_features else generated_ids
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (EagerBackend, QuantizedBackend, CompiledBackend, OnnxBackend)
+}
+
+
+def create_backend(name=None, model_id=None, dtype=None):
+    """名前(config.INFERENCE_BACKEND)からバックエンドを作る"""
+    name = name or config.INFERENCE_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"不明な推論バックエンドです: {name} (選択肢: {', '.join(BACKENDS)})")
+    if config.TORCH_NUM_THREADS:
+        torch.set_num_threads(config.TORCH_NUM_THREADS)
+    return BACKENDS[name](model_id, dtype)
+
+
+def get_generate_kwargs(decoding=None):
+    """デコード設定を generate の引数にする
+
+    decoding にはプロファイル名（config.DECODING_PROFILES のキー）か、
+    既定プロファイルを上書きする設定の辞書を渡す。Noneなら config.DECODING_PROFILE。
+    """
+    if decoding is None or isinstance(decoding, str):
+        name = decoding or config.DECODING_PROFILE
+        if name not in config.DECODING_PROFILES:
+            raise ValueError(f"不明なデコード設定です: {name} (選択肢: {', '.join(config.DECODING_PROFILES)})")
+        settings = dict(config.DECODING_PROFILES[name])
+    else:
+        settings = dict(config.DECODING_PROFILES[config.DECODING_PROFILE])
+        settings.update(decoding)
+
+    kwargs = {
+        'max_new_tokens': settings.get('max_new_tokens', 1024),
+        'num_beams': settings.get('num_beams', 1),
+        'do_sample': False,
+    }
+    # early_stopping はビームサーチの時だけ意味がある
+    if kwargs['num_beams'] > 1 and 'early_stopping' in settings:
+        kwargs['early_stopping'] = settings['early_stopping']
+    return kwargs
+
+
+def run_task(backend, image, task_prompt, prompt=None, **generate_kwargs):
+    """1枚の画像でタスクを実行し、(後処理結果, 生成テキスト, 所要秒数) を返す
+
+    prompt にはタスクに続けて入力する文字列込みのプロンプト（例: '<OPEN_VOCABULARY_DETECTION>cup'）を渡せる。
+    """
+    inputs = backend.processor(
+        text=prompt or task_prompt, images=image, return_tensors="pt", do_rescale=False
+    ).to(backend.device, backend.dtype)
+    start_time = time.perf_counter()
+    generated_ids = backend.generate(inputs["input_ids"], inputs["pixel_values"], **generate_kwargs)
+    elapsed = time.perf_counter() - start_time
+    generated_text = backend.processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
+    results = backend.processor.post_process_generation(
+        generated_text, task=task_prompt, image_size=(image.width, image.height)
+    )
+    return results, generated_text, elapsed
+
+
+def box_iou(a, b):
+    """2つのバウンディングボックスのIoU"""
+    ix1, iy1 = max(a[0], b[0]), max(a[1], b[1])
+    ix2, iy2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, ix2 - ix1) * max(0.0, iy2 - iy1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def result_items(results, task_prompt):
+    """後処理結果から (bbox, label) のリストを取り出す"""
+    detections = results.get(task_prompt)
+    if not isinstance(detections, dict):
+        return []
+    labels = detections.get('labels', detections.get('bboxes_labels', []))
+    return list(zip(detections.get('bboxes', []), labels))
+
+
+def compare_results(reference, candidate, task_prompt, iou_threshold=0.5):
+    """eagerの結果(reference)と比べて、同じラベル・IoU以上で一致した割合を返す"""
+    return detection_f1(
+        result_items(reference, task_prompt), result_items(candidate, task_prompt), iou_threshold
+    )
+
+
+def detection_f1(ref_items, cand_items, iou_threshold=0.5):
+    """(bbox, label) のリスト同士を比べ、同じラベル・IoU以上で一致したもののF1を返す"""
+    if not ref_items:
+        return 1.0 if not cand_items else 0.0
+
+    used = set()
+    matched = 0
+    for ref_box, ref_label in ref_items:
+        for j, (cand_box, cand_label) in enumerate(cand_items):
+            if j in used or cand_label != ref_label:
+                continue
+            if box_iou(ref_box, cand_box) >= iou_threshold:
+                used.add(j)
+                matched += 1
+                break
+    # 取りこぼし・余分な検出の両方を減点する（F1）
+    precision = matched / len(cand_items) if cand_items else 0.0
+    recall = matched / len(ref_items)
+    return 2 * precision * recall / (precision + recall) if matched else 0.0
+
+
+def check_parity(backend_name, image, task_prompt='<DENSE_REGION_CAPTION>', **generate_kwargs):
+    """指定したバックエンドとeagerの結果・速度を比較する"""
+    generate_kwargs = generate_kwargs or get_generate_kwargs()
+    reports = {}
+    outputs = {}
+    for name in ('eager', backend_name):
+        backend = create_backend(name)
+        run_task(backend, image, task_prompt, **generate_kwargs)  # ウォームアップ
+        results, text, elapsed = run_task(backend, image, task_prompt, **generate_kwargs)
+        outputs[name] = (results, text)
+        reports[name] = {'seconds': elapsed}
+        del backend
+
+    ref_results, ref_text = outputs['eager']
+    results, text = outputs[backend_name]
+    reports[backend_name]['text_identical'] = text == ref_text
+    reports[backend_name]['detection_f1'] = compare_results(ref_results, results, task_prompt)
+    reports[backend_name]['speedup'] = reports['eager']['seconds'] / reports[backend_name]['seconds']
+    return reports
+
+
+if __name__ == '__main__':
+    from PIL import Image
+
+    parser = argparse.ArgumentParser(description="推論バックエンドとeagerの結果・速度を比較します")
+    parser.add_argument('--backend', default=config.INFERENCE_BACKEND, choices=list(BACKENDS))
+    parser.add_argument('--image', default='test_image.png')
+    parser.add_argument('--task', default='<DENSE_REGION_CAPTION>')
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    for name, report in check_parity(args.backend, image, args.task).items():
+        print(f"{name}: {report}")
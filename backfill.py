@@ -0,0 +1,386 @@
+# backfill.py
+# 録画した動画ファイル（MP4など）をまとめて解析し、ライブの時と同じように検出履歴へ記録する
+#
+# 動画を BACKFILL_SEGMENT_SEC 秒ごとの区間に分け、VLM_Detector を1つずつ持つ
+# BACKFILL_WORKERS 個のプロセスに配ります。各プロセスは BACKFILL_SAMPLE_FPS で間引いたフレームを
+# 追跡し、区間の中で消失した物体と、区間の終わりでまだ見えている物体を返します。
+# 親プロセスは区間を順番につなぎ、境目をまたいで見えていた物体を1つの記録にまとめてから、
+# 動画の中の時刻で database に書き込みます。
+# 進み具合は memory_log.db の backfill_progress 表に記録と同じトランザクションで残すので、
+# 中断しても同じコマンドで続きから再開できます。
+#
+#   python backfill.py recordings/*.mp4
+#   python backfill.py living.mp4 --start "2024-05-01 09:00:00" --workers 4 --threads 2
+#   python backfill.py recordings/*.mp4 --keywords key wallet --restart   # 新しいホワイトリストで取り込み直す
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from datetime import datetime
+
+import cv2
+
+import config
+import database
+from embedding_index import EmbeddingIndex
+from image_store import ImageStore
+from persistence import write_sighting
+from retention import is_referenced
+from scene_gate import SceneChangeGate
+from tracker import Tracker
+from vision import bgr_view
+
+PROGRESS_TABLE = 'backfill_progress'
+
+# 推論プロセスごとの VLM_Detector（_init_worker で作る）
+_detector = None
+_store = None
+
+
+def ensure_progress_table(conn):
+    with conn:
+        conn.execute(
+            f'''CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE} (
+                video TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                segments INTEGER NOT NULL,
+                next_segment INTEGER NOT NULL,
+                carry TEXT NOT NULL,
+                updated INTEGER NOT NULL
+            )'''
+        )
+
+
+def load_progress(conn, video, fingerprint):
+    """(次に書き込む区間の番号, 持ち越し中の物体) を返す。設定が変わっていれば最初から"""
+    row = conn.execute(
+        f"SELECT fingerprint, next_segment, carry FROM {PROGRESS_TABLE} WHERE video = ?", (video,)
+    ).fetchone()
+    if row is None or row[0] != fingerprint:
+        return 0, []
+    return row[1], json.loads(row[2])
+
+
+def plan_video(path, segment_sec, sample_fps, start=None):
+    """動画の長さを調べ、区間の一覧と動画の開始時刻(UNIX秒)を返す
+
+    start を省略すると、ファイルの更新時刻を録画の終わりとみなして開始時刻を求める。
+    """
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise OSError(f"動画を開けませんでした: {path}")
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if frame_count <= 0:
+        raise OSError(f"動画のフレーム数が分かりません: {path}")
+
+    step = max(1, round(fps / sample_fps))
+    # 区間の長さを間引きの間隔の倍数にして、区間をまたいでも解析するフレームの間隔をそろえる
+    segment_frames = max(step, int(segment_sec * fps) // step * step)
+    if start is None:
+        start_epoch = os.path.getmtime(path) - frame_count / fps
+    else:
+        start_epoch = database.to_epoch(start)
+    segments = [
+        (first, min(first + segment_frames, frame_count)) for first in range(0, frame_count, segment_frames)
+    ]
+    return {'fps': fps, 'frames': frame_count, 'step': step, 'start_epoch': start_epoch, 'segments': segments}
+
+
+def decoding_settings(decoding):
+    """デコード設定を、プロファイル名ではなく中身の辞書にする（backends.get_generate_kwargs と同じ解決順）"""
+    if decoding is None or isinstance(decoding, str):
+        return config.DECODING_PROFILES.get(decoding or config.DECODING_PROFILE, decoding)
+    return {**config.DECODING_PROFILES[config.DECODING_PROFILE], **decoding}
+
+
+def fingerprint(path, plan, task_prompt, keywords, decoding=None):
+    """取り込みの条件。ファイルや設定が変わったら進み具合を使わずに最初からやり直す"""
+    stat = os.stat(path)
+    return json.dumps([
+        stat.st_size, int(stat.st_mtime), plan['step'], plan['segments'][0][1], task_prompt, sorted(keywords),
+        decoding_settings(decoding),
+    ], sort_keys=True)
+
+
+def _init_worker(threads, keywords):
+    """推論プロセスの初期化。スレッド数を決めてからモデルを読み込む"""
+    global _detector, _store
+    # torch を読み込む前に設定する（プロセス数 × スレッド数 がコア数を超えないように）
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+    os.environ['MKL_NUM_THREADS'] = str(threads)
+    cv2.setNumThreads(1)
+    config.TORCH_NUM_THREADS = threads
+    config.WHITELIST_KEYWORDS = list(keywords)
+    # 書き込みは親プロセスがまとめて行う。計測値の取得口・定期削除もプロセスごとには動かさない
+    config.ASYNC_PERSISTENCE = False
+    config.METRICS_PORT = 0
+    config.METRICS_LOG_INTERVAL_SEC = 0
+
+    from vision import VLM_Detector
+    _detector = VLM_Detector(retention_schedule=False)
+    _store = ImageStore()
+
+
+def _interval(obj, image, opening, is_open):
+    """追跡した1つの物体の「最後に見えた時」を画像と一緒に保存し、親プロセスに返す形にする"""
+    row = write_sighting(image, obj['label'], obj['bbox'], obj['last_seen_time'], store=_store)
+    embedding = obj.get('embedding')
+    return {
+        'row': list(row),
+        'embedding': None if embedding is None else [float(v) for v in embedding],
+        'opening': opening,
+        'open': is_open,
+    }
+
+
+def analyze_segment(task):
+    """1つの区間を解析する（推論プロセスで実行）。区間の中で見えた物体のリストを返す
+
+    'opening' : 区間の最初の方（消失とみなすまでの時間以内）で追跡を始めた物体。
+                前の区間の終わりに見えていた物体と同じかもしれない
+    'open'    : 区間の終わりでまだ見えている物体。次の区間に続いているかもしれない
+    """
+    started_at = time.perf_counter()
+    cap = cv2.VideoCapture(task['path'])
+    first, last = task['first'], task['last']
+    cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+    tracker = Tracker()
+    gate = SceneChangeGate() if config.SCENE_GATE_ENABLED else None
+    embed = config.EMBEDDING_INDEX_ENABLED
+    intervals = []
+    opening_ids = set()
+    analyzed = 0
+    batch = []
+
+    def flush():
+        nonlocal analyzed
+        frames = [(index, image, gate is None or gate.should_analyze(image)) for index, image in batch]
+        batch.clear()
+        kept = [image for _, image, analyze in frames if analyze]
+        detections_per_image = iter(
+            _detector.detect(kept, task['task_prompt'], task['decoding'], embed=embed) if kept else ()
+        )
+        for index, image, analyze in frames:
+            seen_time = datetime.fromtimestamp(task['start_epoch'] + index / task['fps'])
+            if not analyze:
+                # 推論を省いたフレームは、ライブと同じく追跡中の物体がまだ見えていることにする
+                tracker.touch(now=seen_time)
+                continue
+            started, disappeared = tracker.update(next(detections_per_image), image, now=seen_time)
+            analyzed += 1
+            # 区間の始まりから「消失とみなすまで」の間に現れた物体は、前の区間から続いているかもしれない
+            if tracker.disappear_seconds is None:
+                opening = analyzed <= tracker.disappear_frames
+            else:
+                opening = (index - first) / task['fps'] <= tracker.disappear_seconds
+            if opening:
+                opening_ids.update(obj['id'] for obj in started)
+            for obj in disappeared:
+                intervals.append(_interval(obj, obj['last_seen_image'], obj['id'] in opening_ids, False))
+
+    index = first
+    while index < last:
+        if index % task['step'] == 0:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            # PIL画像には変換せず、RGBのビューのまま推論・保存に使う
+            batch.append((index, bgr_view(frame)))
+            if len(batch) >= task['batch_size']:
+                flush()
+        elif not cap.grab():
+            # 解析しないフレームはデコードせずに読み飛ばす
+            break
+        index += 1
+    flush()
+    cap.release()
+
+    for obj in tracker.tracks():
+        intervals.append(_interval(obj, obj['last_seen_frame'], obj['id'] in opening_ids, True))
+    return {
+        'video': task['video'],
+        'segment': task['segment'],
+        'intervals': intervals,
+        'frames': index - first,
+        'analyzed': analyzed,
+        'seconds': time.perf_counter() - started_at,
+    }
+
+
+def _as_detection(interval):
+    x1, y1, x2, y2 = interval['row'][3]
+    return {'bbox': [x1, y1, x2, y2], 'label': interval['row'][2], 'center': ((x1 + x2) / 2, (y1 + y2) / 2)}
+
+
+def merge_boundary(carry, intervals, last_segment):
+    """前の区間から持ち越した物体と、次の区間の物体を境目でつなぐ
+
+    持ち越した物体が次の区間の最初の方の物体と対応付けば、同じ物体が見え続けていたとして
+    持ち越した方の記録は捨てる（次の区間の方が最後に見えた時に近い）。
+    戻り値: (記録するもの, 捨てるもの, 次に持ち越すもの)
+    """
+    opening = [interval for interval in intervals if interval['opening']]
+    continued = set()
+    if carry and opening:
+        # 追跡器の対応付け（コストとラベルのゲート）をそのまま使う
+        boundary = Tracker()
+        boundary.update([_as_detection(interval) for interval in carry], None)
+        boundary.update([_as_detection(interval) for interval in opening], None)
+        continued = {
+            track['id'] for track in boundary.tracks() if track['id'] < len(carry) and track['unseen_frames'] == 0
+        }
+
+    finished = [interval for i, interval in enumerate(carry) if i not in continued]
+    finished += [interval for interval in intervals if not interval['open']]
+    dropped = [carry[i] for i in sorted(continued)]
+    next_carry = [interval for interval in intervals if interval['open']]
+    if last_segment:
+        # 動画の終わりでまだ見えていた物体は、そこで最後に見えたとして記録する
+        finished += next_carry
+        next_carry = []
+    return finished, dropped, next_carry
+
+
+def commit_segment(conn, video, fingerprint_text, segments, next_segment, carry, finished, embedding_index):
+    """区間の記録と進み具合を1つのトランザクションで書き込む。記録した件数を返す"""
+    finished = sorted(finished, key=lambda interval: interval['row'][0])
+    with conn:
+        conn.execute(
+            f"INSERT OR REPLACE INTO {PROGRESS_TABLE} "
+            "(video, fingerprint, segments, next_segment, carry, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (video, fingerprint_text, segments, next_segment, json.dumps(carry), int(time.time()))
+        )
+        ids = database.save_detections([tuple(interval['row']) for interval in finished], conn=conn)
+    if embedding_index is not None:
+        pairs = [(i, interval['embedding']) for i, interval in zip(ids, finished) if interval['embedding'] is not None]
+        if pairs:
+            embedding_index.add([i for i, _ in pairs], [embedding for _, embedding in pairs])
+    return len(ids)
+
+
+def remove_dropped_images(conn, dropped, carry):
+    """捨てた記録の画像のうち、どこからも使われていないものを消す"""
+    keep = {path for interval in carry for path in (interval['row'][1], interval['row'][4]) if path}
+    for interval in dropped:
+        for path in (interval['row'][1], interval['row'][4]):
+            if path and path not in keep and not is_referenced(conn, path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def backfill(paths, workers=None, threads=None, segment_sec=None, sample_fps=None, start=None,
+             task_prompt=None, decoding=None, keywords=None, restart=False):
+    """動画ファイルを解析して検出履歴に記録する"""
+    workers = workers or config.BACKFILL_WORKERS
+    threads = threads or config.BACKFILL_THREADS_PER_WORKER or max(1, (os.cpu_count() or 1) // workers)
+    segment_sec = segment_sec or config.BACKFILL_SEGMENT_SEC
+    sample_fps = sample_fps or config.BACKFILL_SAMPLE_FPS
+    task_prompt = task_prompt or config.TASK_PROMPT
+    keywords = keywords or config.WHITELIST_KEYWORDS
+
+    database.init_db()
+    conn = database.connect()
+    ensure_progress_table(conn)
+    embedding_index = EmbeddingIndex() if config.EMBEDDING_INDEX_ENABLED else None
+
+    videos = {}
+    tasks = []
+    for path in paths:
+        try:
+            plan = plan_video(path, segment_sec, sample_fps, start)
+        except OSError as e:
+            print(f"エラー: {e}")
+            continue
+        video = os.path.abspath(path)
+        fingerprint_text = fingerprint(path, plan, task_prompt, keywords, decoding)
+        next_segment, carry = (0, []) if restart else load_progress(conn, video, fingerprint_text)
+        if next_segment >= len(plan['segments']):
+            print(f"[{path}] 取り込み済みのため飛ばします。")
+            continue
+        if next_segment:
+            print(f"[{path}] {next_segment}/{len(plan['segments'])} 区間まで取り込み済みです。続きから再開します。")
+        videos[video] = {
+            'path': path, 'plan': plan, 'fingerprint': fingerprint_text,
+            'next_segment': next_segment, 'carry': carry, 'pending': {},
+        }
+        for segment in range(next_segment, len(plan['segments'])):
+            first, last = plan['segments'][segment]
+            tasks.append({
+                'video': video, 'path': path, 'segment': segment, 'first': first, 'last': last,
+                'fps': plan['fps'], 'step': plan['step'], 'start_epoch': plan['start_epoch'],
+                'task_prompt': task_prompt, 'decoding': decoding, 'batch_size': config.BACKFILL_BATCH_SIZE,
+            })
+
+    if not tasks:
+        conn.close()
+        print("取り込む区間はありません。")
+        return
+    workers = min(workers, len(tasks))
+    print(f"{len(videos)} 本の動画・{len(tasks)} 区間を {workers} プロセス × {threads} スレッドで解析します。")
+
+    frames = analyzed = recorded = 0
+    started_at = time.time()
+    # torch・OpenCVのスレッドを引き継がないよう、推論プロセスは fork ではなく spawn で作る
+    context = multiprocessing.get_context('spawn')
+    try:
+        with context.Pool(workers, initializer=_init_worker, initargs=(threads, list(keywords))) as pool:
+            for result in pool.imap_unordered(analyze_segment, tasks):
+                frames += result['frames']
+                analyzed += result['analyzed']
+                state = videos[result['video']]
+                state['pending'][result['segment']] = result['intervals']
+                # 区間は順番につなぐ（先に終わった後ろの区間は、前の区間が終わるまで待たせる）
+                segment_count = len(state['plan']['segments'])
+                while state['next_segment'] in state['pending']:
+                    intervals = state['pending'].pop(state['next_segment'])
+                    finished, dropped, state['carry'] = merge_boundary(
+                        state['carry'], intervals, state['next_segment'] == segment_count - 1
+                    )
+                    state['next_segment'] += 1
+                    recorded += commit_segment(
+                        conn, result['video'], state['fingerprint'], segment_count,
+                        state['next_segment'], state['carry'], finished, embedding_index
+                    )
+                    remove_dropped_images(conn, dropped, state['carry'])
+                    print(f"[{state['path']}] {state['next_segment']}/{segment_count} 区間を取り込みました。")
+                elapsed = time.time() - started_at
+                print(f"  解析 {analyzed} フレーム（読み込み {frames} フレーム, {frames / elapsed:.1f} フレーム/秒）、"
+                      f"記録 {recorded} 件")
+    finally:
+        conn.close()
+    print(f"取り込みが完了しました。記録 {recorded} 件, {time.time() - started_at:.1f} 秒")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="録画した動画ファイルを解析して検出履歴に取り込みます")
+    parser.add_argument('videos', nargs='+', help="取り込む動画ファイル")
+    parser.add_argument('--workers', type=int, default=None, help="推論するプロセスの数")
+    parser.add_argument('--threads', type=int, default=None, help="1プロセスあたりのPyTorchのスレッド数")
+    parser.add_argument('--segment-sec', type=float, default=None, help="1区間の長さ(秒)")
+    parser.add_argument('--sample-fps', type=float, default=None, help="1秒あたりに解析するフレーム数")
+    parser.add_argument('--start', default=None,
+                        help="録画の開始日時（例: '2024-05-01 09:00:00'）。省略するとファイルの更新時刻から求める")
+    parser.add_argument('--task', default=None, help="タスクプロンプト（省略すると config.TASK_PROMPT）")
+    parser.add_argument('--decoding', default=None, choices=list(config.DECODING_PROFILES))
+    parser.add_argument('--keywords', nargs='+', default=None, help="ホワイトリストのキーワード（省略すると config の設定）")
+    parser.add_argument('--restart', action='store_true', help="進み具合を無視して最初から取り込む")
+    args = parser.parse_args()
+
+    if args.start and len(args.videos) > 1:
+        parser.error("--start は動画ファイルを1つだけ指定する場合に使えます。")
+    try:
+        backfill(
+            args.videos, workers=args.workers, threads=args.threads, segment_sec=args.segment_sec,
+            sample_fps=args.sample_fps, start=args.start, task_prompt=args.task, decoding=args.decoding,
+            keywords=args.keywords, restart=args.restart,
+        )
+    except KeyboardInterrupt:
+        print("\n中断しました。同じコマンドで続きから再開できます。")
+        sys.exit(1)
@@ -0,0 +1,248 @@
+# benchmark.py
+# 推論速度のベンチマーク（detect_objects.py / detected_detailed.py の置き換え）
+#
+# タスク × デコード設定 × データ型 × スレッド数 × 画像サイズ の組み合わせごとに、
+# 前処理 / 画像エンコーダ / 文章生成(デコード) / 後処理 の時間を分けて N 回計測し、
+# パーセンタイルをJSONに保存します。
+# --baseline に以前のJSONを渡すと、遅くなった組み合わせを報告して終了コード1で終わります。
+#
+#   python benchmark.py --image test_image.png --tasks "<OD>" "<DENSE_REGION_CAPTION>" --repeat 10
+#   python benchmark.py --dtypes float32 bfloat16 --threads 4 8 --sizes 640x480 1920x1080
+#   python benchmark.py --baseline benchmark_report.json --output benchmark_new.json
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import torch
+import transformers
+from PIL import Image
+
+import config
+from backends import create_backend, get_generate_kwargs, BACKENDS
+from vision import build_prompts, SUPPORTED_TASKS
+
+STAGES = ('preprocess', 'encode', 'decode', 'postprocess', 'total')
+DTYPES = {
+    'auto': None,
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+
+
+def synchronize(device):
+    """GPUの処理が終わるまで待つ（非同期実行の時間を正しく測るため）"""
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def percentile(values, q):
+    """値のリストのqパーセンタイル（線形補間）"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(values):
+    """計測値(秒)の統計"""
+    return {
+        'mean': sum(values) / len(values),
+        'min': min(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+
+def run_stages(backend, image, task_prompt, generate_kwargs):
+    """1枚の画像でタスクを実行し、段ごとの所要秒数と検出数を返す
+
+    複数のプロンプトを使うタスク（<OPEN_VOCABULARY_DETECTION>）は、プロンプトごとの時間を合計する。
+    """
+    timings = dict.fromkeys(STAGES, 0.0)
+    detections = 0
+    for prompt in build_prompts(task_prompt):
+        start = time.perf_counter()
+        inputs = backend.processor(
+            text=prompt, images=image, return_tensors="pt", do_rescale=False
+        ).to(backend.device, backend.dtype)
+        synchronize(backend.device)
+        preprocessed = time.perf_counter()
+
+        with torch.inference_mode():
+            image_features = backend.encode_image(inputs["pixel_values"])
+            synchronize(backend.device)
+            encoded = time.perf_counter()
+            generated_ids = backend._generate_from_features(image_features, inputs["input_ids"], **generate_kwargs)
+            synchronize(backend.device)
+            decoded = time.perf_counter()
+
+        generated_text = backend.processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
+        results = backend.processor.post_process_generation(
+            generated_text, task=task_prompt, image_size=(image.width, image.height)
+        )
+        finished = time.perf_counter()
+
+        timings['preprocess'] += preprocessed - start
+        timings['encode'] += encoded - preprocessed
+        timings['decode'] += decoded - encoded
+        timings['postprocess'] += finished - decoded
+        timings['total'] += finished - start
+        if isinstance(results.get(task_prompt), dict):
+            detections += len(results[task_prompt].get('bboxes', []))
+    return timings, detections
+
+
+def benchmark_case(backend, image, task_prompt, profile, repeat, warmup):
+    """1つの組み合わせを warmup 回空回ししてから repeat 回計測する"""
+    generate_kwargs = get_generate_kwargs(profile)
+    for _ in range(warmup):
+        run_stages(backend, image, task_prompt, generate_kwargs)
+    samples = {stage: [] for stage in STAGES}
+    detections = 0
+    for _ in range(repeat):
+        timings, detections = run_stages(backend, image, task_prompt, generate_kwargs)
+        for stage in STAGES:
+            samples[stage].append(timings[stage])
+    return {stage: summarize(samples[stage]) for stage in STAGES}, detections
+
+
+def parse_size(text):
+    """'1280x720' を (1280, 720) に、'original' を None にする"""
+    if text == 'original':
+        return None
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def case_key(case):
+    return (case['task'], case['profile'], case['dtype'], case['threads'], case['size'])
+
+
+def run_benchmark(image, backend_name, tasks, profiles, dtypes, thread_counts, sizes, repeat, warmup):
+    """全ての組み合わせを計測して、結果のリストを返す"""
+    cases = []
+    for dtype_name in dtypes:
+        # データ型を変える場合はモデルを読み込み直す
+        backend = create_backend(backend_name, dtype=DTYPES[dtype_name])
+        for threads in thread_counts:
+            if threads:
+                torch.set_num_threads(threads)
+            for size_text in sizes:
+                size = parse_size(size_text)
+                resized = image.resize(size, Image.BILINEAR) if size else image
+                for task_prompt in tasks:
+                    for profile in profiles:
+                        stages, detections = benchmark_case(backend, resized, task_prompt, profile, repeat, warmup)
+                        cases.append({
+                            'task': task_prompt,
+                            'profile': profile,
+                            'settings': get_generate_kwargs(profile),
+                            'dtype': str(backend.dtype).replace('torch.', ''),
+                            'threads': torch.get_num_threads(),
+                            'size': f'{resized.width}x{resized.height}',
+                            'detections': detections,
+                            'seconds': stages,
+                        })
+                        print(f"{task_prompt:32s} {profile:9s} {cases[-1]['dtype']:9s} "
+                              f"threads={cases[-1]['threads']:<3d} {cases[-1]['size']:>10s}  "
+                              + "  ".join(f"{stage}={stages[stage]['p50']:.3f}" for stage in STAGES))
+        del backend
+    return cases
+
+
+def environment(backend_name):
+    """計測した環境（回帰を比べる時に同じ環境かを確認するため）"""
+    return {
+        'backend': backend_name,
+        'model_id': config.MODEL_ID,
+        'python': sys.version.split()[0],
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+    }
+
+
+def find_regressions(cases, baseline_cases, tolerance, stat='p50'):
+    """基準のJSONと比べて、(1 + tolerance) 倍より遅くなった段を返す"""
+    baseline = {case_key(case): case for case in baseline_cases}
+    regressions = []
+    for case in cases:
+        old = baseline.get(case_key(case))
+        if old is None:
+            continue
+        for stage in STAGES:
+            before, after = old['seconds'][stage][stat], case['seconds'][stage][stat]
+            if before > 0 and after > before * (1 + tolerance):
+                regressions.append({
+                    'case': dict(zip(('task', 'profile', 'dtype', 'threads', 'size'), case_key(case))),
+                    'stage': stage,
+                    'before': before,
+                    'after': after,
+                    'ratio': after / before,
+                })
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="段ごとの推論速度を計測します")
+    parser.add_argument('--image', default='test_image.png')
+    parser.add_argument('--backend', default=config.INFERENCE_BACKEND, choices=list(BACKENDS))
+    parser.add_argument('--tasks', nargs='+', default=['<OD>', '<DENSE_REGION_CAPTION>'], choices=SUPPORTED_TASKS)
+    parser.add_argument('--profiles', nargs='+', default=[config.DECODING_PROFILE], choices=list(config.DECODING_PROFILES))
+    parser.add_argument('--dtypes', nargs='+', default=['auto'], choices=list(DTYPES))
+    parser.add_argument('--threads', nargs='+', type=int, default=[config.TORCH_NUM_THREADS or 0],
+                        help="PyTorchのCPUスレッド数（0なら変更しない）")
+    parser.add_argument('--sizes', nargs='+', default=['original'], help="入力画像の大きさ（例: 1280x720）。original は元のまま")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--output', default='benchmark_report.json')
+    parser.add_argument('--baseline', default=None, help="比較する以前の計測結果(JSON)")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="この割合より遅くなったら回帰とみなす")
+    args = parser.parse_args()
+
+    try:
+        image = Image.open(args.image).convert("RGB")
+    except FileNotFoundError:
+        print(f"エラー: '{args.image}' が見つかりません。")
+        sys.exit(1)
+
+    cases = run_benchmark(
+        image, args.backend, args.tasks, args.profiles, args.dtypes, args.threads, args.sizes, args.repeat, args.warmup
+    )
+    report = {
+        'environment': environment(args.backend),
+        'image': args.image,
+        'repeat': args.repeat,
+        'warmup': args.warmup,
+        'results': cases,
+    }
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        report['regressions'] = find_regressions(cases, baseline['results'], args.tolerance)
+        for regression in report['regressions']:
+            case = regression['case']
+            print(f"回帰: {case['task']} {case['profile']} {case['dtype']} threads={case['threads']} {case['size']} "
+                  f"{regression['stage']}: {regression['before']:.3f} → {regression['after']:.3f} 秒 "
+                  f"(x{regression['ratio']:.2f})")
+        if report['regressions']:
+            exit_code = 1
+        else:
+            print("基準と比べて遅くなった項目はありません。")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"計測結果を '{args.output}' に保存しました。")
+    sys.exit(exit_code)
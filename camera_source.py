@@ -0,0 +1,389 @@
+# camera_source.py
+# カメラ入力（スマートフォンのIPカメラ・USBカメラ）を開き、切れても自動でつなぎ直す
+#
+# cv2.VideoCapture と同じ read() / isOpened() / release() を持つので、そのまま置き換えられます。
+#   ・http(s) のURLは MJPEG を自前で読む（MJPEGSource）。受け取ったJPEGは最新の1枚だけを
+#     バイト列のまま持ち、read() で取り出すときに初めてデコードする（読まれずに捨てるフレームはデコードしない）
+#   ・CAMERA_DECODE_MIN_SIDE を指定すると、libjpeg の縮小デコード（cv2.IMREAD_REDUCED_COLOR_2/4/8）で、
+#     短辺が CAMERA_DECODE_MIN_SIDE 以上に残る範囲で最も小さく展開する（Florence-2 は 768x768 に縮めて推論するため）。
+#     フレームが小さくなるので、ピクセル単位の設定（OBJECT_TRACKING_THRESHOLD_PIXELS・ROI_MIN_CROP_SIZE）も
+#     同じ倍率で効き方が変わり、DBに記録する解像度も縮小後のものになる（既定では縮小しない）
+#   ・接続が切れた・CAMERA_READ_TIMEOUT_SEC 秒フレームが届かない場合は、
+#     CAMERA_RECONNECT_MIN_SEC から倍々に CAMERA_RECONNECT_MAX_SEC まで待ってつなぎ直す
+#   ・それ以外（カメラデバイスID・RTSP・動画ファイル）は cv2.VideoCapture をバッファ1枚で開く（OpenCVSource）
+#
+#   cap = open_source(config.VIDEO_STREAM_URL)
+#   ret, frame = cap.read()   # つなぎ直しの間は待つ。Falseになるのは閉じたか、諦めたときだけ
+#
+# 手元で試すには `python fake_mjpeg_server.py --drop-every 10` で偽のIPカメラを立てます。
+
+import http.client
+import threading
+import urllib.request
+
+import cv2
+import numpy as np
+
+import config
+import metrics
+
+# 縮小デコードの倍率と、対応する imdecode のフラグ（大きい倍率から試す）
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+# 幅と高さを持つSOFマーカー（C4: ハフマン表, C8: 予約, CC: 算術符号の表 は除く）
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class CameraError(Exception):
+    """カメラのストリームが読めない"""
+
+
+class NotMJPEGError(CameraError):
+    """URLの応答が MJPEG（multipart）ではない"""
+
+
+def jpeg_size(data):
+    """JPEGのSOFマーカーから (幅, 高さ) を読む（デコードはしない）。読めなければNone"""
+    if data[:2] != b'\xff\xd8':
+        return None
+    i, n = 2, len(data)
+    while i + 9 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # 詰め物の 0xFF
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            # 長さを持たないマーカー
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def decode_scale(size, min_side=None):
+    """短辺が min_side 以上に残る最大の縮小倍率（1, 2, 4, 8）を返す"""
+    min_side = config.CAMERA_DECODE_MIN_SIDE if min_side is None else min_side
+    if not min_side or size is None:
+        return 1
+    short_side = min(size)
+    for scale, _ in REDUCED_DECODE_FLAGS:
+        if short_side // scale >= min_side:
+            return scale
+    return 1
+
+
+def decode_jpeg(data, min_side=None):
+    """JPEGのバイト列をBGRのフレームにする（必要な大きさまで縮小しながらデコード）。壊れていればNone"""
+    scale = decode_scale(jpeg_size(data), min_side)
+    flag = dict(REDUCED_DECODE_FLAGS).get(scale, cv2.IMREAD_COLOR)
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+
+
+def iter_jpeg(stream, boundary=b''):
+    """multipart/x-mixed-replace の本文から、パートごとのJPEGのバイト列を順に返す
+
+    Content-Length があればその長さだけ読み、無ければ次の境界の行までを1枚とみなします。
+    ストリームが終わったら止まります。
+    """
+    bare = boundary.strip(b'-')
+
+    def is_boundary(line):
+        return line.startswith(b'--') and (not bare or line.strip().strip(b'-') == bare)
+
+    at_headers = False
+    while True:
+        if not at_headers:
+            # 次の境界の行まで読み飛ばす
+            line = stream.readline()
+            if not line:
+                return
+            if not is_boundary(line):
+                continue
+        headers = {}
+        while True:
+            line = stream.readline()
+            if not line:
+                return
+            line = line.strip()
+            if not line:
+                break
+            name, _, value = line.partition(b':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = headers.get(b'content-length')
+        if length:
+            length = int(length)
+            data = stream.read(length)
+            if len(data) < length:
+                return
+            at_headers = False
+        else:
+            buffer = bytearray()
+            while True:
+                line = stream.readline()
+                if not line:
+                    return
+                if is_boundary(line):
+                    break
+                buffer += line
+            data = bytes(buffer).rstrip(b'\r\n')
+            # 境界の行は読み終えているので、次はヘッダから読む
+            at_headers = True
+        if data:
+            yield data
+
+
+class Backoff:
+    """つなぎ直すまでの待ち時間（失敗するたびに倍にする）"""
+
+    def __init__(self, min_sec=None, max_sec=None, max_attempts=None):
+        self.min_sec = min_sec or config.CAMERA_RECONNECT_MIN_SEC
+        self.max_sec = max_sec or config.CAMERA_RECONNECT_MAX_SEC
+        self.max_attempts = config.CAMERA_RECONNECT_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.reset()
+
+    def reset(self):
+        self.attempts = 0
+        self.delay = self.min_sec
+
+    def failed(self):
+        """失敗を1回数え、次に待つ秒数を返す"""
+        self.attempts += 1
+        delay = self.delay
+        self.delay = min(self.delay * 2, self.max_sec)
+        return delay
+
+    @property
+    def gave_up(self):
+        return bool(self.max_attempts) and self.attempts > self.max_attempts
+
+
+class MJPEGSource:
+    """HTTPのMJPEGストリームを読む（最新のJPEGを1枚だけ持ち、read()のときにデコードする）"""
+
+    def __init__(self, url, name=None, timeout=None, min_side=None):
+        self.url = url
+        self.name = name or url
+        self.timeout = timeout or config.CAMERA_READ_TIMEOUT_SEC
+        self.min_side = min_side
+        self.backoff = Backoff()
+        self._cond = threading.Condition()
+        self._closed = threading.Event()
+        self._response = None
+        self._jpeg = None
+        self._seq = 0          # 受け取ったJPEGの通し番号
+        self._read_seq = 0     # read() で渡したJPEGの通し番号
+        self.frames_received = 0
+        self.frames_skipped = 0
+        self.frames_corrupt = 0
+        self.reconnects = 0
+        self.frame_size = None
+
+        # 最初の接続だけはここで行い、つながらなければ isOpened() を False にする
+        try:
+            self._response, self._boundary = self._connect()
+        except (OSError, http.client.HTTPException) as e:
+            print(f"[{self.name}] 接続できませんでした: {e}")
+            self._closed.set()
+            return
+        self._thread = threading.Thread(target=self._run, name=f'camera-{self.name}', daemon=True)
+        self._thread.start()
+
+    def _connect(self):
+        response = urllib.request.urlopen(self.url, timeout=self.timeout)
+        content_type = response.headers.get('Content-Type', '')
+        if 'multipart' not in content_type.lower():
+            response.close()
+            raise NotMJPEGError(f"MJPEGではありません（Content-Type: {content_type}）")
+        boundary = b''
+        for param in content_type.split(';')[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.lower() == 'boundary':
+                boundary = value.strip('"').encode('latin-1')
+        return response, boundary
+
+    def _run(self):
+        """受信スレッド: JPEGを受け取り続け、切れたらつなぎ直す"""
+        try:
+            self._receive()
+        finally:
+            # 接続はこのスレッドだけが触る（release() からは閉じない）
+            self._close_response()
+
+    def _receive(self):
+        while not self._closed.is_set():
+            try:
+                if self._response is None:
+                    self._response, self._boundary = self._connect()
+                    self.reconnects += 1
+                    metrics.inc('camera_reconnects')
+                    print(f"[{self.name}] つなぎ直しました。")
+                for jpeg in iter_jpeg(self._response, self._boundary):
+                    self._put(jpeg)
+                    if self._closed.is_set():
+                        return
+                raise CameraError("ストリームが終わりました")
+            except (OSError, http.client.HTTPException, CameraError) as e:
+                self._close_response()
+                if self._closed.is_set():
+                    return
+                delay = self.backoff.failed()
+                if self.backoff.gave_up:
+                    print(f"[{self.name}] つなぎ直しを {self.backoff.max_attempts} 回失敗したため諦めます: {e}")
+                    self._closed.set()
+                    with self._cond:
+                        self._cond.notify_all()
+                    return
+                print(f"[{self.name}] 接続が切れました（{e}）。{delay:.1f} 秒後につなぎ直します（{self.backoff.attempts} 回目）")
+                self._closed.wait(delay)
+
+    def _put(self, jpeg):
+        with self._cond:
+            if self._seq != self._read_seq:
+                # 前のJPEGは読まれないまま置き換わる（デコードもしない）
+                self.frames_skipped += 1
+                metrics.inc('camera_frames_skipped')
+            self._jpeg = jpeg
+            self._seq += 1
+            self.frames_received += 1
+            self.backoff.reset()
+            self._cond.notify_all()
+
+    def _close_response(self):
+        response, self._response = self._response, None
+        if response is not None:
+            try:
+                response.close()
+            except OSError:
+                pass
+
+    def isOpened(self):
+        return not self._closed.is_set()
+
+    def read(self):
+        """まだ渡していない最新のフレームを (True, BGRのフレーム) で返す。閉じた・諦めた場合は (False, None)"""
+        while True:
+            with self._cond:
+                while self._seq == self._read_seq and not self._closed.is_set():
+                    self._cond.wait(0.5)
+                if self._seq == self._read_seq:
+                    return False, None
+                jpeg, self._read_seq = self._jpeg, self._seq
+            with metrics.span('jpeg_decode'):
+                frame = decode_jpeg(jpeg, self.min_side)
+            if frame is not None:
+                self.frame_size = (frame.shape[1], frame.shape[0])
+                return True, frame
+            self.frames_corrupt += 1
+
+    def release(self):
+        # 受信スレッドは、次のJPEGが届くか CAMERA_READ_TIMEOUT_SEC 秒で止まる
+        self._closed.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'frames_received': self.frames_received,
+                'frames_skipped': self.frames_skipped,
+                'frames_corrupt': self.frames_corrupt,
+                'reconnects': self.reconnects,
+                'frame_size': self.frame_size,
+            }
+
+
+class OpenCVSource:
+    """cv2.VideoCapture をバッファ1枚で開き、読めなくなったらつなぎ直す（動画ファイルは終わりで止まる）"""
+
+    def __init__(self, source, name=None):
+        self.source = source
+        self.name = name or str(source)
+        # カメラデバイスとURLはつなぎ直す。動画ファイルは最後まで読んだら終わり
+        self.reconnect = isinstance(source, int) or '://' in str(source)
+        self.backoff = Backoff()
+        self._closed = threading.Event()
+        self.frames_received = 0
+        self.reconnects = 0
+        self.frame_size = None
+        self.cap = self._open()
+        if self.cap is None:
+            print(f"[{self.name}] 接続できませんでした。")
+            self._closed.set()
+
+    def _open(self):
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            cap.release()
+            return None
+        # 古いフレームを溜めない（対応していないバックエンドでは無視される）
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+
+    def isOpened(self):
+        return not self._closed.is_set()
+
+    def read(self):
+        while not self._closed.is_set():
+            if self.cap is None:
+                self.cap = self._open()
+                if self.cap is None:
+                    self._failed("接続できません")
+                    continue
+                self.reconnects += 1
+                metrics.inc('camera_reconnects')
+                print(f"[{self.name}] つなぎ直しました。")
+            ret, frame = self.cap.read()
+            if ret:
+                self.backoff.reset()
+                self.frames_received += 1
+                self.frame_size = (frame.shape[1], frame.shape[0])
+                return True, frame
+            self.cap.release()
+            self.cap = None
+            if not self.reconnect:
+                self._closed.set()
+                break
+            self._failed("フレームを読み込めません")
+        return False, None
+
+    def _failed(self, reason):
+        delay = self.backoff.failed()
+        if self.backoff.gave_up:
+            print(f"[{self.name}] つなぎ直しを {self.backoff.max_attempts} 回失敗したため諦めます: {reason}")
+            self._closed.set()
+            return
+        print(f"[{self.name}] {reason}。{delay:.1f} 秒後につなぎ直します（{self.backoff.attempts} 回目）")
+        self._closed.wait(delay)
+
+    def release(self):
+        self._closed.set()
+        if self.cap is not None:
+            self.cap.release()
+
+    def stats(self):
+        return {
+            'frames_received': self.frames_received,
+            'reconnects': self.reconnects,
+            'frame_size': self.frame_size,
+        }
+
+
+def open_source(source, name=None):
+    """source（URL・カメラデバイスID・動画ファイル）を開く。つながったかは isOpened() で確かめる"""
+    if config.CAMERA_MJPEG_DIRECT and isinstance(source, str) and source.startswith(('http://', 'https://')):
+        try:
+            return MJPEGSource(source, name=name)
+        except NotMJPEGError as e:
+            print(f"[{name or source}] {e}。OpenCVで開きます。")
+    return OpenCVSource(source, name=name)
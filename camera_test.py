@@ -1,19 +1,25 @@
+import argparse
+
 import cv2
 
+import config
+from camera_source import open_source
+
+# -------------------------------------------------------------------
+# スマートフォンのIPカメラアプリが表示したURLは config.py の VIDEO_STREAM_URL に入力してください
+# （例: 'http://192.168.1.5:8080/video'）。別のURLを試すときは引数で渡せます:
+#   python camera_test.py http://127.0.0.1:8080/video
 # -------------------------------------------------------------------
-# ▼▼▼▼▼ ここに、あなたのスマートフォンのIPカメラアプリが表示したURLを入力してください ▼▼▼▼▼
-# 例: 'http://192.168.1.5:8080/video'
-VIDEO_STREAM_URL = 'http://192.168.11.6:8080/video'
-# ▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲▲
 
-def main():
-    """指定されたURLのカメラ映像を表示するテストプログラム"""
+def main(url=None):
+    """指定されたURLのカメラ映像を表示するテストプログラム（vision_runner.py と同じ方法で開く）"""
+    url = url or config.VIDEO_STREAM_URL
 
-    print(f"接続先のURL: {VIDEO_STREAM_URL}")
+    print(f"接続先のURL: {url}")
     print("カメラに接続を試みています...")
 
-    # カメラに接続
-    cap = cv2.VideoCapture(VIDEO_STREAM_URL)
+    # カメラに接続（つながった後で切れた場合は、自動でつなぎ直す）
+    cap = open_source(url)
 
     # 接続チェック
     if not cap.isOpened():
@@ -32,10 +38,10 @@ def main():
 
     # メインループ
     while True:
-        # カメラから1フレーム読み込む
+        # カメラから1フレーム読み込む（切れている間は、つなぎ直すまで待つ）
         ret, frame = cap.read()
 
-        # フレームが正しく読み込めなかった場合はループを抜ける
+        # つなぎ直しを諦めた場合はループを抜ける
         if not ret:
             print("エラー: 映像ストリームからフレームを読み込めませんでした。接続が切れた可能性があります。")
             break
@@ -48,9 +54,12 @@ def main():
             break
 
     # 後処理
+    print(f"カメラ: {cap.stats()}")  # 受信・デコードを省いた枚数、つなぎ直した回数、デコード後の大きさ
     print("テストプログラムを終了します。")
     cap.release()          # カメラを解放
     cv2.destroyAllWindows()  # すべてのウィンドウを閉じる
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="カメラの映像を表示して接続を確かめます")
+    parser.add_argument('url', nargs='?', default=None, help="接続先のURL（省略すると config.VIDEO_STREAM_URL）")
+    main(parser.parse_args().url)
\ No newline at end of file
@@ -2,17 +2,247 @@
 
 # --- 定数設定 ---
 DB_NAME = 'memory_log.db'
+# SQLiteの調整値（database.connect で設定）
+DB_BUSY_TIMEOUT = 5.0          # 他の接続が書き込み中の時に待つ秒数
+DB_CACHE_SIZE_KB = 16384       # ページキャッシュ(KB)
+DB_MMAP_SIZE = 268435456       # メモリマップするサイズ(バイト)
+# 検索結果の1ページの件数（app.py・database.search_page）
+SEARCH_PAGE_SIZE = 20
 HISTORY_DIR = 'history'
 MODEL_ID = 'microsoft/Florence-2-large'
+
+# --- 起動設定 ---
+# 初回に読み込んだモデルをsafetensorsで保存しておき、次回からはここから読み込む（Noneなら保存しない）
+MODEL_SNAPSHOT_DIR = 'model_snapshots'
+# カメラを開く前に、合成画像で推論を空回しする回数（最初のフレームの推論が遅くならないように）
+WARMUP_RUNS = 1
+# 空回しに使う合成画像の大きさ（カメラの解像度に合わせる）
+WARMUP_IMAGE_SIZE = (1280, 720)
+
+# --- 推論バックエンド設定（backends.py） ---
+# 'eager'(標準のPyTorch) / 'int8'(動的int8量子化) / 'compile'(torch.compile) / 'onnx'(画像エンコーダをONNX Runtimeで実行)
+# eagerとの結果の一致は `python backends.py --backend <名前>` で確認できます
+INFERENCE_BACKEND = 'eager'
+# PyTorchのCPUスレッド数（Noneなら自動）
+TORCH_NUM_THREADS = None
+# onnxバックエンドの書き出し先とスレッド数
+ONNX_CACHE_DIR = 'onnx_cache'
+ONNX_NUM_THREADS = None
+
+# --- タスクとデコード設定 ---
+# '<DENSE_REGION_CAPTION>'(領域ごとの説明文) / '<OD>'(物体検出) /
+# '<OPEN_VOCABULARY_DETECTION>'(WHITELIST_KEYWORDSのキーワードごとに検出。1回のgenerateに束ねる) /
+# '<CAPTION_TO_PHRASE_GROUNDING>'(WHITELIST_KEYWORDSを1つのプロンプトに詰めて検出)
+# 下の2つはホワイトリストの物体だけをモデルに尋ねるので、散らかった場面でも生成量が増えません
+TASK_PROMPT = '<DENSE_REGION_CAPTION>'
+
+# generate() のデコード設定。num_beams=1 は貪欲法、max_new_tokens は生成トークン数の上限
+# 各プロファイルの速度と精度は `python profile_decoding.py` で計測できます
+DECODING_PROFILES = {
+    # これまでと同じ設定（最も遅いが基準になる）
+    'accurate': {'num_beams': 3, 'max_new_tokens': 1024},
+    'balanced': {'num_beams': 2, 'max_new_tokens': 512, 'early_stopping': True},
+    # ライブ追跡向け
+    'fast': {'num_beams': 1, 'max_new_tokens': 256},
+}
+DECODING_PROFILE = 'accurate'
 COLORS = ['red', 'blue', 'green', 'yellow', 'purple', 'orange']
 
 # --- Webカメラ設定を追加 ---
 WEBCAM_DEVICE_ID = 0  
+# 解析の頻度（scheduler.py が無効の場合は固定、有効な場合は最初の頻度）
 PROCESSING_FPS = 3    
 OBJECT_TRACKING_THRESHOLD_PIXELS = 75 
 
 FRAMES_TO_CONSIDER_DISAPPEARED = 5 
 
+# --- カメラ入力設定（camera_source.py） ---
+# スマートフォンのIPカメラアプリが表示したURL（例: 'http://192.168.1.5:8080/video'）。
+# Noneならローカルカメラ（WEBCAM_DEVICE_ID）を使います。手元で試すなら fake_mjpeg_server.py の 'http://127.0.0.1:8080/video'
+VIDEO_STREAM_URL = 'http://192.168.11.6:8080/video'
+# http(s) のURLは MJPEG を直接読み、縮小デコードします（Falseなら cv2.VideoCapture に任せる）
+CAMERA_MJPEG_DIRECT = True
+# 縮小デコードで残す短辺の最小ピクセル数（Florence-2 の入力 768x768 に合わせるなら 768。Noneなら縮小しない）。
+# 縮小するとフレームのピクセル数が変わるので、OBJECT_TRACKING_THRESHOLD_PIXELS と ROI_MIN_CROP_SIZE も
+# 縮小後の大きさに合わせて見直すこと（DBに記録する解像度も縮小後のものになる）
+CAMERA_DECODE_MIN_SIDE = None
+# この秒数フレームが届かなければ切れたとみなします（接続のタイムアウトも兼ねる）
+CAMERA_READ_TIMEOUT_SEC = 5.0
+# つなぎ直すまでの待ち時間（秒）。失敗するたびに倍にし、最大値で止めます
+CAMERA_RECONNECT_MIN_SEC = 0.5
+CAMERA_RECONNECT_MAX_SEC = 10.0
+# 続けて何回つなぎ直しに失敗したら諦めるか（Noneなら諦めずに待ち続ける）
+CAMERA_RECONNECT_MAX_ATTEMPTS = None
+
+# --- 追跡設定（tracker.py） ---
+# 対応付けのコスト: 'distance'(中心間の距離。OBJECT_TRACKING_THRESHOLD_PIXELS未満のみ) / 'iou'(1 - IoU)
+TRACKING_COST = 'distance'
+# 'iou' の場合、これ未満のIoUの組は対応付けない
+TRACKING_MIN_IOU = 0.3
+# Trueにすると、同じホワイトリストのキーワードを含むラベル同士だけを対応付ける
+TRACKING_LABEL_GATING = True
+# 最後に見えてからこの秒数が過ぎたら消失とみなす（解析の頻度が変わっても同じ時間で判定する）
+# Noneにすると、従来どおり FRAMES_TO_CONSIDER_DISAPPEARED 回見失ったら消失
+SECONDS_TO_CONSIDER_DISAPPEARED = 2.0
+# 時間で判定する場合も、最低この回数は続けて見失ってから消失とみなす（1回の検出漏れで消さない）
+DISAPPEAR_MIN_MISSES = 2
+
+# --- 解析頻度の自動調整（scheduler.py） ---
+# Falseにすると PROCESSING_FPS の固定の頻度で解析します
+SCHEDULER_ENABLED = True
+# 静止している時の最低頻度と、物体が出入りしている時の最大頻度（1秒あたりの解析回数）
+SCHEDULER_MIN_FPS = 0.5
+SCHEDULER_MAX_FPS = 8.0
+# 物体が現れた・消えた・見失い中になってから、最大頻度を保つ秒数
+SCHEDULER_ACTIVE_HOLD_SEC = 3.0
+# 何も変わらなかった時に、解析ごとに頻度に掛ける係数
+SCHEDULER_BACKOFF = 0.8
+# このプロセスの推論が使ってよいCPUの割合（全コアに対して。Noneなら制限しない）
+SCHEDULER_CPU_BUDGET = 0.6
+# 1コアあたりのロードアベレージがこれを超えたら、最低頻度に下げる
+SCHEDULER_LOAD_LIMIT = 1.5
+# 所要時間・CPU時間の移動平均に使う回数
+SCHEDULER_WINDOW = 10
+
+# --- フレーム置き場設定（frame_store.py） ---
+# 追跡中オブジェクトの「最後に見えたフレーム」は追跡ごとにコピーせず、ここで共有します
+# 'raw'(画像のまま) / 'jpeg'(圧縮して保持。メモリが少ない)
+FRAME_STORE_MODE = 'raw'
+# 追跡から参照されていなくても保持しておく直近のフレーム数
+FRAME_STORE_CAPACITY = 2
+FRAME_STORE_JPEG_QUALITY = 90
+
+# --- 保存設定（persistence.py） ---
+# Trueにすると、消失したオブジェクトの画像保存とDB記録を別スレッドでまとめて行います
+ASYNC_PERSISTENCE = True
+# 書き込み待ちキューの長さと、1トランザクションでまとめて記録する最大件数
+PERSIST_QUEUE_SIZE = 64
+PERSIST_BATCH_SIZE = 32
+# キューが満杯の時に待つ最大秒数（これを超えたらその記録は諦める）
+PERSIST_SUBMIT_TIMEOUT = 0.5
+
+# --- 画像保存設定（image_store.py） ---
+# 画像は内容のハッシュをファイル名にして保存し、同じフレームは1回だけ書き込みます
+# 'frame'(フレーム全体) / 'crop'(余白付きの切り出し画像 + 縮小したフレーム。ディスクの使用量が少ない)
+IMAGE_STORE_MODE = 'frame'
+IMAGE_STORE_JPEG_QUALITY = 75
+# 'crop' の場合の、切り出しの余白の割合と、縮小したフレームの長辺のピクセル数
+IMAGE_STORE_CROP_PADDING = 0.5
+IMAGE_STORE_CONTEXT_MAX_SIDE = 480
+
+# --- 保持ポリシー設定（retention.py） ---
+# Noneにした項目は適用しません
+RETENTION_MAX_AGE_DAYS = 30        # これより古い記録を削除する（日）
+RETENTION_KEEP_PER_LABEL = 200     # ラベルごとに新しい方から残す件数
+RETENTION_DISK_QUOTA_MB = 2048     # history/ の合計がこれを超えたら古い記録から削除する（MB）
+# 1トランザクションで削除する件数と、トランザクションの間に待つ秒数（書き込みスレッドを待たせない）
+RETENTION_BATCH_SIZE = 500
+RETENTION_BATCH_PAUSE = 0.05
+# incremental_vacuum で1回に切り詰めるページ数
+RETENTION_VACUUM_PAGES = 1000
+# Trueにすると、検出中はRETENTION_INTERVAL_SEC秒ごとに自動で適用する（既定では自動では消さない）
+# app.py のサイドバーか `python retention.py --schedule on` で保存した設定がある場合は、そちらが優先されます
+RETENTION_SCHEDULE_ENABLED = False
+RETENTION_INTERVAL_SEC = 3600
+
+# --- 画像キャッシュ設定（image_cache.py・app.py） ---
+# 検索画面に出す縮小画像・BBOX付き画像の保存先と、合計サイズの上限（超えたら古く使われたものから消す）
+IMAGE_CACHE_DIR = 'image_cache'
+IMAGE_CACHE_MAX_BYTES = 200 * 1024 * 1024
+# 縮小画像の長辺のピクセル数とJPEG品質
+IMAGE_CACHE_MAX_SIDE = 960
+IMAGE_CACHE_JPEG_QUALITY = 85
+# Trueにすると、保存スレッドが記録と同時にBBOX付き画像を作っておく（初回表示も速くなる）
+IMAGE_CACHE_WARM_ON_PERSIST = True
+# 検索結果を使い回す秒数（新しい記録が画面に出るまでの最大の遅れ）
+SEARCH_CACHE_TTL = 10
+# ラベルの描画に使うフォント
+FONT_PATH = 'meiryo.ttc'
+
+# --- シーン変化ゲート設定 ---
+# 前回解析したフレームとの差が小さい場合はVLMの推論を省略し、追跡状態をそのまま引き継ぎます
+SCENE_GATE_ENABLED = True
+# 縮小グレースケール画像の平均絶対差分(0〜1)がこの値未満なら「変化なし」とみなす
+SCENE_CHANGE_THRESHOLD = 0.02
+# 比較に使う縮小画像の一辺のピクセル数
+SCENE_GATE_SIZE = 32
+# 変化が無くても、この回数連続で省略したら1回は推論する
+SCENE_GATE_MAX_SKIPS = 30
+
+# --- 切り出し(ROI)推論設定 ---
+# Trueにすると、追跡中のオブジェクトは前回位置の周囲だけを切り出して再確認します
+ROI_INFERENCE_ENABLED = True
+# この回数に1回はフレーム全体で推論し、新しい物体を探す
+ROI_FULL_FRAME_INTERVAL = 5
+# バウンディングボックスの幅・高さに対する余白の割合
+ROI_PADDING_RATIO = 0.5
+# 切り出し範囲の最小の一辺（ピクセル）
+ROI_MIN_CROP_SIZE = 128
+# 追跡中のオブジェクトがこれより多い場合は、フレーム全体で推論する
+ROI_MAX_CROPS = 4
+
+# --- パイプライン設定 ---
+# Trueにすると、取り込み・推論・表示を別スレッドで動かします（vision_runner.py）
+PIPELINE_MODE = True
+# 段と段の間のキューの長さ。1にすると常に最新フレームだけを解析します
+PIPELINE_FRAME_QUEUE_SIZE = 1
+PIPELINE_RESULT_QUEUE_SIZE = 1
+
+# --- 計測設定（metrics.py） ---
+# Falseにすると計測は一切行いません（区間の計測は何もしないオブジェクトになる）
+METRICS_ENABLED = True
+# Prometheus形式の取得口（http://METRICS_HOST:METRICS_PORT/metrics）。Noneなら開かない
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+# この秒数ごとに計測値の要約を1行表示する（Noneなら表示しない）
+METRICS_LOG_INTERVAL_SEC = 30
+# 分位数を計算する直近の回数と、FPSを計算する期間（秒）
+METRICS_WINDOW = 512
+METRICS_RATE_PERIOD_SEC = 10
+
+# --- 推論サービス設定（detector_service.py） ---
+# 設定すると main.py・vision_runner.py・multi_runner.py はモデルを読み込まず、
+# `python detector_service.py` で起動したサービスに推論を頼みます（例: 'http://127.0.0.1:8765'）
+DETECTOR_SERVICE_URL = None
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+# 待ち行列の長さ（満杯なら断る）、1回の推論に束ねる最大件数、束ねるために待つミリ秒
+SERVICE_QUEUE_SIZE = 16
+SERVICE_MAX_BATCH = 4
+SERVICE_BATCH_WAIT_MS = 10
+# 1件の要求の期限（秒）と、送る画像のJPEG品質
+SERVICE_REQUEST_TIMEOUT = 30.0
+SERVICE_JPEG_QUALITY = 90
+
+# --- 見た目の類似検索設定（embedding_index.py） ---
+# 検出に使った画像特徴量から物体ごとの埋め込みを作り、記録と一緒に保存します（追加の推論はしません）
+EMBEDDING_INDEX_ENABLED = True
+# 埋め込みのファイル名（拡張子 .f16 と .ids のファイルが作られます）
+EMBEDDING_INDEX_PATH = 'memory_log.embeddings'
+# 埋め込みの次元数（画像特徴量を乱数射影で縮めます。小さいほど検索が速く、ファイルも小さい）
+EMBEDDING_DIM = 256
+# 「似ている記録を探す」で表示する件数
+SIMILAR_TOP_K = 12
+
+# --- 複数カメラ設定（multi_runner.py） ---
+# ストリームID: 接続先（URL または カメラデバイスID）
+# 全カメラのフレームを1回の推論にまとめ、1つのモデルを共有します
+VIDEO_SOURCES = {
+    'living': VIDEO_STREAM_URL,
+    'desk': WEBCAM_DEVICE_ID,
+}
+
+# --- 録画の一括取り込み設定（backfill.py） ---
+# 推論するプロセスの数と、1プロセスあたりのPyTorchのスレッド数（Noneなら CPUコア数 ÷ プロセス数）
+BACKFILL_WORKERS = 2
+BACKFILL_THREADS_PER_WORKER = None
+# 動画を何秒ごとの区間に分けて各プロセスに配るか
+BACKFILL_SEGMENT_SEC = 300
+# 1秒あたり何フレームを解析するか（間のフレームはデコードせずに読み飛ばす）
+BACKFILL_SAMPLE_FPS = 1.0
+# 1回の推論に束ねるフレーム数
+BACKFILL_BATCH_SIZE = 4
+
 
 # 記録したいオブジェクトのキーワードを列挙します。
 # 例として、鍵、カップ、眼鏡、スマートフォンを登録します。
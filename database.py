@@ -1,76 +1,473 @@
 # database.py (修正版)
 
+import heapq
+import re
 import sqlite3
 import os
 from datetime import datetime
 import config
+import metrics
 import shutil
 
-# init_dbは変更なし
+# スキーマのバージョン（PRAGMA user_version に記録する）
+#   1: timestamp・bbox_coords をTEXTで持つ最初の形式
+#   2: 時刻はUNIX秒の整数、bboxは数値の列、ラベルとキーワードは別テーブル
+#   3: ラベル（説明文）の全文検索用に FTS5 の索引を追加
+#   4: 切り出し画像のパス(crop_path)と、保存画像の縮小率(image_scale)を追加
+#   5: 画像ファイルがまだ参照されているかを調べるため crop_path に索引を追加（retention.py）
+SCHEMA_VERSION = 5
+
+SCHEMA_V2 = [
+    '''CREATE TABLE IF NOT EXISTS labels (
+        id INTEGER PRIMARY KEY,
+        text TEXT NOT NULL UNIQUE
+    )''',
+    '''CREATE TABLE IF NOT EXISTS keywords (
+        id INTEGER PRIMARY KEY,
+        keyword TEXT NOT NULL UNIQUE
+    )''',
+    '''CREATE TABLE IF NOT EXISTS label_keywords (
+        keyword_id INTEGER NOT NULL REFERENCES keywords(id),
+        label_id INTEGER NOT NULL REFERENCES labels(id),
+        PRIMARY KEY (keyword_id, label_id)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS detections (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        timestamp INTEGER NOT NULL,
+        label_id INTEGER NOT NULL REFERENCES labels(id),
+        x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER,
+        image_path TEXT
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_detections_timestamp ON detections (timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_detections_label_timestamp ON detections (label_id, timestamp)",
+]
+
+# ラベルの全文検索索引。labels と同じ内容をトリガーで同期する
+# porter: 語幹でまとめる（cups → cup）、prefix: 前方一致(cup*)を速くする
+SCHEMA_V3 = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS labels_fts USING fts5(
+        text, content='labels', content_rowid='id',
+        tokenize='porter unicode61 remove_diacritics 2', prefix='2 3'
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS labels_fts_insert AFTER INSERT ON labels BEGIN
+        INSERT INTO labels_fts (rowid, text) VALUES (new.id, new.text);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS labels_fts_delete AFTER DELETE ON labels BEGIN
+        INSERT INTO labels_fts (labels_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS labels_fts_update AFTER UPDATE ON labels BEGIN
+        INSERT INTO labels_fts (labels_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO labels_fts (rowid, text) VALUES (new.id, new.text);
+    END''',
+    # 既にあるラベルから索引を作り直す
+    "INSERT INTO labels_fts (labels_fts) VALUES ('rebuild')",
+]
+
+# 画像は image_store.py が内容のハッシュで保存し、複数の行で同じファイルを共有する
+# image_scale: image_path の画像の大きさ / 元のフレームの大きさ（BBOXは元のフレームの座標）
+SCHEMA_V4 = [
+    "ALTER TABLE detections ADD COLUMN crop_path TEXT",
+    "ALTER TABLE detections ADD COLUMN image_scale REAL NOT NULL DEFAULT 1.0",
+    "CREATE INDEX IF NOT EXISTS idx_detections_image_path ON detections (image_path)",
+]
+
+SCHEMA_V5 = [
+    "CREATE INDEX IF NOT EXISTS idx_detections_crop_path ON detections (crop_path)",
+]
+
+# 検索結果の列（timestampは表示用の文字列に直して返す）
+RESULT_COLUMNS = '''
+    d.id AS id,
+    strftime('%Y-%m-%d %H:%M:%S', d.timestamp, 'unixepoch', 'localtime') AS timestamp,
+    d.timestamp AS epoch,
+    l.text AS label,
+    d.image_path AS image_path,
+    d.crop_path AS crop_path,
+    d.image_scale AS image_scale,
+    d.x1 AS x1, d.y1 AS y1, d.x2 AS x2, d.y2 AS y2
+'''
+
+def connect():
+    """データベースへの接続を開く（長く使い続ける接続は別スレッドから使えるようにする）"""
+    conn = sqlite3.connect(config.DB_NAME, check_same_thread=False, timeout=config.DB_BUSY_TIMEOUT)
+    # WALにすると、書き込み中でも検索（読み込み）が待たされない
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA cache_size=-{int(config.DB_CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA mmap_size={int(config.DB_MMAP_SIZE)}")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+def to_epoch(value):
+    """'YYYY-mm-dd HH:MM:SS' の文字列・datetime・数値を、UNIX秒の整数にする"""
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    if isinstance(value, str):
+        return int(datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp())
+    return int(value)
+
+def extract_keywords(label):
+    """ラベルから検索用のキーワード（小文字の単語と、含まれるホワイトリストのキーワード）を取り出す"""
+    words = set(re.findall(r'[a-z0-9]+', label.lower()))
+    words.update(keyword for keyword in config.WHITELIST_KEYWORDS if keyword in label.lower())
+    return words
+
+def get_label_id(conn, label):
+    """ラベルのIDを返す。初めてのラベルなら labels とキーワードの表に追加する"""
+    row = conn.execute("SELECT id FROM labels WHERE text = ?", (label,)).fetchone()
+    if row:
+        return row[0]
+    label_id = conn.execute("INSERT INTO labels (text) VALUES (?)", (label,)).lastrowid
+    for keyword in extract_keywords(label):
+        conn.execute("INSERT OR IGNORE INTO keywords (keyword) VALUES (?)", (keyword,))
+        conn.execute(
+            "INSERT OR IGNORE INTO label_keywords (keyword_id, label_id) "
+            "SELECT id, ? FROM keywords WHERE keyword = ?",
+            (label_id, keyword)
+        )
+    return label_id
+
+def parse_bbox_str(bbox_str):
+    """旧形式の 'x1,y1,x2,y2' を数値のリストにする。読めなければ全てNone"""
+    try:
+        coords = [int(float(coord)) for coord in bbox_str.split(',')]
+        if len(coords) == 4:
+            return coords
+    except (AttributeError, ValueError):
+        pass
+    return [None, None, None, None]
+
+def fts5_available(conn):
+    """SQLiteがFTS5付きでビルドされているかどうか"""
+    try:
+        conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def migrate(conn):
+    """古い形式のデータベースを、その場で最新のスキーマに変換する"""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(detections)")]
+
+    if version < 2:
+        if 'bbox_coords' in columns:
+            migrate_v1_to_v2(conn)
+        else:
+            with conn:
+                conn.execute("BEGIN")
+                for statement in SCHEMA_V2:
+                    conn.execute(statement)
+                conn.execute("PRAGMA user_version = 2")
+        version = 2
+
+    if version < 3:
+        # FTS5が無い場合は索引を作らずに進める（検索はキーワード表・部分一致で行う）
+        statements = SCHEMA_V3 if fts5_available(conn) else []
+        if not statements:
+            print("警告: このSQLiteはFTS5に対応していないため、全文検索の索引は作りません。")
+        with conn:
+            conn.execute("BEGIN")
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute("PRAGMA user_version = 3")
+        version = 3
+
+    if version < 4:
+        with conn:
+            conn.execute("BEGIN")
+            for statement in SCHEMA_V4:
+                conn.execute(statement)
+            conn.execute("PRAGMA user_version = 4")
+        version = 4
+
+    if version < 5:
+        with conn:
+            conn.execute("BEGIN")
+            for statement in SCHEMA_V5:
+                conn.execute(statement)
+            conn.execute("PRAGMA user_version = 5")
+
+def enable_incremental_vacuum(conn):
+    """削除で空いたページを少しずつ切り詰められるようにする（retention.py の incremental_vacuum）
+
+    WALモードでは設定を変えた後にVACUUMで作り直す必要がある（既存のデータベースでは初回のみ時間がかかる）。
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    if conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        print("データベースを再構成しています（初回のみ）...")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+def migrate_v1_to_v2(conn):
+    """TEXTで持っていた最初の形式(1)を、型付きの列と正規化したラベル表(2)に変換する"""
+    print("データベースを新しい形式に変換しています...")
+    with conn:
+        # DDLも含めて1つのトランザクションにする（途中で失敗したら元に戻る）
+        conn.execute("BEGIN")
+        conn.execute("ALTER TABLE detections RENAME TO detections_v1")
+        for statement in SCHEMA_V2:
+            conn.execute(statement)
+        cursor = conn.execute(
+            "SELECT id, CAST(strftime('%s', timestamp, 'utc') AS INTEGER), label, bbox_coords, image_path "
+            "FROM detections_v1 ORDER BY id"
+        )
+        while True:
+            chunk = cursor.fetchmany(10000)
+            if not chunk:
+                break
+            conn.executemany(
+                "INSERT INTO detections (id, timestamp, label_id, x1, y1, x2, y2, image_path) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (row_id, epoch or 0, get_label_id(conn, label), *parse_bbox_str(bbox_str), image_path)
+                    for row_id, epoch, label, bbox_str, image_path in chunk
+                ]
+            )
+        conn.execute("DROP TABLE detections_v1")
+        conn.execute("PRAGMA user_version = 2")
+    print("データベースの変換が完了しました。")
+
 def init_db():
     if not os.path.exists(config.HISTORY_DIR):
         os.makedirs(config.HISTORY_DIR)
-        
-    conn = sqlite3.connect(config.DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS detections (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            timestamp TEXT NOT NULL,
-            label TEXT NOT NULL,
-            bbox_coords TEXT,
-            image_path TEXT
-        )
-    ''')
-    conn.commit()
+
+    conn = connect()
+    enable_incremental_vacuum(conn)
+    migrate(conn)
     conn.close()
     print(f"データベース '{config.DB_NAME}' を準備しました。")
 
 
 # ★★★ save_detection関数を修正 ★★★
 # この関数はDBへの記録に専念させ、引数で全ての情報を受け取るようにします。
-def save_detection(timestamp_str, image_path, label, bbox):
-    """検出情報をデータベースに記録する"""
-    conn = sqlite3.connect(config.DB_NAME)
-    cursor = conn.cursor()
-    
-    bbox_str = ','.join(map(str, [int(coord) for coord in bbox]))
-    
-    cursor.execute(
-        "INSERT INTO detections (timestamp, label, bbox_coords, image_path) VALUES (?, ?, ?, ?)",
-        (timestamp_str, label, bbox_str, image_path)
-    )
-    
-    conn.commit()
-    conn.close()
-    # vision.py側でメッセージを出すので、ここでのprintは不要
-    # print(f"  [DB Save] {label}")
+def save_detection(timestamp_str, image_path, label, bbox, crop_path=None, image_scale=1.0):
+    """検出情報をデータベースに記録し、その記録のIDを返す"""
+    # vision.py側でメッセージを出すので、ここではprintしない
+    return save_detections([(timestamp_str, image_path, label, bbox, crop_path, image_scale)])[0]
+
+def save_detections(rows, conn=None):
+    """複数の検出情報 (timestamp, image_path, label, bbox) を1トランザクションで記録する
+
+    timestamp は 'YYYY-mm-dd HH:MM:SS' の文字列・datetime・UNIX秒のどれでもよい。
+    行の後ろに (crop_path, image_scale) を付けると、切り出し画像と縮小率も記録する。
+    conn を渡すとその接続を使い回す（閉じない）。省略すると接続を開いて閉じる。
+    戻り値は rows と同じ順番の、記録した行のIDのリスト（embedding_index.py で使う）。
+    """
+    if not rows:
+        return []
+    own_conn = conn is None
+    if own_conn:
+        conn = connect()
+    try:
+        with metrics.span('db_write'), conn:
+            # ラベルの検索から記録の追加までを1つの書き込みトランザクションにする
+            # （途中で retention.remove_unused_labels がラベルを消すと、外部キー違反で全件失敗するため）
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            ids = [
+                conn.execute(
+                    "INSERT INTO detections (timestamp, label_id, x1, y1, x2, y2, image_path, crop_path, image_scale) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        to_epoch(row[0]), get_label_id(conn, row[2]), *[int(coord) for coord in row[3]], row[1],
+                        *(row[4:6] if len(row) >= 6 else (None, 1.0)),
+                    )
+                ).lastrowid
+                for row in rows
+            ]
+    finally:
+        if own_conn:
+            conn.close()
+    return ids
+
+def get_detections(ids, conn=None):
+    """IDを指定して記録を取り出す。ids と同じ順番で、削除済みのIDは飛ばす"""
+    if not ids:
+        return []
+    own_conn = conn is None
+    if own_conn:
+        conn = connect()
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            f"SELECT {RESULT_COLUMNS} FROM detections d JOIN labels l ON l.id = d.label_id "
+            f"WHERE d.id IN ({','.join('?' * len(ids))})",
+            list(ids)
+        ).fetchall()
+    finally:
+        if own_conn:
+            conn.close()
+    by_id = {row['id']: row for row in rows}
+    return [by_id[i] for i in ids if i in by_id]
+
+def search_for_object(keyword, order='recent'):
+    """キーワードに一致するオブジェクトの履歴を検索して返す
 
-# search_for_objectは変更なし
-def search_for_object(keyword):
-    """キーワードに一致するオブジェクトの履歴を検索して返す"""
-    conn = sqlite3.connect(config.DB_NAME)
+    キーワードは全文検索の式として解釈する（build_fts_query を参照）。
+    order='recent' なら新しい順、'relevance' ならラベルの一致度(bm25)の高い順。
+    ラベル（重複を除いた説明文）の索引を引いてから detections を索引で結合するので、
+    detections 全体は走査しない。
+    """
+    conn = connect()
     # 結果を辞書型で受け取れるようにする
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
-    
+
+    label_ids_sql, params = matching_label_ids(conn, keyword)
+    if label_ids_sql is None:
+        conn.close()
+        return []
+    order_by = "m.rank, d.timestamp DESC, d.id DESC" if order == 'relevance' else "d.timestamp DESC, d.id DESC"
     cursor.execute(
-        "SELECT timestamp, label, image_path FROM detections WHERE label LIKE ? ORDER BY timestamp DESC", 
-        ('%' + keyword + '%',)
+        f"SELECT {RESULT_COLUMNS}, m.rank AS rank FROM detections d "
+        f"JOIN ({label_ids_sql}) m ON m.label_id = d.label_id "
+        "JOIN labels l ON l.id = d.label_id "
+        f"ORDER BY {order_by}",
+        params
     )
-    
+
     results = cursor.fetchall()
     conn.close()
     return results
 
+def search_page(keyword=None, limit=None, after=None, start=None, end=None, label=None, conn=None):
+    """検索結果を新しい順に1ページ分だけ返す（キーセット方式のページ送り）
+
+    keyword : 全文検索の式（省略すると全件）
+    after   : 前のページが返した次ページのカーソル (timestamp, id)。省略すると最初のページ
+    start, end : 検出日時の範囲（datetime・文字列・UNIX秒。start以上、end未満）
+    label   : ホワイトリストのキーワード（例: 'cup'）で絞り込む
+    戻り値  : (行のリスト, 次のページのカーソル。最後のページならNone)
+
+    キーワード・ラベルで絞り込む場合は、一致したラベルごとに (label_id, timestamp, id) の索引を
+    新しい順に limit+1 件だけ読み、それらを併合する。多くの記録に一致する語でも、一致した行を
+    全て並べ替えることはない（読む行数は 一致したラベルの数 × ページの大きさ まで）。
+    """
+    limit = limit or config.SEARCH_PAGE_SIZE
+    own_conn = conn is None
+    if own_conn:
+        conn = connect()
+    conn.row_factory = sqlite3.Row
+    try:
+        label_ids = None
+        if keyword and keyword.strip():
+            label_ids_sql, keyword_params = matching_label_ids(conn, keyword)
+            if label_ids_sql is None:
+                return [], None
+            label_ids = {row[0] for row in conn.execute(f"SELECT label_id FROM ({label_ids_sql})", keyword_params)}
+        if label:
+            keyword_label_ids = {row[0] for row in conn.execute(
+                "SELECT lk.label_id FROM label_keywords lk JOIN keywords k ON k.id = lk.keyword_id WHERE k.keyword = ?",
+                (label.strip().lower(),)
+            )}
+            label_ids = keyword_label_ids if label_ids is None else label_ids & keyword_label_ids
+
+        where, params = [], []
+        if start is not None:
+            where.append("d.timestamp >= ?")
+            params.append(to_epoch(start))
+        if end is not None:
+            where.append("d.timestamp < ?")
+            params.append(to_epoch(end))
+        if after is not None:
+            # 前のページの最後の行より「古い」行だけ（OFFSETを使わないので深いページでも速い）
+            where.append("(d.timestamp, d.id) < (?, ?)")
+            params.extend([after[0], after[1]])
+
+        sql = f"SELECT {RESULT_COLUMNS} FROM detections d JOIN labels l ON l.id = d.label_id"
+        if label_ids is not None:
+            where.insert(0, "d.label_id = ?")
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY d.timestamp DESC, d.id DESC LIMIT ?"
+        # 1件多く取って、次のページがあるかを判定する
+        params.append(limit + 1)
+        with metrics.span('db_search'):
+            if label_ids is None:
+                rows = conn.execute(sql, params).fetchall()
+            else:
+                # ラベルごとの結果は既に新しい順なので、併合して先頭の limit+1 件だけを取る
+                pages = [conn.execute(sql, [label_id, *params]).fetchall() for label_id in sorted(label_ids)]
+                merged = heapq.merge(*pages, key=lambda row: (row['epoch'], row['id']), reverse=True)
+                rows = [row for _, row in zip(range(limit + 1), merged)]
+    finally:
+        if own_conn:
+            conn.close()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = (rows[-1]['epoch'], rows[-1]['id'])
+    return rows, next_cursor
+
+def iter_search(keyword=None, page_size=None, **filters):
+    """検索結果を1件ずつ返すジェネレータ（内部では search_page で1ページずつ読む）"""
+    conn = connect()
+    try:
+        after = None
+        while True:
+            rows, after = search_page(keyword, limit=page_size, after=after, conn=conn, **filters)
+            yield from rows
+            if after is None:
+                break
+    finally:
+        conn.close()
+
+def build_fts_query(text):
+    """検索欄の入力をFTS5の検索式にする
+
+    - 空白で区切った単語は全て含むもの(AND)を探す
+    - "black wallet" のように " で囲むと、その並びのフレーズを探す
+    - 末尾に * を付けると前方一致（smart* → smartphone）
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+        if phrase.strip():
+            terms.append('"' + phrase.strip() + '"')
+        elif word:
+            prefix = word.endswith('*')
+            word = word.rstrip('*').replace('"', '')
+            if word:
+                terms.append('"' + word + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+def matching_label_ids(conn, keyword):
+    """キーワードに一致するラベルを (label_id, rank) で返す副問い合わせと、そのパラメータ
+
+    全文検索の索引(labels_fts)があればそれを使い、無ければキーワード表・部分一致で探す。
+    検索式が空ならNoneを返す。
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'labels_fts'").fetchone():
+        query = build_fts_query(keyword)
+        if not query:
+            return None, ()
+        return (
+            "SELECT rowid AS label_id, bm25(labels_fts) AS rank FROM labels_fts WHERE labels_fts MATCH ?"
+        ), (query,)
+
+    normalized = keyword.strip().lower()
+    if conn.execute("SELECT 1 FROM keywords WHERE keyword = ?", (normalized,)).fetchone():
+        return (
+            "SELECT lk.label_id AS label_id, 0 AS rank FROM label_keywords lk "
+            "JOIN keywords k ON k.id = lk.keyword_id WHERE k.keyword = ?"
+        ), (normalized,)
+    return "SELECT id AS label_id, 0 AS rank FROM labels WHERE text LIKE ?", ('%' + keyword + '%',)
+
 def clear_db():
     """データベースの全レコードと、historyフォルダ内の全画像ファイルを削除する"""
     try:
         # 1. データベースの全レコードを削除
-        conn = sqlite3.connect(config.DB_NAME)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM detections")
-        conn.commit()
+        conn = connect()
+        with conn:
+            conn.execute("DELETE FROM detections")
+            conn.execute("DELETE FROM label_keywords")
+            conn.execute("DELETE FROM keywords")
+            # 全文検索の索引(labels_fts)はトリガーで一緒に空になる
+            conn.execute("DELETE FROM labels")
         conn.close()
         print("データベースの全レコードを削除しました。")
 
@@ -81,9 +478,9 @@ def clear_db():
             shutil.rmtree(history_path)
             os.makedirs(history_path)
             print("historyフォルダ内の全画像ファイルを削除しました。")
-        
+
         return True, "データベースと履歴ファイルを正常にクリアしました。"
-        
+
     except Exception as e:
         print(f"データベースのクリア中にエラーが発生しました: {e}")
-        return False, f"エラーが発生しました: {e}"
\ No newline at end of file
+        return False, f"エラーが発生しました: {e}"
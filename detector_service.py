@@ -0,0 +1,391 @@
+# detector_service.py
+# VLM_Detector を1つのプロセスだけで持ち、他のプロセスからはHTTPで推論を頼むための常駐サービス
+#
+#   python detector_service.py          # サービスを起動（モデルを読み込み、空回しして待つ）
+#
+# config.DETECTOR_SERVICE_URL を設定すると、main.py・vision_runner.py・multi_runner.py は
+# モデルを読み込まずにこのサービスを使います（RemoteDetector）。app.py の「その場で解析」もこれを使います。
+# こうするとメモリ上の重みは常に1つだけになります。
+#
+# 同時に届いた要求は SERVICE_BATCH_WAIT_MS だけ待って最大 SERVICE_MAX_BATCH 件まで束ね、
+# 1回のgenerateで推論します（マイクロバッチ）。待ち行列が満杯なら503、期限までに終わらなければ504を返します。
+#
+#   POST /track?stream_id=living   本文はJPEG。追跡を更新し、追跡中オブジェクトを返す
+#   POST /detect                   本文はJPEG。追跡・保存をせずに検出結果だけを返す
+#   GET  /health                   待ち行列の長さや統計
+
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+import config
+import metrics
+from vision import DEFAULT_STREAM_ID, bgr_view, draw_tracked_objects
+
+
+class ServiceError(Exception):
+    """推論サービスがエラーを返した、または接続できなかった"""
+
+
+class _Request:
+    """待ち行列に積む1件の推論要求"""
+
+    def __init__(self, kind, image, stream_id, task_prompt, decoding, timeout):
+        self.kind = kind  # 'track' または 'detect'
+        self.image = image
+        self.stream_id = stream_id
+        self.task_prompt = task_prompt
+        self.decoding = decoding
+        self.deadline = time.monotonic() + timeout
+        self.enqueued_at = time.monotonic()
+        self.done = threading.Event()
+        self.cancelled = False
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class DetectorService:
+    """待ち行列から要求を取り出し、束ねて VLM_Detector で推論するスレッドを持つ"""
+
+    def __init__(self, detector, max_batch=None, batch_wait_ms=None, queue_size=None):
+        self.detector = detector
+        self.max_batch = max_batch or config.SERVICE_MAX_BATCH
+        self.batch_wait = (config.SERVICE_BATCH_WAIT_MS if batch_wait_ms is None else batch_wait_ms) / 1000
+        self.queue = queue.Queue(maxsize=queue_size or config.SERVICE_QUEUE_SIZE)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='detector-service', daemon=True)
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.rejected = 0
+        self.expired = 0
+        # 推論器の統計は推論スレッドだけが触るので、バッチごとに写しを作って /health に渡す
+        self.detector_stats = {}
+
+    def start(self):
+        self._publish_detector_stats()
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def submit(self, request):
+        """要求を待ち行列に積む。満杯ならFalse"""
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            metrics.inc('service_rejected')
+            return False
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            # 少しだけ待って、同時に届いた要求を束ねる
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._process(batch)
+
+    def _process(self, batch):
+        now = time.monotonic()
+        live = []
+        for request in batch:
+            if request.cancelled or request.deadline < now:
+                # 呼び出し側がもう待っていない要求は推論しない
+                with self._lock:
+                    self.expired += 1
+                metrics.inc('service_expired')
+                request.finish(error='timeout')
+            else:
+                metrics.observe('service_queue_wait', now - request.enqueued_at)
+                live.append(request)
+        if not live:
+            return
+
+        # 同じ設定（種類・タスク・デコード設定）の要求ごとに1回の推論にまとめる
+        groups = {}
+        for request in live:
+            groups.setdefault((request.kind, request.task_prompt, request.decoding), []).append(request)
+        for (kind, task_prompt, decoding), requests in groups.items():
+            try:
+                if kind == 'track':
+                    self._track(requests, task_prompt, decoding)
+                else:
+                    detections = self.detector.detect(
+                        [request.image for request in requests], task_prompt=task_prompt, decoding=decoding
+                    )
+                    for request, result in zip(requests, detections):
+                        request.finish({'detections': result})
+            except Exception as e:
+                print(f"  [Service] 推論に失敗しました: {e}")
+                for request in requests:
+                    request.finish(error=str(e))
+        with self._lock:
+            self.batches += 1
+            self.requests += len(live)
+        metrics.observe('service_batch_size', len(live))
+        self._publish_detector_stats()
+
+    def _publish_detector_stats(self):
+        """シーン変化ゲート・フレーム置き場の統計の写しを作る（推論スレッドから呼ぶ）"""
+        detector_stats = {
+            'gate_stats': self.detector.gate_stats(),
+            'frame_store': self.detector.frame_store_stats(),
+        }
+        with self._lock:
+            self.detector_stats = detector_stats
+
+    def _track(self, requests, task_prompt, decoding):
+        # 1回のバッチには同じストリームのフレームを1枚しか入れられないので、最新のものだけを推論し、
+        # 古い方にも同じ結果を返す
+        latest = {}
+        for request in requests:
+            latest[request.stream_id] = request
+        targets = list(latest.values())
+        tracks_per_image = self.detector.update_batch(
+            [request.image for request in targets], [request.stream_id for request in targets],
+            task_prompt=task_prompt, decoding=decoding,
+        )
+        tracks_by_stream = {
+            request.stream_id: [
+                {'id': track['id'], 'bbox': track['bbox'], 'label': track['label'],
+                 'unseen_frames': track['unseen_frames']}
+                for track in tracks
+            ]
+            for request, tracks in zip(targets, tracks_per_image)
+        }
+        for request in requests:
+            request.finish({'tracks': tracks_by_stream[request.stream_id]})
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue': self.queue.qsize(),
+                'batches': self.batches,
+                'requests': self.requests,
+                'rejected': self.rejected,
+                'expired': self.expired,
+            }
+
+    def published_detector_stats(self):
+        """最後のバッチの後の推論器の統計（HTTPのスレッドから呼んでよい）"""
+        with self._lock:
+            return self.detector_stats
+
+
+def _make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if urllib.parse.urlparse(self.path).path != '/health':
+                self._send_json(404, {'error': 'not found'})
+                return
+            # 推論スレッドが更新中の辞書は読まず、バッチごとに作った写しを返す
+            self._send_json(200, {
+                'status': 'ok',
+                'service': service.stats(),
+                **service.published_detector_stats(),
+            })
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            kind = url.path.strip('/')
+            if kind not in ('track', 'detect'):
+                self._send_json(404, {'error': 'not found'})
+                return
+            params = dict(urllib.parse.parse_qsl(url.query))
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                image = Image.open(io.BytesIO(body)).convert('RGB')
+                timeout = float(params.get('timeout', config.SERVICE_REQUEST_TIMEOUT))
+            except (OSError, ValueError) as e:
+                self._send_json(400, {'error': f'bad request: {e}'})
+                return
+
+            request = _Request(
+                kind, image, params.get('stream_id', DEFAULT_STREAM_ID),
+                params.get('task'), params.get('decoding'), timeout,
+            )
+            if not service.submit(request):
+                self._send_json(503, {'error': 'busy'})
+                return
+            if not request.done.wait(timeout):
+                request.cancelled = True
+                self._send_json(504, {'error': 'timeout'})
+                return
+            if request.error is not None:
+                self._send_json(504 if request.error == 'timeout' else 500, {'error': request.error})
+                return
+            self._send_json(200, request.result)
+
+        def log_message(self, format, *args):
+            # アクセスごとのログは出さない
+            pass
+
+    return Handler
+
+
+def serve(host=None, port=None):
+    """モデルを読み込み、推論サービスを起動して終了するまで待つ"""
+    from vision import VLM_Detector
+    import database
+
+    database.init_db()
+    detector = VLM_Detector()
+    detector.warm_up()
+    service = DetectorService(detector)
+    service.start()
+    host = host or config.SERVICE_HOST
+    port = port or config.SERVICE_PORT
+    server = ThreadingHTTPServer((host, port), _make_handler(service))
+    server.daemon_threads = True
+    print(f">>> 推論サービスを http://{host}:{port} で開始しました。Ctrl+Cで終了します。 <<<")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        detector.close()
+        print(f"推論サービス統計: {service.stats()}")
+
+
+class DetectorClient:
+    """推論サービスのクライアント"""
+
+    def __init__(self, url=None, timeout=None):
+        self.url = (url or config.DETECTOR_SERVICE_URL or f'http://{config.SERVICE_HOST}:{config.SERVICE_PORT}').rstrip('/')
+        self.timeout = config.SERVICE_REQUEST_TIMEOUT if timeout is None else timeout
+
+    def _request(self, path, params=None, image=None):
+        query = urllib.parse.urlencode({k: v for k, v in (params or {}).items() if v is not None})
+        data = None
+        if image is not None:
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=config.SERVICE_JPEG_QUALITY)
+            data = buffer.getvalue()
+        request = urllib.request.Request(
+            f'{self.url}{path}?{query}', data=data,
+            headers={'Content-Type': 'image/jpeg'} if data is not None else {},
+        )
+        try:
+            # サーバ側の期限より少し長く待つ（サーバが504を返せるように）
+            with urllib.request.urlopen(request, timeout=self.timeout + 5) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            raise ServiceError(f'{e.code}: {e.read().decode("utf-8", "replace")}') from e
+        except (urllib.error.URLError, OSError) as e:
+            raise ServiceError(f'推論サービスに接続できません ({self.url}): {e}') from e
+
+    def health(self):
+        return self._request('/health')
+
+    def track(self, image, stream_id=DEFAULT_STREAM_ID, task_prompt=None, decoding=None):
+        """追跡を更新し、追跡中オブジェクトのリストを返す"""
+        params = {'stream_id': stream_id, 'task': task_prompt, 'decoding': decoding, 'timeout': self.timeout}
+        return self._request('/track', params, image)['tracks']
+
+    def detect(self, image, task_prompt=None, decoding=None):
+        """追跡・保存をせずに検出結果だけを返す"""
+        params = {'task': task_prompt, 'decoding': decoding, 'timeout': self.timeout}
+        return self._request('/detect', params, image)['detections']
+
+
+class RemoteDetector:
+    """VLM_Detector と同じ呼び方で、推論サービスに推論を頼む（このプロセスではモデルを読み込まない）"""
+
+    # 推論のCPUはサービスのプロセスで使われる（AdaptiveScheduler はCPUの予算を使わない）
+    cpu_in_process = False
+
+    def __init__(self, url=None):
+        self.client = DetectorClient(url)
+        self.client.health()
+        print(f"推論サービスに接続しました: {self.client.url}")
+        self._pool = ThreadPoolExecutor(max_workers=config.SERVICE_MAX_BATCH, thread_name_prefix='remote-detector')
+
+    def warm_up(self, *args, **kwargs):
+        """サービス側で空回し済みなので何もしない"""
+
+    def run_detection(self, image, stream_id=DEFAULT_STREAM_ID, task_prompt=None, decoding=None):
+        tracks = self.client.track(image, stream_id, task_prompt, decoding)
+        return draw_tracked_objects(image, tracks)
+
+    def run_detection_batch(self, images, stream_ids, task_prompt=None, decoding=None):
+        # 同時に送ると、サービス側で1回の推論に束ねられる
+        futures = [
+            self._pool.submit(self.client.track, image, stream_id, task_prompt, decoding)
+            for image, stream_id in zip(images, stream_ids)
+        ]
+        return [draw_tracked_objects(image, future.result()) for image, future in zip(images, futures)]
+
+    def track_frame(self, frame, stream_id=DEFAULT_STREAM_ID, task_prompt=None, decoding=None):
+        return self.track_frames([frame], [stream_id], task_prompt, decoding)[0]
+
+    def track_frames(self, frames, stream_ids, task_prompt=None, decoding=None):
+        """BGRフレームを送って追跡中オブジェクトのリストを受け取る（描画は呼び出し側で行う）"""
+        futures = [
+            self._pool.submit(self.client.track, Image.fromarray(bgr_view(frame)), stream_id, task_prompt, decoding)
+            for frame, stream_id in zip(frames, stream_ids)
+        ]
+        return [future.result() for future in futures]
+
+    def gate_stats(self):
+        return self.client.health().get('gate_stats', {})
+
+    def frame_store_stats(self):
+        return self.client.health().get('frame_store', {})
+
+    def close(self):
+        self._pool.shutdown()
+
+
+def create_detector():
+    """DETECTOR_SERVICE_URL が設定されていればサービスのクライアントを、無ければ VLM_Detector を作る"""
+    if config.DETECTOR_SERVICE_URL:
+        return RemoteDetector(config.DETECTOR_SERVICE_URL)
+    from vision import VLM_Detector
+    return VLM_Detector()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="VLMの推論サービスを起動します")
+    parser.add_argument('--host', default=config.SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=config.SERVICE_PORT)
+    args = parser.parse_args()
+    serve(args.host, args.port)
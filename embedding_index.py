@@ -0,0 +1,290 @@
+# embedding_index.py
+# 見た目の似ている記録を探すための、領域の特徴ベクトル(埋め込み)の置き場と検索
+#
+# VLM_Detector が検出のために実行した画像エンコーダの出力（画像を格子状に分けたトークンの特徴量）から、
+# バウンディングボックスに重なるトークンを平均して物体ごとのベクトルを作ります（追加の推論は不要）。
+# ベクトルは固定の乱数射影で EMBEDDING_DIM 次元に縮め、長さ1に正規化した float16 で
+# memory_log.db の隣のファイルに追記し、検索時はメモリマップして内積で上位k件を求めます。
+# float16 のままの行列積や毎回の float32 への変換は遅いので、検索する側は float32 の写しをメモリに持ち、
+# ファイルが伸びた分だけ変換して足します（30万件×256次元で約300MB、1回の検索は数十ms）。
+#
+#   <EMBEDDING_INDEX_PATH>.f16 : ベクトル（float16, 行数 × EMBEDDING_DIM）
+#   <EMBEDDING_INDEX_PATH>.ids : 各行の detections.id（int64）
+#   <EMBEDDING_INDEX_PATH>.lock: 2つのファイルへの追記をプロセス間でそろえるためのロック
+#                               （ライブの保存スレッドと backfill.py が同時に追記するため）
+#
+#   python embedding_index.py --compact   # 削除済みの記録のベクトルを詰める
+#   python embedding_index.py --bench 300000
+
+import argparse
+import contextlib
+import math
+import os
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+
+import config
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+@lru_cache(maxsize=None)
+def projection_matrix(input_dim, output_dim):
+    """固定の乱数射影行列（保存済みのベクトルと同じ射影になるよう、乱数の種は固定）"""
+    rng = np.random.default_rng(20240601)
+    return (rng.standard_normal((input_dim, output_dim)) / math.sqrt(output_dim)).astype(np.float32)
+
+
+def region_embeddings(image_features, image_size, bboxes, dim=None):
+    """1枚の画像の画像特徴量から、バウンディングボックスごとの埋め込み (len(bboxes), dim) を作る
+
+    image_features : (トークン数, 特徴量の次元) のテンソルか配列。末尾の 辺×辺 個が格子状のトークン
+                     （先頭に全体を平均したトークンが付いていても無視する）
+    image_size     : 特徴量を計算した画像の (幅, 高さ)。プロセッサは縦横比を保たずに正方形へ縮めるので、
+                     bboxは幅・高さそれぞれの比率で格子に対応付ける
+    """
+    dim = dim or config.EMBEDDING_DIM
+    if not len(bboxes):
+        return np.empty((0, dim), dtype=np.float16)
+    if hasattr(image_features, 'detach'):
+        image_features = image_features.detach().float().cpu().numpy()
+    features = np.asarray(image_features, dtype=np.float32)
+    side = math.isqrt(features.shape[0])
+    grid = features[features.shape[0] - side * side:].reshape(side, side, -1)
+    width, height = image_size
+
+    vectors = np.empty((len(bboxes), grid.shape[2]), dtype=np.float32)
+    for i, (x1, y1, x2, y2) in enumerate(bboxes):
+        gx1 = min(side - 1, max(0, int(x1 / width * side)))
+        gy1 = min(side - 1, max(0, int(y1 / height * side)))
+        gx2 = max(gx1 + 1, min(side, math.ceil(x2 / width * side)))
+        gy2 = max(gy1 + 1, min(side, math.ceil(y2 / height * side)))
+        vectors[i] = grid[gy1:gy2, gx1:gx2].mean(axis=(0, 1))
+
+    if dim < vectors.shape[1]:
+        vectors = vectors @ projection_matrix(vectors.shape[1], dim)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    return vectors.astype(np.float16)
+
+
+class EmbeddingIndex:
+    """追記型の埋め込みファイルと、その上の全件内積による上位k件検索
+
+    書き込み（保存スレッド）と検索（app.py）は別のプロセスでもよい。
+    検索側はファイルが伸びていたらメモリマップを開き直す。
+    """
+
+    def __init__(self, path=None, dim=None):
+        path = path or config.EMBEDDING_INDEX_PATH
+        self.dim = dim or config.EMBEDDING_DIM
+        self.vectors_path = path + '.f16'
+        self.ids_path = path + '.ids'
+        self.lock_path = path + '.lock'
+        self._lock = threading.Lock()
+        self._reset()
+
+    @contextlib.contextmanager
+    def _file_lock(self, shared=False):
+        """他のプロセスと共有するロック（追記・置き換えは排他、行数の確認は共有）"""
+        with open(self.lock_path, 'a+b') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def _reset(self):
+        self._loaded_key = None
+        self._vectors = np.empty((0, self.dim), dtype=np.float16)
+        self._ids = np.empty(0, dtype=np.int64)
+        # 検索用の float32 の写し（容量を倍々に広げ、先頭の _matrix_rows 行が有効）
+        self._matrix = np.empty((0, self.dim), dtype=np.float32)
+        self._matrix_rows = 0
+
+    def add(self, ids, vectors):
+        """detections.id と埋め込みを追記する"""
+        if not len(ids):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float16).reshape(len(ids), self.dim)
+        with self._lock, self._file_lock():
+            # 2つのファイルへの追記は、他のプロセスの追記と混ざらないようにロックの中で行う
+            self._align_files()
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.ids_path, 'ab') as f:
+                f.write(np.asarray(ids, dtype=np.int64).tobytes())
+
+    def _align_files(self):
+        """途中で止まった追記の残り（片方のファイルだけにある行・書きかけの行）を切り捨てる（排他ロックの中で呼ぶ）
+
+        ベクトルを先に書くので、残るのはそろっている行より後ろだけ。そのまま追記すると行がずれる。
+        """
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in (self.vectors_path, self.ids_path)]
+        rows = min(sizes[0] // (2 * self.dim), sizes[1] // 8)
+        for path, size, expected in zip((self.vectors_path, self.ids_path), sizes, (rows * 2 * self.dim, rows * 8)):
+            if size != expected:
+                print(f"警告: {path} の途中で止まった追記の残り（{size - expected} バイト）を切り捨てました。")
+                os.truncate(path, expected)
+
+    def _load(self):
+        """ファイルが伸びていればメモリマップを開き直し、(ベクトル, ID) を返す"""
+        with self._lock, self._file_lock(shared=True):
+            try:
+                vectors_stat, ids_stat = os.stat(self.vectors_path), os.stat(self.ids_path)
+            except FileNotFoundError:
+                self._reset()
+                return self._vectors, self._ids
+            key = (vectors_stat.st_ino, vectors_stat.st_size, ids_stat.st_ino, ids_stat.st_size)
+            if key != self._loaded_key:
+                # 追記はロックの中で両方に書くので、そろっている行までは正しい。
+                # 途中で止まった追記の残りは読まない（次の add() で切り捨てる）
+                rows = min(key[1] // (2 * self.dim), key[3] // 8)
+                # compact() でファイルが置き換わった場合は、float32 の写しも作り直す
+                if self._loaded_key is not None and (key[0] != self._loaded_key[0] or rows < len(self._ids)):
+                    self._reset()
+                if rows:
+                    self._vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r', shape=(rows, self.dim))
+                    self._ids = np.memmap(self.ids_path, dtype=np.int64, mode='r', shape=(rows,))
+                self._loaded_key = key
+            return self._vectors, self._ids
+
+    def _search_matrix(self, vectors):
+        """検索用の float32 の写しを、増えた行だけ変換して返す"""
+        with self._lock:
+            rows = len(vectors)
+            if rows > len(self._matrix):
+                grown = np.empty((max(rows, 2 * len(self._matrix)), self.dim), dtype=np.float32)
+                grown[:self._matrix_rows] = self._matrix[:self._matrix_rows]
+                self._matrix = grown
+            if rows > self._matrix_rows:
+                self._matrix[self._matrix_rows:rows] = vectors[self._matrix_rows:rows]
+                self._matrix_rows = rows
+            return self._matrix[:rows]
+
+    def __len__(self):
+        return len(self._load()[1])
+
+    def vector_for(self, detection_id):
+        """記録の埋め込みを返す。無ければNone"""
+        vectors, ids = self._load()
+        rows = np.nonzero(ids == detection_id)[0]
+        if not len(rows):
+            return None
+        return np.asarray(vectors[rows[-1]])
+
+    def search(self, query, k=None, exclude_ids=()):
+        """query に内積（コサイン類似度）の大きい順に k 件の (detections.id, 類似度) を返す"""
+        k = k or config.SIMILAR_TOP_K
+        vectors, ids = self._load()
+        if not len(ids):
+            return []
+        query = np.asarray(query, dtype=np.float32).reshape(self.dim)
+        scores = self._search_matrix(vectors) @ query
+        if exclude_ids:
+            scores[np.isin(ids, list(exclude_ids))] = -np.inf
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+    def compact(self, valid_ids):
+        """valid_ids（まだDBに残っている記録）以外の行を捨ててファイルを詰める。捨てた行数を返す"""
+        valid_ids = np.fromiter(valid_ids, dtype=np.int64)
+        newest = valid_ids.max() if len(valid_ids) else -1
+        # valid_ids を読んだ後に追記された記録（IDはそれより大きい）は残す
+        return self._rewrite(lambda ids: np.isin(ids, valid_ids) | (ids > newest))
+
+    def discard(self, removed_ids):
+        """削除した記録の行を捨ててファイルを詰める。捨てた行数を返す"""
+        removed_ids = np.fromiter(removed_ids, dtype=np.int64)
+        if not len(removed_ids):
+            return 0
+        return self._rewrite(lambda ids: ~np.isin(ids, removed_ids))
+
+    def _rewrite(self, keep_rows):
+        """keep_rows(ids) がTrueの行だけを残してファイルを置き換える
+
+        読んでから置き換えるまでの間に他のプロセスが追記した行を失わないよう、全て排他ロックの中で行う。
+        """
+        with self._lock, self._file_lock():
+            self._align_files()
+            rows = os.path.getsize(self.ids_path) // 8 if os.path.exists(self.ids_path) else 0
+            if not rows:
+                return 0
+            ids = np.fromfile(self.ids_path, dtype=np.int64)
+            keep = keep_rows(ids)
+            removed = int((~keep).sum())
+            if not removed:
+                return 0
+            vectors = np.memmap(self.vectors_path, dtype=np.float16, mode='r', shape=(rows, self.dim))
+            for path, data in ((self.vectors_path, vectors[keep]), (self.ids_path, ids[keep])):
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data.tobytes())
+            del vectors
+            self._reset()
+            os.replace(self.vectors_path + '.tmp', self.vectors_path)
+            os.replace(self.ids_path + '.tmp', self.ids_path)
+        return removed
+
+    def clear(self):
+        """全ての埋め込みを消す"""
+        with self._lock, self._file_lock():
+            self._reset()
+            for path in (self.vectors_path, self.ids_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def stats(self):
+        vectors, ids = self._load()
+        return {'rows': len(ids), 'dim': self.dim, 'bytes': vectors.nbytes + ids.nbytes,
+                'search_bytes': self._matrix.nbytes}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="見た目の類似検索用の埋め込みファイルを管理します")
+    parser.add_argument('--compact', action='store_true', help="DBから削除済みの記録の埋め込みを詰める")
+    parser.add_argument('--bench', type=int, default=0, help="指定した件数の乱数ベクトルで検索速度を計測する")
+    args = parser.parse_args()
+
+    if args.compact:
+        import database
+        conn = database.connect()
+        valid = [row[0] for row in conn.execute("SELECT id FROM detections")]
+        conn.close()
+        index = EmbeddingIndex()
+        print(f"{index.compact(valid)} 行を削除しました。{index.stats()}")
+
+    if args.bench:
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            index = EmbeddingIndex(os.path.join(tmp, 'bench'))
+            rng = np.random.default_rng(0)
+            for start in range(0, args.bench, 100000):
+                count = min(100000, args.bench - start)
+                vectors = rng.standard_normal((count, index.dim)).astype(np.float32)
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                index.add(np.arange(start, start + count), vectors)
+            query = index.vector_for(0)
+            index.search(query)  # 初回は float32 の写しを作る
+            timings = []
+            for _ in range(10):
+                start_time = time.perf_counter()
+                index.search(query)
+                timings.append(time.perf_counter() - start_time)
+            print(f"{args.bench} 件: 検索 {sorted(timings)[len(timings) // 2] * 1000:.1f} ms (中央値)")
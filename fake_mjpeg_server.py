@@ -0,0 +1,169 @@
+# fake_mjpeg_server.py
+# スマートフォンのIPカメラアプリの代わりに、手元でMJPEGを配信する偽のカメラ（camera_source.py の確認用）
+#
+# 動く四角形とフレーム番号を描いたJPEGを multipart/x-mixed-replace で流します（OpenCVは使いません）。
+# Wi-Fiの瞬断や、つながったまま映像が止まる状態を真似できます。
+#
+#   python fake_mjpeg_server.py                                   # http://127.0.0.1:8080/video
+#   python fake_mjpeg_server.py --drop-every 10 --down-sec 3      # 10秒ごとに切断し、3秒間は接続を断る
+#   python fake_mjpeg_server.py --stall-every 15                  # 15秒ごとに、つながったまま送るのを止める
+#   python fake_mjpeg_server.py --no-length                       # Content-Length を付けない
+#
+# vision_runner.py で使うには config.VIDEO_STREAM_URL を 'http://127.0.0.1:8080/video' にします。
+
+import argparse
+import io
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageDraw
+
+from image_cache import load_font
+
+BOUNDARY = 'fakemjpegboundary'
+
+
+def render_frames(width, height, count, quality):
+    """1周分のフレームを前もってJPEGにしておく（配信中はエンコードしない）"""
+    font = load_font(max(16, height // 20))
+    frames = []
+    size = max(16, min(width, height) // 5)
+    for i in range(count):
+        image = Image.new('RGB', (width, height), (40, 40, 40))
+        draw = ImageDraw.Draw(image)
+        x = int((width - size) * i / max(1, count - 1))
+        y = (height - size) // 2
+        draw.rectangle([x, y, x + size, y + size], fill=(220, 60, 60))
+        draw.text((10, 10), f"frame {i:04d}  {width}x{height}", fill=(255, 255, 255), font=font)
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality)
+        frames.append(buffer.getvalue())
+    return frames
+
+
+class FakeCamera:
+    """配信の状態（切断・停止の予定と、接続を断っている期間）"""
+
+    def __init__(self, frames, fps, drop_every=None, stall_every=None, down_sec=0.0, with_length=True):
+        self.frames = frames
+        self.fps = fps
+        self.drop_every = drop_every
+        self.stall_every = stall_every
+        self.down_sec = down_sec
+        self.with_length = with_length
+        self._lock = threading.Lock()
+        self.down_until = 0.0
+        self.connections = 0
+
+    def is_down(self):
+        with self._lock:
+            return time.time() < self.down_until
+
+    def connected(self):
+        """接続を1つ数え、その通し番号を返す"""
+        with self._lock:
+            self.connections += 1
+            return self.connections
+
+    def went_down(self):
+        with self._lock:
+            self.down_until = time.time() + self.down_sec
+
+
+class MJPEGHandler(BaseHTTPRequestHandler):
+    camera = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        camera = self.camera
+        if self.path.split('?')[0] == '/shot.jpg':
+            self._send_shot(camera.frames[0])
+            return
+        if self.path.split('?')[0] != '/video':
+            self.send_error(404)
+            return
+        if camera.is_down():
+            # 瞬断中は接続をすぐに切る
+            self.close_connection = True
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        number = camera.connected()
+        print(f"接続 {number}: {self.client_address[0]}")
+
+        started = time.time()
+        interval = 1.0 / camera.fps
+        i = 0
+        try:
+            while True:
+                elapsed = time.time() - started
+                if camera.drop_every and elapsed >= camera.drop_every:
+                    print(f"接続 {number}: 切断します")
+                    camera.went_down()
+                    break
+                if camera.stall_every and elapsed >= camera.stall_every:
+                    # つながったまま何も送らない（受け手はタイムアウトでつなぎ直すはず）
+                    print(f"接続 {number}: 送るのを止めます")
+                    time.sleep(60)
+                    break
+                jpeg = camera.frames[i % len(camera.frames)]
+                headers = f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n'
+                if camera.with_length:
+                    headers += f'Content-Length: {len(jpeg)}\r\n'
+                self.wfile.write(headers.encode('ascii') + b'\r\n' + jpeg + b'\r\n')
+                self.wfile.flush()
+                i += 1
+                time.sleep(max(0.0, started + i * interval - time.time()))
+        except (BrokenPipeError, ConnectionResetError):
+            print(f"接続 {number}: 受け手が切断しました")
+
+    def _send_shot(self, jpeg):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(jpeg)))
+        self.end_headers()
+        self.wfile.write(jpeg)
+
+
+def serve(host, port, camera):
+    handler = type('Handler', (MJPEGHandler,), {'camera': camera})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="手元でMJPEGを配信する偽のIPカメラ")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--size', default='1920x1080', help="フレームの大きさ（幅x高さ）")
+    parser.add_argument('--fps', type=float, default=15.0)
+    parser.add_argument('--quality', type=int, default=80, help="JPEGの品質")
+    parser.add_argument('--loop-frames', type=int, default=60, help="前もって作っておく1周分のフレーム数")
+    parser.add_argument('--drop-every', type=float, default=None, help="接続してからこの秒数で切断する（Wi-Fiの瞬断）")
+    parser.add_argument('--down-sec', type=float, default=0.0, help="切断したあと、この秒数は接続を断る")
+    parser.add_argument('--stall-every', type=float, default=None, help="接続してからこの秒数で、つながったまま送るのを止める")
+    parser.add_argument('--no-length', action='store_true', help="パートに Content-Length を付けない")
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    print(f"{args.loop_frames} 枚のフレームを作っています（{width}x{height}）...")
+    camera = FakeCamera(
+        render_frames(width, height, args.loop_frames, args.quality), args.fps,
+        drop_every=args.drop_every, stall_every=args.stall_every,
+        down_sec=args.down_sec, with_length=not args.no_length,
+    )
+    server = serve(args.host, args.port, camera)
+    print(f">>> http://{args.host}:{args.port}/video で配信しています。Ctrl+Cで終了します。 <<<")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
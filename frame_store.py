@@ -0,0 +1,100 @@
+# frame_store.py
+# 追跡中オブジェクトが「最後に見えたフレーム」を共有して持つための置き場
+#
+# 追跡ごとにフレームのコピーを持つ代わりに、フレームはここに1回だけ保存し、
+# 追跡側はフレームIDだけを持ちます。フレームは参照カウントで管理し、
+# 直近 FRAME_STORE_CAPACITY 枚より古く、どの追跡からも参照されていないものは捨てます。
+
+import io
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+import config
+
+
+class FrameStore:
+    """参照カウント付きのフレームのリングバッファ
+
+    mode='raw'  : PIL画像のまま保持する（取り出しが速い）
+    mode='jpeg' : JPEGに圧縮したバイト列で保持する（メモリが少ない）
+    """
+
+    def __init__(self, capacity=None, mode=None, jpeg_quality=None):
+        self.capacity = config.FRAME_STORE_CAPACITY if capacity is None else capacity
+        self.mode = mode or config.FRAME_STORE_MODE
+        self.jpeg_quality = config.FRAME_STORE_JPEG_QUALITY if jpeg_quality is None else jpeg_quality
+        if self.mode not in ('raw', 'jpeg'):
+            raise ValueError(f"不明なフレーム保存方式です: {self.mode}")
+        self._lock = threading.Lock()
+        self._frames = OrderedDict()  # frame_id -> [データ, 参照数, バイト数]
+        self._next_id = 0
+        self.total_bytes = 0
+        self.peak_bytes = 0
+
+    def put(self, image):
+        """フレーム（PIL画像 または RGBのNumPy配列）を保存してフレームIDを返す（この時点では参照数0）"""
+        if self.mode == 'jpeg':
+            if isinstance(image, np.ndarray):
+                image = Image.fromarray(image)
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=self.jpeg_quality)
+            data = buffer.getvalue()
+            size = len(data)
+        elif isinstance(image, np.ndarray):
+            data = image
+            size = image.nbytes
+        else:
+            data = image
+            size = image.width * image.height * len(image.getbands())
+
+        with self._lock:
+            frame_id = self._next_id
+            self._next_id += 1
+            self._frames[frame_id] = [data, 0, size]
+            self.total_bytes += size
+            self.peak_bytes = max(self.peak_bytes, self.total_bytes)
+            self._evict()
+        return frame_id
+
+    def acquire(self, frame_id):
+        """追跡がフレームを参照し始める"""
+        with self._lock:
+            self._frames[frame_id][1] += 1
+
+    def release(self, frame_id):
+        """追跡がフレームの参照をやめる"""
+        with self._lock:
+            entry = self._frames.get(frame_id)
+            if entry is None:
+                return
+            entry[1] -= 1
+            self._evict()
+
+    def get(self, frame_id):
+        """フレームを取り出す（jpeg はPIL画像、raw は保存した時のまま）"""
+        with self._lock:
+            data = self._frames[frame_id][0]
+        if self.mode == 'jpeg':
+            return Image.open(io.BytesIO(data))
+        return data
+
+    def _evict(self):
+        """直近 capacity 枚より古く、参照されていないフレームを捨てる"""
+        oldest_recent = self._next_id - self.capacity
+        for frame_id in [fid for fid, entry in self._frames.items() if fid < oldest_recent and entry[1] <= 0]:
+            self.total_bytes -= self._frames.pop(frame_id)[2]
+
+    def stats(self):
+        """保持しているフレーム数とメモリ使用量"""
+        with self._lock:
+            referenced = sum(1 for entry in self._frames.values() if entry[1] > 0)
+            return {
+                'mode': self.mode,
+                'frames': len(self._frames),
+                'referenced_frames': referenced,
+                'bytes': self.total_bytes,
+                'peak_bytes': self.peak_bytes,
+            }
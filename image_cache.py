@@ -0,0 +1,155 @@
+# image_cache.py
+# 検索画面で表示する縮小画像と、BBOXを描き込んだ画像をディスクにキャッシュする
+#
+# 元画像（history/ のフル解像度JPEG）を毎回開いて描画する代わりに、
+# 一度作った表示用の画像を IMAGE_CACHE_DIR に保存して使い回します。
+# 合計サイズが IMAGE_CACHE_MAX_BYTES を超えたら、最も長く使われていないものから消します（LRU）。
+
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+import config
+
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    """フォントを読み込む（同じ大きさは1回だけ読み込む）。見つからなければ標準フォント"""
+    try:
+        return ImageFont.truetype(config.FONT_PATH, size)
+    except IOError:
+        return ImageFont.load_default()
+
+
+def draw_bbox(image, bbox, label, scale=1.0):
+    """画像にBBOXとラベルを描く（scaleは元画像に対する縮小率）"""
+    draw = ImageDraw.Draw(image)
+    box = [v * scale for v in bbox]
+    draw.rectangle(box, outline='lime', width=max(2, round(5 * scale)))
+    font_size = max(12, round(32 * scale))
+    draw.text((box[0], box[1] - font_size - 8), label, fill='lime', font=load_font(font_size))
+    return image
+
+
+class ImageCache:
+    """表示用画像のLRUディスクキャッシュ
+
+    キーは元画像のパス・更新時刻・サイズと描画内容から作るので、
+    元画像が差し替えられた場合は自動的に作り直される。
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None, max_side=None, jpeg_quality=None):
+        self.cache_dir = cache_dir or config.IMAGE_CACHE_DIR
+        self.max_bytes = config.IMAGE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_side = max_side or config.IMAGE_CACHE_MAX_SIDE
+        self.jpeg_quality = jpeg_quality or config.IMAGE_CACHE_JPEG_QUALITY
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # ファイル名 -> バイト数（古く使われたものが先頭）
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._load_existing()
+
+    def _load_existing(self):
+        """前回までに作ったキャッシュを、最後に使われた順に読み込む"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.jpg'):
+                continue
+            st = os.stat(os.path.join(self.cache_dir, name))
+            files.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.total_bytes += size
+        with self._lock:
+            self._evict()
+
+    def thumbnail(self, image_path):
+        """縮小画像のパスを返す（無ければ作る）"""
+        return self._get(image_path, 'thumb')
+
+    def annotated(self, image_path, bbox, label):
+        """BBOXとラベルを描いた縮小画像のパスを返す（無ければ作る）"""
+        return self._get(image_path, 'bbox', tuple(float(v) for v in bbox), label)
+
+    def _key(self, image_path, kind, bbox=None, label=None):
+        st = os.stat(image_path)
+        source = (os.path.abspath(image_path), st.st_mtime_ns, st.st_size, kind, self.max_side, bbox, label)
+        return hashlib.sha1(repr(source).encode('utf-8')).hexdigest() + f'_{kind}.jpg'
+
+    def _get(self, image_path, kind, bbox=None, label=None):
+        name = self._key(image_path, kind, bbox, label)
+        path = os.path.join(self.cache_dir, name)
+        with self._lock:
+            if os.path.exists(path):
+                if name not in self._entries:
+                    # 別のプロセス（保存スレッドなど）が作ったもの
+                    size = os.path.getsize(path)
+                    self._entries[name] = size
+                    self.total_bytes += size
+                self._entries.move_to_end(name)
+                self.hits += 1
+                # 次回起動時もLRUの順番が分かるように更新時刻を進める
+                os.utime(path)
+                return path
+            self._entries.pop(name, None)
+            self.misses += 1
+
+        image = self._render(image_path, bbox, label)
+        # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        image.save(tmp_path, 'JPEG', quality=self.jpeg_quality)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+
+        with self._lock:
+            if name not in self._entries:
+                self.total_bytes += size
+            self._entries[name] = size
+            self._evict(keep=name)
+        return path
+
+    def _render(self, image_path, bbox=None, label=None):
+        with Image.open(image_path) as source:
+            image = source.convert('RGB')
+        scale = min(1.0, self.max_side / max(image.size))
+        if scale < 1.0:
+            image = image.resize((round(image.width * scale), round(image.height * scale)), Image.BILINEAR)
+        if bbox is not None:
+            draw_bbox(image, bbox, label, scale)
+        return image
+
+    def _evict(self, keep=None):
+        """合計サイズが上限を超えている間、最も長く使われていないものを消す"""
+        while self.total_bytes > self.max_bytes and self._entries:
+            name = next(iter(self._entries))
+            if name == keep:
+                break
+            self.total_bytes -= self._entries.pop(name)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def clear(self):
+        """キャッシュを全て消す"""
+        with self._lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'files': len(self._entries),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
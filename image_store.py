@@ -0,0 +1,104 @@
+# image_store.py
+# 消失したオブジェクトの画像を、内容のハッシュをファイル名にして history/ に保存する
+#
+# 同じフレームから複数のオブジェクトが消えても、フレームの画像は1回しか書き込まず、
+# DBの複数の行が同じファイルを指します。
+# IMAGE_STORE_MODE = 'crop' の場合は、フレーム全体の代わりに
+# 「余白付きの切り出し画像」と「縮小した周囲の様子(コンテキスト)」だけを保存します。
+
+import hashlib
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+import config
+
+
+def crop_box(bbox, image_size, padding_ratio):
+    """バウンディングボックスの周囲に余白を付けた切り出し範囲(整数)を返す"""
+    width, height = image_size
+    x1, y1, x2, y2 = bbox
+    pad_x = (x2 - x1) * padding_ratio
+    pad_y = (y2 - y1) * padding_ratio
+    left = max(0, int(x1 - pad_x))
+    top = max(0, int(y1 - pad_y))
+    right = min(width, int(round(x2 + pad_x)))
+    bottom = min(height, int(round(y2 + pad_y)))
+    return (left, top, max(right, left + 1), max(bottom, top + 1))
+
+
+def image_hash(image):
+    """画素の内容から画像のハッシュ（16進文字列）を作る"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{image.mode}:{image.width}x{image.height}:'.encode('ascii'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class ImageStore:
+    """内容アドレス方式の画像置き場
+
+    mode='frame' : フレーム全体を保存する（同じフレームは1回だけ）
+    mode='crop'  : 余白付きの切り出し画像と、縮小したコンテキストのフレームを保存する
+    """
+
+    def __init__(self, root=None, mode=None, jpeg_quality=None, context_max_side=None, crop_padding=None):
+        self.root = root or config.HISTORY_DIR
+        self.mode = mode or config.IMAGE_STORE_MODE
+        self.jpeg_quality = jpeg_quality or config.IMAGE_STORE_JPEG_QUALITY
+        self.context_max_side = context_max_side or config.IMAGE_STORE_CONTEXT_MAX_SIDE
+        self.crop_padding = config.IMAGE_STORE_CROP_PADDING if crop_padding is None else crop_padding
+        if self.mode not in ('frame', 'crop'):
+            raise ValueError(f"不明な画像保存方式です: {self.mode}")
+        self._lock = threading.Lock()
+        self.written = 0
+        self.deduplicated = 0
+        self.bytes_written = 0
+
+    def save(self, image, bbox):
+        """画像を保存し、DBに記録する (image_path, crop_path, image_scale) を返す"""
+        if isinstance(image, np.ndarray):
+            # ライブの経路ではフレームをRGBの配列のまま持っている（vision.VLM_Detector.track_frames）
+            image = Image.fromarray(image)
+        if self.mode == 'frame':
+            return self._put(image, 'frames'), None, 1.0
+
+        crop = image.crop(crop_box(bbox, image.size, self.crop_padding))
+        crop_path = self._put(crop, 'crops')
+        scale = min(1.0, self.context_max_side / max(image.size))
+        context = image
+        if scale < 1.0:
+            context = image.resize((round(image.width * scale), round(image.height * scale)))
+        return self._put(context, 'context'), crop_path, scale
+
+    def _put(self, image, kind):
+        """画像を内容のハッシュで保存する。既に同じ画像があれば書き込まない"""
+        name = image_hash(image)
+        directory = os.path.join(self.root, kind, name[:2])
+        path = os.path.join(directory, name + '.jpg')
+        if os.path.exists(path):
+            with self._lock:
+                self.deduplicated += 1
+            return path
+
+        os.makedirs(directory, exist_ok=True)
+        # 書きかけのファイルを読まれないよう、一時ファイルに書いてから置き換える
+        # （backfill.py では複数のプロセスが同じ置き場に書くので、プロセスIDも付ける）
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        image.convert('RGB').save(tmp_path, 'JPEG', quality=self.jpeg_quality)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.written += 1
+            self.bytes_written += os.path.getsize(path)
+        return path
+
+    def stats(self):
+        with self._lock:
+            return {
+                'mode': self.mode,
+                'written': self.written,
+                'deduplicated': self.deduplicated,
+                'bytes_written': self.bytes_written,
+            }
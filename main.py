@@ -1,69 +1,74 @@
 # main.py
 
 import cv2
-import numpy as np
-from PIL import Image
-import time
 
 import config
 import database
-from vision import VLM_Detector
+import metrics
+from camera_source import open_source
+from detector_service import create_detector
+from overlay import draw_overlay
+from scheduler import AdaptiveScheduler
 
 def main():
     """プログラムのメイン処理（Webカメラ版）"""
     # 1. 初期化
     database.init_db()
-    detector = VLM_Detector()
-    
-    # Webカメラを開く
-    cap = cv2.VideoCapture(config.WEBCAM_DEVICE_ID)
-    if not cap.isOpened():
-        print(f"エラー: カメラデバイスID {config.WEBCAM_DEVICE_ID} を開けませんでした。")
-        return
+    # DETECTOR_SERVICE_URL が設定されていれば、推論サービスのクライアントになる
+    detector = create_detector()
+    cap = None
+    try:
+        # カメラを開く前に推論を空回ししておく
+        detector.warm_up()
 
-    print("\nWebカメラのフィードを開始します。ウィンドウを選択して 'q' キーを押すと終了します。")
-    
-    # FPS制御用の設定
-    last_processed_time = 0
-    frame_interval = 1.0 / config.PROCESSING_FPS
+        # Webカメラを開く（抜けてもつなぎ直す）
+        cap = open_source(config.WEBCAM_DEVICE_ID, name='webcam')
+        if not cap.isOpened():
+            print(f"エラー: カメラデバイスID {config.WEBCAM_DEVICE_ID} を開けませんでした。")
+            return
 
-    # 2. メインループ
-    while True:
-        # カメラからフレームを読み込む
-        ret, frame = cap.read()
-        if not ret:
-            print("エラー: フレームを読み込めませんでした。")
-            break
+        print("\nWebカメラのフィードを開始します。ウィンドウを選択して 'q' キーを押すと終了します。")
 
-        display_frame = frame  # 表示用のフレームを準備
+        # 解析の頻度は物体の出入り・推論の時間・CPUの使用量に合わせて自動で決める
+        scheduler = AdaptiveScheduler()
+        # 最後の推論結果（推論しないフレームにも同じ枠を描く）
+        tracked_objects = []
 
-        current_time = time.time()
-        # 指定した間隔が経過した場合のみ推論を実行
-        if (current_time - last_processed_time) >= frame_interval:
-            last_processed_time = current_time
-            
-            print("-" * 20)
-            # OpenCV(BGR)からPillow(RGB)へ画像を変換
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(frame_rgb)
-            
-            # 物体検出を実行
-            processed_image_pil = detector.run_detection(pil_image)
-            
-            # 表示用にPillow(RGB)からOpenCV(BGR)へ画像を変換
-            display_frame = cv2.cvtColor(np.array(processed_image_pil), cv2.COLOR_RGB2BGR)
+        # 2. メインループ
+        while True:
+            # カメラからフレームを読み込む
+            with metrics.span('capture_read'):
+                ret, frame = cap.read()
+            if not ret:
+                print("エラー: フレームを読み込めませんでした。")
+                break
+            metrics.mark('frames_captured')
 
-        # 画面に映像を表示
-        cv2.imshow('VLM Live Feed', display_frame)
+            # 解析する時刻になった場合のみ推論を実行
+            if scheduler.ready():
+                print("-" * 20)
+                # 物体検出を実行（BGRのフレームをそのまま渡し、追跡中オブジェクトのリストを受け取る）
+                tracked_objects = scheduler.run(detector.track_frame, frame)
 
-        # 'q'キーが押されたらループを抜ける
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-            
-    # 3. 後処理
+            # 画面に映像を表示（カメラのフレームに直接描く）
+            with metrics.span('draw'):
+                draw_overlay(frame, tracked_objects)
+            cv2.imshow('VLM Live Feed', frame)
+
+            # 'q'キーが押されたらループを抜ける
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    finally:
+        # 3. 後処理（途中で例外が出ても、書き込み待ちの記録を保存してから終わる）
+        detector.close()
+        if cap is not None:
+            cap.release()
+        cv2.destroyAllWindows()
+
+    print(f"シーン変化ゲート統計: {detector.gate_stats()}")
+    print(f"フレーム置き場: {detector.frame_store_stats()}")
+    print(f"解析頻度: {scheduler.stats()}")
     print("アプリケーションを終了します。")
-    cap.release()
-    cv2.destroyAllWindows()
 
     # 終了時に「グラス」を検索するデモ
     database.search_for_object('glasses')
@@ -0,0 +1,278 @@
+# metrics.py
+# ライブ処理の段ごとの所要時間・FPS・捨てたフレーム数を集計する軽量な計測レイヤー
+#
+#   with metrics.span('generate'):      # 区間の所要時間（直近 METRICS_WINDOW 回の分布）
+#       ...
+#   metrics.mark('frames_analyzed')     # 回数と、直近の1秒あたりの回数（FPS）
+#   metrics.inc('frames_dropped', 3)    # 回数だけ
+#
+# 集計結果は http://METRICS_HOST:METRICS_PORT/metrics で Prometheus のテキスト形式で取得でき、
+# METRICS_LOG_INTERVAL_SEC 秒ごとに1行のログにも出せます。
+# METRICS_ENABLED = False の場合、span() は何もしない共有のオブジェクトを返すだけで、
+# 集計もスレッドも動きません。
+
+import contextlib
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+
+# このモジュールが最初にimportされた時刻（起動時刻の目安。起動から最初の検出までの時間に使う）
+PROCESS_STARTED_AT = time.time()
+
+PREFIX = 'pbl_vlm'
+QUANTILES = (0.5, 0.9, 0.99)
+# 何もしない区間（無効時に毎回作らずに使い回す）
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class Histogram:
+    """直近 window 回の値と、累計の回数・合計を持つ"""
+
+    def __init__(self, window):
+        self.values = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.values.append(value)
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q):
+        if not self.values:
+            return 0.0
+        ordered = sorted(self.values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Meter:
+    """累計の回数と、直近 period 秒の1秒あたりの回数"""
+
+    def __init__(self, period):
+        self.period = period
+        self.count = 0
+        self.times = deque()
+
+    def mark(self, value, now):
+        self.count += value
+        self.times.append((now, value))
+        while self.times and self.times[0][0] < now - self.period:
+            self.times.popleft()
+
+    def rate(self, now):
+        recent = sum(value for t, value in self.times if t >= now - self.period)
+        return recent / self.period
+
+
+class Registry:
+    """全ての計測値の置き場（スレッド間で共有）"""
+
+    def __init__(self, window=None, rate_period=None):
+        self.window = window or config.METRICS_WINDOW
+        self.rate_period = rate_period or config.METRICS_RATE_PERIOD_SEC
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.meters = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.window)
+            histogram.observe(seconds)
+
+    def mark(self, name, value=1):
+        now = time.time()
+        with self._lock:
+            meter = self.meters.get(name)
+            if meter is None:
+                meter = self.meters[name] = Meter(self.rate_period)
+            meter.mark(value, now)
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    @contextlib.contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        """現在の集計値を辞書で返す"""
+        now = time.time()
+        with self._lock:
+            return {
+                'stages': {
+                    name: {
+                        'count': h.count,
+                        'mean': h.total / h.count if h.count else 0.0,
+                        **{f'p{int(q * 100)}': h.quantile(q) for q in QUANTILES},
+                    }
+                    for name, h in self.histograms.items()
+                },
+                'rates': {name: meter.rate(now) for name, meter in self.meters.items()},
+                'totals': {
+                    **{name: meter.count for name, meter in self.meters.items()},
+                    **self.counters,
+                },
+                'gauges': dict(self.gauges),
+            }
+
+    def to_prometheus(self):
+        """Prometheus のテキスト形式（version 0.0.4）にする"""
+        now = time.time()
+        lines = []
+        with self._lock:
+            if self.histograms:
+                lines.append(f'# HELP {PREFIX}_stage_seconds 処理段ごとの所要時間（分位数は直近{self.window}回）')
+                lines.append(f'# TYPE {PREFIX}_stage_seconds summary')
+                for name, h in sorted(self.histograms.items()):
+                    for q in QUANTILES:
+                        lines.append(f'{PREFIX}_stage_seconds{{stage="{name}",quantile="{q}"}} {h.quantile(q):.6f}')
+                    lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{name}"}} {h.total:.6f}')
+                    lines.append(f'{PREFIX}_stage_seconds_count{{stage="{name}"}} {h.count}')
+            for name, meter in sorted(self.meters.items()):
+                lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+                lines.append(f'{PREFIX}_{name}_total {meter.count}')
+                lines.append(f'# TYPE {PREFIX}_{name}_per_second gauge')
+                lines.append(f'{PREFIX}_{name}_per_second {meter.rate(now):.3f}')
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+                lines.append(f'{PREFIX}_{name}_total {value}')
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f'# TYPE {PREFIX}_{name} gauge')
+                lines.append(f'{PREFIX}_{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def log_line(self):
+        """定期ログ用の1行の要約"""
+        snapshot = self.snapshot()
+        # totals はロックの中で写したもの。メーターの分（rates に出す）を除いたものがカウンタ
+        counters = {name: value for name, value in snapshot['totals'].items() if name not in snapshot['rates']}
+        parts = [f"{name}={rate:.2f}/s" for name, rate in sorted(snapshot['rates'].items())]
+        parts += [f"{name}={value}" for name, value in sorted(counters.items())]
+        parts += [f"{name}:p50={s['p50'] * 1000:.0f}ms/p90={s['p90'] * 1000:.0f}ms"
+                  for name, s in sorted(snapshot['stages'].items())]
+        return ' '.join(parts)
+
+
+registry = Registry() if config.METRICS_ENABLED else None
+
+
+def enabled():
+    return registry is not None
+
+
+def span(name):
+    """区間の所要時間を計測する with 文用のオブジェクト"""
+    if registry is None:
+        return _NULL_SPAN
+    return registry.span(name)
+
+
+def observe(name, seconds):
+    if registry is not None:
+        registry.observe(name, seconds)
+
+
+def mark(name, value=1):
+    if registry is not None:
+        registry.mark(name, value)
+
+
+def inc(name, value=1):
+    if registry is not None:
+        registry.inc(name, value)
+
+
+def set_gauge(name, value):
+    if registry is not None:
+        registry.set_gauge(name, value)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.to_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # アクセスごとのログは出さない
+        pass
+
+
+class _LogThread(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name='metrics-log', daemon=True)
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            print(f"  [Metrics] {registry.log_line()}")
+
+
+_server = None
+_log_thread = None
+# 同じプロセスの複数の場所（ランナー・画面・推論サービス）から呼ばれても1つずつしか立てない
+_start_lock = threading.Lock()
+
+
+def start(host=None, port=None, log_interval=None):
+    """HTTPの取得口と定期ログを開始する（無効な場合・開始済みの場合は何もしない）"""
+    if registry is None:
+        return
+    with _start_lock:
+        _start(host, port, log_interval)
+
+
+def _start(host, port, log_interval):
+    global _server, _log_thread
+    host = host or config.METRICS_HOST
+    port = config.METRICS_PORT if port is None else port
+    log_interval = config.METRICS_LOG_INTERVAL_SEC if log_interval is None else log_interval
+    if port and _server is None:
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            print(f"計測値の取得口を開けませんでした ({host}:{port}): {e}")
+        else:
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+            print(f"計測値を http://{host}:{port}/metrics で公開しています。")
+    # 取得口を開けなかった場合（_server がNone）も、定期ログは2つ目を立てない
+    if log_interval and (_log_thread is None or not _log_thread.is_alive()):
+        _log_thread = _LogThread(log_interval)
+        _log_thread.start()
+
+
+def stop():
+    """HTTPの取得口と定期ログを止める"""
+    global _server, _log_thread
+    with _start_lock:
+        if _log_thread is not None:
+            _log_thread.stop_event.set()
+            _log_thread = None
+        if _server is not None:
+            _server.shutdown()
+            _server.server_close()
+            _server = None
@@ -0,0 +1,109 @@
+# multi_runner.py
+# 複数カメラの映像を1つのVLM_Detectorでまとめて解析する
+
+import queue
+import threading
+
+import cv2
+
+import config
+import database
+import metrics
+from camera_source import open_source
+from detector_service import create_detector
+from overlay import draw_overlay
+from scheduler import AdaptiveScheduler
+from pipeline import CaptureThread, PipelineStats
+
+
+def open_sources(sources):
+    """config.VIDEO_SOURCES の各カメラを開く。開けなかったものは飛ばす（開けたものは切れてもつなぎ直す）"""
+    caps = {}
+    for stream_id, source in sources.items():
+        print(f"[{stream_id}] カメラへの接続を試みます: {source}")
+        cap = open_source(source, name=stream_id)
+        if cap.isOpened():
+            caps[stream_id] = cap
+        else:
+            print(f"[{stream_id}] エラー: カメラに接続できませんでした。")
+    return caps
+
+
+def run_multi_vision_process(sources=None):
+    """複数カメラの最新フレームを1回のgenerateに束ねて解析し続ける"""
+    sources = sources or config.VIDEO_SOURCES
+    database.init_db()
+    # カメラを開く前にモデルを読み込み、推論を空回ししておく（古いフレームを溜めないため）
+    # DETECTOR_SERVICE_URL が設定されていれば、推論サービスのクライアントになる
+    detector = create_detector()
+    detector.warm_up()
+    caps = open_sources(sources)
+    if not caps:
+        print("エラー: 接続できたカメラがありません。")
+        detector.close()
+        return
+
+    # カメラごとに取り込みスレッドを立て、最新の1枚だけを保持する
+    streams = {}
+    for stream_id, cap in caps.items():
+        frame_queue = queue.Queue(maxsize=1)
+        stats = PipelineStats()
+        stop_event = threading.Event()
+        thread = CaptureThread(cap, frame_queue, stats, stop_event)
+        thread.start()
+        streams[stream_id] = (frame_queue, stats, stop_event, thread)
+
+    # 全カメラを束ねた推論の頻度を、物体の出入り・推論の時間・CPUの使用量に合わせて決める
+    scheduler = AdaptiveScheduler()
+    print(f">>> {len(streams)} 台のカメラで映像解析プロセスを開始しました。 <<<")
+    print(">>> 映像ウィンドウを選択して 'q' キーを押すと終了します。 <<<")
+
+    try:
+        while streams:
+            # 次の解析時刻まで待つ（その間も取り込みスレッドが最新のフレームに入れ替える）
+            if not scheduler.ready():
+                if cv2.waitKey(max(1, int(scheduler.wait_time() * 1000))) & 0xFF == ord('q'):
+                    break
+                continue
+            # 各ストリームの最新フレームを集める（止まったストリームは外す）
+            frames, stream_ids = [], []
+            for stream_id, (frame_queue, stats, stop_event, thread) in list(streams.items()):
+                try:
+                    _, _, frame = frame_queue.get_nowait()
+                except queue.Empty:
+                    if stop_event.is_set():
+                        print(f"[{stream_id}] ストリームが停止しました。 {stats.snapshot()}")
+                        del streams[stream_id]
+                    continue
+                stats.add('frames_analyzed')
+                frames.append(frame)
+                stream_ids.append(stream_id)
+
+            if frames:
+                # BGRのフレームのまま1回の推論に束ね、追跡中オブジェクトのリストを受け取る
+                tracks_per_frame = scheduler.run(detector.track_frames, frames, stream_ids)
+                with metrics.span('display'):
+                    for stream_id, frame, tracked_objects in zip(stream_ids, frames, tracks_per_frame):
+                        cv2.imshow(f'Live Vision Feed [{stream_id}]', draw_overlay(frame, tracked_objects))
+
+            # 'q'キーが押されたらループを抜ける
+            if cv2.waitKey(1 if frames else 20) & 0xFF == ord('q'):
+                break
+    finally:
+        for stream_id, (_, stats, stop_event, thread) in streams.items():
+            stop_event.set()
+            thread.join(timeout=2.0)
+            print(f"[{stream_id}] 統計: {stats.snapshot()}")
+        detector.close()
+        print(f"解析頻度: {scheduler.stats()}")
+        print(f"シーン変化ゲート統計: {detector.gate_stats()}")
+        print(f"フレーム置き場: {detector.frame_store_stats()}")
+        for stream_id, cap in caps.items():
+            print(f"[{stream_id}] カメラ: {cap.stats()}")
+            cap.release()
+        cv2.destroyAllWindows()
+        print("アプリケーションを終了します。")
+
+
+if __name__ == '__main__':
+    run_multi_vision_process()
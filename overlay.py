@@ -0,0 +1,62 @@
+# overlay.py
+# 追跡中のオブジェクトを、OpenCVのBGRフレーム(NumPy配列)に直接描く（ライブ表示用）
+#
+# PIL画像への変換・RGB⇔BGRの変換をせずに、カメラから読んだフレームにそのまま描きます。
+# 枠は cv2.rectangle で描き、ラベルの文字は config.FONT_PATH のフォントで
+# 「文字の形（アルファ値）」だけを1回作ってキャッシュし、以後は色を付けて重ねるだけにします
+# （OpenCV の標準フォントは日本語を描けないため）。
+
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+
+import config
+from image_cache import load_font
+
+FONT_SIZE = 16
+LINE_WIDTH = 3
+
+
+@lru_cache(maxsize=None)
+def color_bgr(name):
+    """'red' などの色名を OpenCV の (B, G, R) にする"""
+    r, g, b = ImageColor.getrgb(name)[:3]
+    return (b, g, r)
+
+
+@lru_cache(maxsize=512)
+def text_mask(text, size=FONT_SIZE):
+    """文字の形を 0〜1 のアルファ値の配列 (高さ, 幅, 1) で返す（同じラベルは1回だけ作る）"""
+    font = load_font(size)
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new('L', (max(1, right - left), max(1, bottom - top)))
+    ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)
+    alpha = np.asarray(mask, dtype=np.float32)[..., None] / 255.0
+    alpha.flags.writeable = False
+    return alpha
+
+
+def put_text(frame, text, origin, color, size=FONT_SIZE):
+    """フレームの origin (左上) に文字を重ねる。はみ出す部分は描かない"""
+    alpha = text_mask(text, size)
+    height, width = frame.shape[:2]
+    x, y = int(origin[0]), int(origin[1])
+    left, top = max(0, x), max(0, y)
+    right, bottom = min(width, x + alpha.shape[1]), min(height, y + alpha.shape[0])
+    if right <= left or bottom <= top:
+        return
+    alpha = alpha[top - y:bottom - y, left - x:right - x]
+    region = frame[top:bottom, left:right]
+    region[:] = region * (1.0 - alpha) + np.asarray(color, dtype=np.float32) * alpha
+
+
+def draw_overlay(frame, tracked_objects, font_size=FONT_SIZE, line_width=LINE_WIDTH):
+    """追跡中のオブジェクト（'id'・'bbox'・'label' を持つ辞書）をBGRフレームにその場で描き、同じ配列を返す"""
+    for obj in tracked_objects:
+        color = color_bgr(config.COLORS[obj['id'] % len(config.COLORS)])
+        x1, y1, x2, y2 = (int(round(v)) for v in obj['bbox'])
+        cv2.rectangle(frame, (x1, y1), (x2, y2), color, line_width)
+        put_text(frame, obj['label'], (x1, y1 - font_size - 4), color, font_size)
+    return frame
@@ -0,0 +1,183 @@
+# persistence.py
+# 消失したオブジェクトの画像保存とDBへの記録を、推論ループの外（別スレッド）で行う
+#
+# 推論側は submit() でキューに積むだけで、JPEGの書き出しとDBへの挿入は
+# 書き込みスレッドがまとめて（1トランザクションで）行います。
+# 画像は image_store.ImageStore が内容のハッシュで保存します（同じフレームは1回だけ書く）。
+# 見た目の埋め込みがあれば、記録のIDと一緒に embedding_index.EmbeddingIndex に追記します。
+
+import queue
+import threading
+import time
+
+import config
+import database
+import metrics
+from embedding_index import EmbeddingIndex
+from image_cache import ImageCache
+from image_store import ImageStore
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_store():
+    """書き込みスレッドを使わない場合に共有する画像置き場"""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = ImageStore()
+        return _default_store
+
+
+def write_sighting(image, label, bbox, seen_time, store=None):
+    """画像を保存し、DBに入れる行 (timestamp, image_path, label, bbox, crop_path, image_scale) を返す"""
+    timestamp_str = seen_time.strftime('%Y-%m-%d %H:%M:%S')
+    image_path, crop_path, image_scale = (store or get_default_store()).save(image, bbox)
+    return (timestamp_str, image_path, label, bbox, crop_path, image_scale)
+
+
+class PersistenceWriter(threading.Thread):
+    """画像の保存とDBへの記録をまとめて行う書き込みスレッド
+
+    キューが満杯の場合は submit() が最大 submit_timeout 秒だけ待ち（背圧）、
+    それでも空かなければその記録を諦めて件数を数える。推論が止まり続けることはない。
+    """
+
+    _STOP = object()
+
+    def __init__(self, queue_size=None, batch_size=None, submit_timeout=None):
+        super().__init__(name='persistence', daemon=True)
+        self.queue = queue.Queue(maxsize=queue_size or config.PERSIST_QUEUE_SIZE)
+        self.batch_size = batch_size or config.PERSIST_BATCH_SIZE
+        self.submit_timeout = config.PERSIST_SUBMIT_TIMEOUT if submit_timeout is None else submit_timeout
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.batches = 0
+        self.image_store = ImageStore()
+        # 検索画面用のBBOX付き画像を先に作っておく
+        self.image_cache = ImageCache() if config.IMAGE_CACHE_WARM_ON_PERSIST else None
+        self.embedding_index = EmbeddingIndex() if config.EMBEDDING_INDEX_ENABLED else None
+
+    def submit(self, image, label, bbox, seen_time, embedding=None):
+        """消失したオブジェクトを書き込み待ちに積む。積めなかった場合はFalse"""
+        try:
+            self.queue.put((image, label, list(bbox), seen_time, embedding), timeout=self.submit_timeout)
+        except queue.Full:
+            metrics.inc('persist_dropped')
+            with self._lock:
+                self.dropped += 1
+            print(f"  [Persist] 書き込みが追いつかないため {label} の記録を諦めました。")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def run(self):
+        conn = database.connect()
+        try:
+            stopping = False
+            while not stopping:
+                item = self.queue.get()
+                batch = []
+                if item is self._STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+                # 溜まっている分をまとめて取り出す
+                while not stopping and len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is self._STOP:
+                        stopping = True
+                    else:
+                        batch.append(item)
+                if batch:
+                    try:
+                        self._write_batch(conn, batch)
+                    except Exception as e:
+                        # 想定外のエラーでも書き込みスレッドは止めない（止まると以降の記録が全て捨てられる）
+                        print(f"  [Persist] 記録の書き込みに失敗しました: {e!r}")
+                        self._count_errors(len(batch))
+                metrics.set_gauge('persist_queue_depth', self.queue.qsize())
+                # get() した数だけ task_done() を呼ぶ（flush() の join のため）
+                for _ in range(len(batch) + (1 if stopping else 0)):
+                    self.queue.task_done()
+        finally:
+            conn.close()
+
+    def _write_batch(self, conn, batch):
+        rows = []
+        embeddings = []
+        for image, label, bbox, seen_time, embedding in batch:
+            try:
+                with metrics.span('image_save'):
+                    rows.append(write_sighting(image, label, bbox, seen_time, store=self.image_store))
+                embeddings.append(embedding)
+            except Exception as e:
+                print(f"  [Persist] 画像の保存に失敗しました: {e!r}")
+                self._count_errors(1)
+        try:
+            ids = database.save_detections(rows, conn=conn)
+        except Exception as e:
+            print(f"  [Persist] DBへの記録に失敗しました: {e!r}")
+            self._count_errors(len(rows))
+            return
+        with self._lock:
+            self.written += len(rows)
+            self.batches += 1
+        if self.embedding_index is not None:
+            pairs = [(i, embedding) for i, embedding in zip(ids, embeddings) if embedding is not None]
+            if pairs:
+                try:
+                    self.embedding_index.add([i for i, _ in pairs], [embedding for _, embedding in pairs])
+                except Exception as e:
+                    print(f"  [Persist] 埋め込みの保存に失敗しました: {e!r}")
+                    self._count_errors(len(pairs))
+        if self.image_cache is not None:
+            for _, image_path, label, bbox, _, image_scale in rows:
+                try:
+                    self.image_cache.annotated(image_path, [v * image_scale for v in bbox], label)
+                except Exception as e:
+                    print(f"  [Persist] 表示用画像の作成に失敗しました: {e!r}")
+                    self._count_errors(1)
+
+    def _count_errors(self, count):
+        metrics.inc('persist_errors', count)
+        with self._lock:
+            self.errors += count
+
+    def flush(self, timeout=None):
+        """積まれている記録が全て書き込まれるまで待つ"""
+        deadline = None if timeout is None else time.time() + timeout
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def close(self):
+        """残りを書き込んでからスレッドを止める"""
+        if not self.is_alive():
+            if self.queue.unfinished_tasks:
+                print(f"  [Persist] 書き込みスレッドが止まっているため、{self.queue.unfinished_tasks} 件の記録を書き込めませんでした。")
+            return
+        self.queue.put(self._STOP)
+        self.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'submitted': self.submitted,
+                'written': self.written,
+                'dropped': self.dropped,
+                'errors': self.errors,
+                'batches': self.batches,
+                'pending': self.queue.qsize(),
+                'images': self.image_store.stats(),
+            }
@@ -0,0 +1,185 @@
+# pipeline.py
+# 取り込み・推論・表示をスレッドで分離したパイプライン
+
+import queue
+import threading
+import time
+
+import cv2
+
+import metrics
+from overlay import draw_overlay
+from scheduler import AdaptiveScheduler
+
+
+def put_latest(q, item):
+    """キューが満杯なら古い要素を捨てて、最新の要素を入れる。捨てた件数を返す"""
+    dropped = 0
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped += 1
+            except queue.Empty:
+                pass
+
+
+class PipelineStats:
+    """パイプライン各段のカウンタ（スレッド間で共有）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frames_captured = 0
+        self.frames_dropped = 0      # 推論が間に合わず捨てたカメラフレーム
+        self.frames_analyzed = 0
+        self.results_dropped = 0     # 表示が間に合わず捨てた推論結果
+        self.read_failures = 0
+        self.inference_errors = 0
+
+    def add(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'frames_captured': self.frames_captured,
+                'frames_dropped': self.frames_dropped,
+                'frames_analyzed': self.frames_analyzed,
+                'results_dropped': self.results_dropped,
+                'read_failures': self.read_failures,
+                'inference_errors': self.inference_errors,
+            }
+
+
+class CaptureThread(threading.Thread):
+    """カメラから常にフレームを読み続け、最新の1枚だけをキューに残すスレッド"""
+
+    def __init__(self, cap, frame_queue, stats, stop_event):
+        super().__init__(name='capture', daemon=True)
+        self.cap = cap
+        self.frame_queue = frame_queue
+        self.stats = stats
+        self.stop_event = stop_event
+
+    def run(self):
+        frame_id = 0
+        while not self.stop_event.is_set():
+            with metrics.span('capture_read'):
+                ret, frame = self.cap.read()
+            if not ret:
+                # camera_source のカメラはつなぎ直しの間は待つので、ここに来るのは閉じたか諦めたときだけ
+                print("エラー: フレームを読み込めませんでした。")
+                self.stats.add('read_failures')
+                self.stop_event.set()
+                break
+            frame_id += 1
+            self.stats.add('frames_captured')
+            metrics.mark('frames_captured')
+            dropped = put_latest(self.frame_queue, (frame_id, time.time(), frame))
+            if dropped:
+                self.stats.add('frames_dropped', dropped)
+                metrics.inc('frames_dropped', dropped)
+
+
+class InferenceThread(threading.Thread):
+    """解析する時刻（AdaptiveScheduler）になったら最新フレームを取り出して解析するスレッド"""
+
+    def __init__(self, detector, frame_queue, result_queue, stats, stop_event, scheduler):
+        super().__init__(name='inference', daemon=True)
+        self.detector = detector
+        self.scheduler = scheduler
+        self.frame_queue = frame_queue
+        self.result_queue = result_queue
+        self.stats = stats
+        self.stop_event = stop_event
+
+    def run(self):
+        while not self.stop_event.is_set():
+            # 次の解析時刻まで待つ（その間のフレームは取り込みスレッドが捨てる）
+            if self.stop_event.wait(self.scheduler.wait_time()):
+                break
+            try:
+                frame_id, captured_at, frame = self.frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            # BGRのフレームをそのまま渡し、追跡中オブジェクトのリストを受け取る（描画は表示側で行う）
+            try:
+                tracked_objects = self.scheduler.run(self.detector.track_frame, frame)
+            except Exception as e:
+                # 1回の推論の失敗（推論サービスの通信エラーなど）でスレッドを止めない。
+                # 失敗が続く場合に空回りしないよう、最低頻度の間隔だけ待ってから次のフレームを解析する
+                print(f"エラー: 推論に失敗しました: {e!r}")
+                self.stats.add('inference_errors')
+                metrics.inc('inference_errors')
+                self.stop_event.wait(1.0 / self.scheduler.min_fps)
+                continue
+            self.stats.add('frames_analyzed')
+
+            dropped = put_latest(self.result_queue, (frame_id, captured_at, frame, tracked_objects))
+            if dropped:
+                self.stats.add('results_dropped', dropped)
+                metrics.inc('results_dropped', dropped)
+
+
+class VisionPipeline:
+    """取り込みスレッド → 推論スレッド → 表示（メインスレッド）をつなぐパイプライン
+
+    各段の間は有界キューでつなぎ、溢れたら古いものから捨てるため、
+    表示までの遅延は「推論1回分」に収まります。
+    """
+
+    def __init__(self, cap, detector, frame_queue_size=1, result_queue_size=1, scheduler=None):
+        self.cap = cap
+        self.detector = detector
+        self.scheduler = scheduler or AdaptiveScheduler()
+        self.stats = PipelineStats()
+        self.stop_event = threading.Event()
+        self.frame_queue = queue.Queue(maxsize=frame_queue_size)
+        self.result_queue = queue.Queue(maxsize=result_queue_size)
+        self.capture_thread = CaptureThread(cap, self.frame_queue, self.stats, self.stop_event)
+        self.inference_thread = InferenceThread(
+            detector, self.frame_queue, self.result_queue, self.stats, self.stop_event, self.scheduler
+        )
+
+    def start(self):
+        self.capture_thread.start()
+        self.inference_thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.capture_thread.join(timeout=2.0)
+        self.inference_thread.join()
+
+    def get_result(self, timeout=0.05):
+        """最新の推論結果 (frame_id, captured_at, frame, tracked_objects) を返す。無ければNone"""
+        try:
+            return self.result_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def run_display(self, window_name='Live Vision Feed'):
+        """メインスレッドで結果を表示し続ける。'q'キーか取り込み停止で終了"""
+        self.start()
+        try:
+            while not self.stop_event.is_set():
+                result = self.get_result()
+                if result is not None:
+                    _, captured_at, frame, tracked_objects = result
+                    with metrics.span('display'):
+                        # カメラのフレームに直接描いて表示する（色の変換・PIL画像への変換はしない）
+                        draw_overlay(frame, tracked_objects)
+                        cv2.imshow(window_name, frame)
+                    # 取り込みから表示までの遅延（metrics のログに定期的に出る）
+                    metrics.observe('end_to_end', time.time() - captured_at)
+
+                # 'q'キーが押されたらループを抜ける
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+        finally:
+            self.stop()
+        return self.stats.snapshot()
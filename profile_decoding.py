@@ -0,0 +1,84 @@
+# profile_decoding.py
+# config.DECODING_PROFILES の各プロファイルについて、タスクごとの速度と精度を計測する
+#
+# 精度は 'accurate' プロファイルの結果を基準にした、ホワイトリスト対象物のF1です
+# （ラベルは含まれるキーワードに置き換えて比較するので、説明文の言い回しの違いは無視されます）。
+#
+#   python profile_decoding.py --image test_image.png --repeat 3
+
+import argparse
+import json
+import statistics
+
+from PIL import Image
+
+import config
+from backends import create_backend, get_generate_kwargs, run_task, result_items, detection_f1
+from vision import build_prompts, SUPPORTED_TASKS
+
+TASKS = SUPPORTED_TASKS
+REFERENCE_PROFILE = 'accurate'
+
+
+def whitelist_items(items):
+    """ラベルをホワイトリストのキーワードに置き換え、対象外の検出は捨てる"""
+    mapped = []
+    for box, label in items:
+        for keyword in config.WHITELIST_KEYWORDS:
+            if keyword in label:
+                mapped.append((box, keyword))
+                break
+    return mapped
+
+
+def run_profile(backend, image, task_prompt, profile):
+    """1つのタスクとプロファイルで画像を解析し、(検出のリスト, 所要秒数) を返す"""
+    items, total = [], 0.0
+    for prompt in build_prompts(task_prompt):
+        results, _, elapsed = run_task(backend, image, task_prompt, prompt=prompt, **get_generate_kwargs(profile))
+        items.extend(result_items(results, task_prompt))
+        total += elapsed
+    return whitelist_items(items), total
+
+
+def profile_decoding(backend, image, tasks, profiles, repeat):
+    """タスク×プロファイルごとの速度(秒)と、基準プロファイルに対するF1を返す"""
+    report = []
+    for task_prompt in tasks:
+        run_profile(backend, image, task_prompt, REFERENCE_PROFILE)  # ウォームアップ
+        reference, _ = run_profile(backend, image, task_prompt, REFERENCE_PROFILE)
+        for profile in profiles:
+            timings, f1_scores = [], []
+            for _ in range(repeat):
+                items, elapsed = run_profile(backend, image, task_prompt, profile)
+                timings.append(elapsed)
+                f1_scores.append(detection_f1(reference, items))
+            report.append({
+                'task': task_prompt,
+                'profile': profile,
+                'settings': config.DECODING_PROFILES[profile],
+                'mean_seconds': statistics.mean(timings),
+                'median_seconds': statistics.median(timings),
+                'f1_vs_reference': statistics.mean(f1_scores),
+            })
+            print(f"{task_prompt:32s} {profile:10s} "
+                  f"{report[-1]['median_seconds']:7.3f} 秒  F1={report[-1]['f1_vs_reference']:.2f}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="デコード設定ごとの速度と精度を計測します")
+    parser.add_argument('--image', default='test_image.png')
+    parser.add_argument('--tasks', nargs='+', default=list(TASKS), choices=TASKS)
+    parser.add_argument('--profiles', nargs='+', default=list(config.DECODING_PROFILES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--backend', default=config.INFERENCE_BACKEND)
+    parser.add_argument('--output', default='profile_report.json')
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert("RGB")
+    backend = create_backend(args.backend)
+    report = profile_decoding(backend, image, args.tasks, args.profiles, args.repeat)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'backend': backend.name, 'image': args.image, 'results': report}, f, ensure_ascii=False, indent=2)
+    print(f"計測結果を '{args.output}' に保存しました。")
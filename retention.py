@@ -0,0 +1,294 @@
+# retention.py
+# 古い検出履歴を、画像ファイルと一緒に少しずつ削除する（保持ポリシー）
+#
+# clear_db のように全てを消す代わりに、
+#   ・RETENTION_MAX_AGE_DAYS 日より古い記録
+#   ・ラベルごとに新しい方から RETENTION_KEEP_PER_LABEL 件を超えた記録
+#   ・history/ の合計が RETENTION_DISK_QUOTA_MB を超えている間、最も古い記録
+# を RETENTION_BATCH_SIZE 件ずつの短いトランザクションで削除します（書き込みスレッドを長く待たせない）。
+# 画像ファイルは、どの記録からも参照されなくなった時だけ消します（image_store.py で共有しているため）。
+# 最後に incremental_vacuum で空いたページをOSに返します。
+#
+# 検出中の自動整理（RetentionScheduler）は、明示的に有効にした場合だけ動きます。
+# app.py のサイドバーか `python retention.py --schedule on` で有効にすると、設定は
+# memory_log.db の retention_settings 表に保存され、config.RETENTION_SCHEDULE_ENABLED より優先されます。
+
+import argparse
+import os
+import threading
+import time
+
+import config
+import database
+from embedding_index import EmbeddingIndex
+
+SETTINGS_TABLE = 'retention_settings'
+
+
+def directory_size(path):
+    """フォルダ以下の全ファイルの合計バイト数"""
+    total = 0
+    if not os.path.exists(path):
+        return 0
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            total += directory_size(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            total += entry.stat().st_size
+    return total
+
+
+def is_referenced(conn, path):
+    """画像ファイルがまだどれかの記録から参照されていればTrue"""
+    return conn.execute(
+        "SELECT 1 FROM detections WHERE image_path = ? UNION ALL "
+        "SELECT 1 FROM detections WHERE crop_path = ? LIMIT 1",
+        (path, path)
+    ).fetchone() is not None
+
+
+def delete_detections(conn, ids):
+    """記録を削除し、どこからも参照されなくなった画像ファイルも消す。(削除したファイル数, バイト数) を返す"""
+    if not ids:
+        return 0, 0
+    placeholders = ','.join('?' * len(ids))
+    with conn:
+        paths = set()
+        for image_path, crop_path in conn.execute(
+            f"SELECT image_path, crop_path FROM detections WHERE id IN ({placeholders})", ids
+        ):
+            paths.update(p for p in (image_path, crop_path) if p)
+        conn.execute(f"DELETE FROM detections WHERE id IN ({placeholders})", ids)
+        orphaned = [path for path in paths if not is_referenced(conn, path)]
+
+    # ファイルはコミットした後に消す（トランザクションが失敗しても画像は残る）
+    files, freed = 0, 0
+    for path in orphaned:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            continue
+        files += 1
+        freed += size
+    return files, freed
+
+
+def _expired_by_age(conn, cutoff, limit):
+    return [row[0] for row in conn.execute(
+        "SELECT id FROM detections WHERE timestamp < ? ORDER BY timestamp LIMIT ?", (cutoff, limit)
+    )]
+
+
+def _expired_by_count(conn, keep, limit):
+    return [row[0] for row in conn.execute(
+        "SELECT id FROM ("
+        "  SELECT id, ROW_NUMBER() OVER (PARTITION BY label_id ORDER BY timestamp DESC, id DESC) AS rank"
+        "  FROM detections"
+        ") WHERE rank > ? LIMIT ?",
+        (keep, limit)
+    )]
+
+
+def _oldest(conn, limit):
+    return [row[0] for row in conn.execute(
+        "SELECT id FROM detections ORDER BY timestamp, id LIMIT ?", (limit,)
+    )]
+
+
+def remove_unused_labels(conn):
+    """どの記録からも使われなくなったラベルとキーワードを消す（全文検索の索引はトリガーで同期）"""
+    with conn:
+        conn.execute("DELETE FROM label_keywords WHERE label_id NOT IN (SELECT label_id FROM detections)")
+        conn.execute("DELETE FROM labels WHERE id NOT IN (SELECT label_id FROM detections)")
+        conn.execute("DELETE FROM keywords WHERE id NOT IN (SELECT keyword_id FROM label_keywords)")
+
+
+def incremental_vacuum(conn, pages=None, pause=None):
+    """空いたページを少しずつファイルから切り詰める。切り詰めたページ数を返す"""
+    pages = pages or config.RETENTION_VACUUM_PAGES
+    pause = config.RETENTION_BATCH_PAUSE if pause is None else pause
+    # auto_vacuum=INCREMENTAL でない場合は何もできない（database.enable_incremental_vacuum）
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    vacuumed = 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    while free > 0:
+        conn.execute(f"PRAGMA incremental_vacuum({int(min(free, pages))})").fetchall()
+        remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if remaining >= free:
+            break
+        vacuumed += free - remaining
+        free = remaining
+        time.sleep(pause)
+    return vacuumed
+
+
+def apply_retention(max_age_days=None, keep_per_label=None, disk_quota_mb=None, now=None, conn=None):
+    """保持ポリシーに従って古い記録を削除し、結果の統計を返す
+
+    引数を省略すると config の RETENTION_* を使う（Noneの項目は適用しない）。
+    """
+    max_age_days = config.RETENTION_MAX_AGE_DAYS if max_age_days is None else max_age_days
+    keep_per_label = config.RETENTION_KEEP_PER_LABEL if keep_per_label is None else keep_per_label
+    disk_quota_mb = config.RETENTION_DISK_QUOTA_MB if disk_quota_mb is None else disk_quota_mb
+    batch_size = config.RETENTION_BATCH_SIZE
+    now = time.time() if now is None else now
+
+    own_conn = conn is None
+    if own_conn:
+        conn = database.connect()
+    stats = {'rows': 0, 'files': 0, 'freed_bytes': 0, 'vacuumed_pages': 0, 'embeddings': 0}
+    deleted_ids = []
+
+    def run(select):
+        while True:
+            ids = select()
+            if not ids:
+                return
+            files, freed = delete_detections(conn, ids)
+            deleted_ids.extend(ids)
+            stats['rows'] += len(ids)
+            stats['files'] += files
+            stats['freed_bytes'] += freed
+            # 他の接続（書き込みスレッド）が割り込めるように少し待つ
+            time.sleep(config.RETENTION_BATCH_PAUSE)
+            yield freed
+
+    try:
+        if max_age_days:
+            cutoff = int(now - max_age_days * 86400)
+            for _ in run(lambda: _expired_by_age(conn, cutoff, batch_size)):
+                pass
+        if keep_per_label:
+            for _ in run(lambda: _expired_by_count(conn, keep_per_label, batch_size)):
+                pass
+        if disk_quota_mb:
+            quota = disk_quota_mb * 1024 * 1024
+            usage = directory_size(config.HISTORY_DIR)
+            if usage > quota:
+                for freed in run(lambda: _oldest(conn, batch_size)):
+                    usage -= freed
+                    if usage <= quota:
+                        break
+        if stats['rows']:
+            remove_unused_labels(conn)
+            stats['vacuumed_pages'] = incremental_vacuum(conn)
+            if config.EMBEDDING_INDEX_ENABLED:
+                # 削除した記録の埋め込みも消す（残すと類似検索が削除済みのIDばかり返すようになる）
+                stats['embeddings'] = EmbeddingIndex().discard(deleted_ids)
+    finally:
+        if own_conn:
+            conn.close()
+    return stats
+
+
+def ensure_settings_table(conn):
+    with conn:
+        conn.execute(
+            f'''CREATE TABLE IF NOT EXISTS {SETTINGS_TABLE} (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                enabled INTEGER NOT NULL,
+                max_age_days REAL,
+                keep_per_label INTEGER,
+                disk_quota_mb REAL,
+                updated INTEGER NOT NULL
+            )'''
+        )
+
+
+def load_settings(conn=None):
+    """サイドバー・CLIで保存した自動整理の設定を辞書で返す。保存されていなければNone
+
+    ポリシーの項目がNoneなら config の RETENTION_* を使い、0なら適用しない（apply_retention と同じ）。
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = database.connect()
+    try:
+        ensure_settings_table(conn)
+        row = conn.execute(
+            f"SELECT enabled, max_age_days, keep_per_label, disk_quota_mb FROM {SETTINGS_TABLE} WHERE id = 1"
+        ).fetchone()
+    finally:
+        if own_conn:
+            conn.close()
+    if row is None:
+        return None
+    return {'enabled': bool(row[0]), 'max_age_days': row[1], 'keep_per_label': row[2], 'disk_quota_mb': row[3]}
+
+
+def save_settings(enabled, max_age_days=None, keep_per_label=None, disk_quota_mb=None, conn=None):
+    """自動整理を行うかどうかと、その時のポリシーを保存する"""
+    own_conn = conn is None
+    if own_conn:
+        conn = database.connect()
+    try:
+        ensure_settings_table(conn)
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {SETTINGS_TABLE} "
+                "(id, enabled, max_age_days, keep_per_label, disk_quota_mb, updated) VALUES (1, ?, ?, ?, ?, ?)",
+                (int(bool(enabled)), max_age_days, keep_per_label, disk_quota_mb, int(time.time()))
+            )
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def schedule_enabled(conn=None):
+    """検出中に自動整理を行うか（保存した設定があればそれを、無ければ config.RETENTION_SCHEDULE_ENABLED）"""
+    settings = load_settings(conn)
+    return config.RETENTION_SCHEDULE_ENABLED if settings is None else settings['enabled']
+
+
+class RetentionScheduler(threading.Thread):
+    """RETENTION_INTERVAL_SEC 秒ごとに保持ポリシーを適用するスレッド
+
+    保存した設定があればそのポリシーで適用し、サイドバーで無効にされたら次からは何もしない。
+    """
+
+    def __init__(self, interval=None):
+        super().__init__(name='retention', daemon=True)
+        self.interval = interval or config.RETENTION_INTERVAL_SEC
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                settings = load_settings()
+                if settings is not None and not settings['enabled']:
+                    continue
+                settings = settings or {}
+                stats = apply_retention(
+                    settings.get('max_age_days'), settings.get('keep_per_label'), settings.get('disk_quota_mb')
+                )
+            except database.sqlite3.Error as e:
+                print(f"  [Retention] 古い記録の削除に失敗しました: {e}")
+                continue
+            if stats['rows']:
+                print(f"  [Retention] {stats['rows']}件の記録と{stats['files']}個の画像を削除しました。")
+
+    def close(self):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="保持ポリシーに従って古い検出履歴を削除します")
+    parser.add_argument('--max-age-days', type=float, default=None)
+    parser.add_argument('--keep-per-label', type=int, default=None)
+    parser.add_argument('--disk-quota-mb', type=float, default=None)
+    parser.add_argument('--schedule', choices=['on', 'off'], default=None,
+                        help="削除はせずに、検出中の自動整理を有効/無効にして保存する（ポリシーは上の引数。省略した項目は config）")
+    args = parser.parse_args()
+
+    database.init_db()
+    if args.schedule is not None:
+        save_settings(args.schedule == 'on', args.max_age_days, args.keep_per_label, args.disk_quota_mb)
+        print(f"検出中の自動整理を{'有効' if args.schedule == 'on' else '無効'}にしました: {load_settings()}")
+        raise SystemExit
+    result = apply_retention(args.max_age_days, args.keep_per_label, args.disk_quota_mb)
+    print(f"削除した記録: {result['rows']}件, 画像: {result['files']}個 ({result['freed_bytes'] / 1024 / 1024:.1f} MB), "
+          f"切り詰めたページ: {result['vacuumed_pages']}, 埋め込み: {result['embeddings']}行")
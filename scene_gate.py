@@ -0,0 +1,67 @@
+# scene_gate.py
+# 前回解析したフレームからほとんど変化していない場合に、VLMの推論を省略するための前段フィルタ
+
+import numpy as np
+
+import config
+
+
+class SceneChangeGate:
+    """縮小したグレースケール画像の差分で、シーンが変化したかを判定する"""
+
+    def __init__(self, threshold=None, size=None, max_skips=None):
+        self.threshold = config.SCENE_CHANGE_THRESHOLD if threshold is None else threshold
+        self.size = config.SCENE_GATE_SIZE if size is None else size
+        self.max_skips = config.SCENE_GATE_MAX_SKIPS if max_skips is None else max_skips
+        self.reference = None       # 最後に推論した時の縮小画像
+        self.consecutive_skips = 0
+        self.last_score = None
+        self.checked = 0
+        self.skipped = 0
+
+    def _thumbnail(self, image):
+        """PIL画像・NumPy配列(RGBのビュー)を小さなグレースケール配列(0〜1)にする"""
+        if isinstance(image, np.ndarray):
+            # 間引いたビューから作る（フレーム全体をコピー・縮小しない）
+            height, width = image.shape[:2]
+            small = image[::max(1, height // self.size), ::max(1, width // self.size)][:self.size, :self.size]
+            return small.mean(axis=2, dtype=np.float32) / 255.0
+        small = image.convert('L').resize((self.size, self.size))
+        return np.asarray(small, dtype=np.float32) / 255.0
+
+    def should_analyze(self, image):
+        """推論すべきならTrue。変化が閾値未満ならFalse（推論を省略）"""
+        self.checked += 1
+        thumb = self._thumbnail(image)
+        if self.reference is None or thumb.shape != self.reference.shape:
+            self.last_score = None
+            self._accept(thumb)
+            return True
+
+        # 平均絶対差分（0〜1）で変化量を測る
+        self.last_score = float(np.mean(np.abs(thumb - self.reference)))
+        if self.last_score < self.threshold and self.consecutive_skips < self.max_skips:
+            self.consecutive_skips += 1
+            self.skipped += 1
+            return False
+
+        self._accept(thumb)
+        return True
+
+    def _accept(self, thumb):
+        self.reference = thumb
+        self.consecutive_skips = 0
+
+    def reset(self):
+        self.reference = None
+        self.consecutive_skips = 0
+
+    def stats(self):
+        analyzed = self.checked - self.skipped
+        return {
+            'checked': self.checked,
+            'analyzed': analyzed,
+            'skipped': self.skipped,
+            'skip_rate': self.skipped / self.checked if self.checked else 0.0,
+            'last_score': self.last_score,
+        }
@@ -0,0 +1,128 @@
+# scheduler.py
+# 解析の頻度を、推論にかかる時間・CPUの使用量・物体の出入りに合わせて自動で調整する
+#
+# 固定の PROCESSING_FPS の代わりに使います。
+#   ・物体が現れた/消えた/見失い中の間は、SCHEDULER_ACTIVE_HOLD_SEC 秒だけ最大頻度(SCHEDULER_MAX_FPS)にする
+#   ・何も変わらない間は、1回ごとに SCHEDULER_BACKOFF を掛けて SCHEDULER_MIN_FPS まで下げる
+#   ・1回の推論に使ったCPU時間から、CPU使用率が SCHEDULER_CPU_BUDGET を超えない頻度に抑える
+#     （推論サービスに頼む RemoteDetector はこのプロセスでCPUを使わないので、CPUの予算は使わない）
+#   ・マシン全体が混んでいる（1コアあたりのロードアベレージが SCHEDULER_LOAD_LIMIT 超え）なら下げる
+#
+#   scheduler = AdaptiveScheduler()
+#   if scheduler.ready():
+#       tracked_objects = scheduler.run(detector.track_frame, frame)
+
+import os
+import threading
+import time
+from collections import deque
+
+import config
+import metrics
+
+
+class AdaptiveScheduler:
+    """次にいつ解析するかを決める（スレッド間で共有してよい）"""
+
+    def __init__(self, min_fps=None, max_fps=None, cpu_budget=None, enabled=None):
+        self.enabled = config.SCHEDULER_ENABLED if enabled is None else enabled
+        self.min_fps = min_fps or config.SCHEDULER_MIN_FPS
+        self.max_fps = max_fps or config.SCHEDULER_MAX_FPS
+        self.cpu_budget = config.SCHEDULER_CPU_BUDGET if cpu_budget is None else cpu_budget
+        self.cpu_count = os.cpu_count() or 1
+        self._lock = threading.Lock()
+        self.latencies = deque(maxlen=config.SCHEDULER_WINDOW)
+        self.cpu_times = deque(maxlen=config.SCHEDULER_WINDOW)
+        self.fps = config.PROCESSING_FPS
+        self.next_due = 0.0
+        self.active_until = 0.0
+        self.previous_ids = None
+        self.runs = 0
+
+    def ready(self, now=None):
+        """解析する時刻になっていればTrue"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return now >= self.next_due
+
+    def wait_time(self, now=None):
+        """次に解析するまでの秒数（0なら今すぐ）"""
+        now = time.time() if now is None else now
+        with self._lock:
+            return max(0.0, self.next_due - now)
+
+    def run(self, function, *args, **kwargs):
+        """function（推論）を実行して所要時間とCPU時間を測り、結果の追跡状態から次の解析時刻を決める
+
+        function は追跡中オブジェクトのリスト（複数カメラなら、そのリストのリスト）を返すこと。
+        推論を別のプロセスで行う検出器（cpu_in_process が False）の場合、CPU時間は測らない。
+        """
+        started = time.time()
+        in_process = getattr(getattr(function, '__self__', None), 'cpu_in_process', True)
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = function(*args, **kwargs)
+        cpu_seconds = time.process_time() - cpu_start if in_process else None
+        self.record(time.perf_counter() - wall_start, cpu_seconds, result, started)
+        return result
+
+    def record(self, latency, cpu_seconds, tracked_objects, started=None):
+        """1回の解析の結果を記録して、次の解析時刻を決める（cpu_seconds がNoneならCPU時間は記録しない）"""
+        started = time.time() - latency if started is None else started
+        now = started + latency
+        with self._lock:
+            self.runs += 1
+            self.latencies.append(latency)
+            if cpu_seconds is not None:
+                self.cpu_times.append(cpu_seconds)
+            if self._is_active(tracked_objects):
+                self.active_until = now + config.SCHEDULER_ACTIVE_HOLD_SEC
+            self.fps = self._target_fps(now)
+            # 解析を始めた時刻から数える（推論の時間も間隔に含める）
+            self.next_due = started + 1.0 / self.fps
+            fps = self.fps
+        metrics.set_gauge('analysis_fps', round(fps, 3))
+        return fps
+
+    def _is_active(self, tracked_objects):
+        """物体が現れた・消えた・見失い中ならTrue"""
+        if tracked_objects and isinstance(tracked_objects[0], list):
+            # 複数カメラの場合は (カメラの番号, 追跡ID) で区別する
+            tracks = [(i, obj) for i, objects in enumerate(tracked_objects) for obj in objects]
+        else:
+            tracks = [(0, obj) for obj in tracked_objects or []]
+        ids = {(i, obj['id']) for i, obj in tracks}
+        changed = self.previous_ids is not None and ids != self.previous_ids
+        self.previous_ids = ids
+        missing = any(obj.get('unseen_frames', 0) > 0 for _, obj in tracks)
+        return changed or missing
+
+    def _target_fps(self, now):
+        if not self.enabled:
+            return config.PROCESSING_FPS
+        if now < self.active_until:
+            fps = self.max_fps
+        else:
+            fps = max(self.min_fps, self.fps * config.SCHEDULER_BACKOFF)
+
+        # 推論が連続で回る頻度より速くはできない
+        latency = sum(self.latencies) / len(self.latencies)
+        if latency > 0:
+            fps = min(fps, 1.0 / latency)
+        # CPUの予算: (1回あたりのCPU秒 × 頻度) / コア数 ≦ cpu_budget
+        cpu_seconds = sum(self.cpu_times) / len(self.cpu_times) if self.cpu_times else 0.0
+        if self.cpu_budget and cpu_seconds > 0:
+            fps = min(fps, self.cpu_budget * self.cpu_count / cpu_seconds)
+        # マシン全体が混んでいる場合は最低の頻度にする
+        if hasattr(os, 'getloadavg') and os.getloadavg()[0] / self.cpu_count > config.SCHEDULER_LOAD_LIMIT:
+            fps = self.min_fps
+        return max(self.min_fps, min(self.max_fps, fps))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'fps': round(self.fps, 3),
+                'runs': self.runs,
+                'latency': sum(self.latencies) / len(self.latencies) if self.latencies else 0.0,
+                'cpu_seconds': sum(self.cpu_times) / len(self.cpu_times) if self.cpu_times else 0.0,
+                'active': time.time() < self.active_until,
+            }
@@ -0,0 +1,67 @@
+# test_backends.py
+# 推論バックエンド（int8・torch.compile・ONNX）の結果が eager と一致するかのテスト
+#
+#   python -m pytest test_backends.py
+#
+# torch・transformers が無い環境、モデル（config.MODEL_ID）を読み込めない環境では飛ばします。
+# 手で比べる場合は `python backends.py --backend int8 --image 画像` を使います。
+
+import gc
+
+import pytest
+from PIL import Image, ImageDraw
+
+pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from backends import compare_results, create_backend, get_generate_kwargs, run_task
+
+TASK_PROMPT = '<OD>'
+# eager と比べて、同じラベル・IoU 0.5以上で一致した検出のF1がこれ以上なら合格
+MIN_F1 = {'int8': 0.8, 'compile': 0.9, 'onnx': 0.9}
+
+
+def fixed_image():
+    """毎回同じになる合成画像（乱数・外部ファイルを使わない）"""
+    image = Image.new('RGB', (768, 768), (235, 235, 230))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([80, 420, 340, 700], fill=(150, 90, 40))
+    draw.ellipse([430, 120, 690, 380], fill=(200, 40, 40))
+    draw.rectangle([470, 480, 650, 720], fill=(40, 70, 170))
+    return image
+
+
+def load_backend(name):
+    try:
+        return create_backend(name)
+    except OSError as e:
+        # モデルをダウンロードできない（オフライン・キャッシュ無し）
+        pytest.skip(f"モデルを読み込めません: {e}")
+
+
+@pytest.fixture(scope='module')
+def reference():
+    """eager の結果 (後処理結果, 生成テキスト)"""
+    backend = load_backend('eager')
+    results, text, _ = run_task(backend, fixed_image(), TASK_PROMPT, **get_generate_kwargs('fast'))
+    del backend
+    gc.collect()
+    return results, text
+
+
+@pytest.mark.parametrize('name', ['int8', 'compile', 'onnx'])
+def test_backend_matches_eager(reference, name):
+    if name == 'onnx':
+        pytest.importorskip('onnxruntime')
+    backend = load_backend(name)
+    image = fixed_image()
+    generate_kwargs = get_generate_kwargs('fast')
+    try:
+        # compile は1回目にコンパイルするので、2回目の結果を比べる
+        run_task(backend, image, TASK_PROMPT, **generate_kwargs)
+        results, text, _ = run_task(backend, image, TASK_PROMPT, **generate_kwargs)
+    finally:
+        del backend
+        gc.collect()
+    ref_results, ref_text = reference
+    assert compare_results(ref_results, results, TASK_PROMPT) >= MIN_F1[name], (ref_text, text)
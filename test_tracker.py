@@ -0,0 +1,149 @@
+# test_tracker.py
+# tracker.py の対応付け・ラベルのゲート・消失判定のテスト
+#
+#   python -m pytest test_tracker.py
+
+import itertools
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+import tracker
+from tracker import INVALID_COST, Tracker, solve_assignment
+
+START = datetime(2024, 5, 1, 9, 0, 0)
+
+
+def detection(label, x, y, size=40):
+    return {'bbox': [x, y, x + size, y + size], 'label': label, 'center': (x + size / 2, y + size / 2)}
+
+
+def brute_force(cost):
+    """全ての割り当てを試して、(割り当てられた有効な組の数, その合計コスト) の最良を返す"""
+    n, m = cost.shape
+    best = None
+    if n <= m:
+        candidates = ((range(n), cols) for cols in itertools.permutations(range(m), n))
+    else:
+        candidates = ((rows, range(m)) for rows in itertools.permutations(range(n), m))
+    for rows, cols in candidates:
+        values = cost[list(rows), list(cols)]
+        valid = values < INVALID_COST
+        # 割り当てられる組をできるだけ多く、その中で合計コストを最小に
+        score = (-int(valid.sum()), float(values[valid].sum()))
+        best = score if best is None or score < best else best
+    return -best[0], best[1]
+
+
+def assigned(cost, rows, cols):
+    values = cost[rows, cols]
+    valid = values < INVALID_COST
+    return int(valid.sum()), float(values[valid].sum())
+
+
+@pytest.fixture(params=['scipy', 'numpy'])
+def solver(request, monkeypatch):
+    if request.param == 'scipy':
+        if tracker.linear_sum_assignment is None:
+            pytest.skip("scipyがありません")
+    else:
+        monkeypatch.setattr(tracker, 'linear_sum_assignment', None)
+    return request.param
+
+
+@pytest.mark.parametrize('shape', [(1, 1), (3, 3), (2, 5), (5, 2), (4, 6), (6, 4)])
+def test_solve_assignment_matches_brute_force(solver, shape):
+    rng = np.random.default_rng(sum(shape))
+    for _ in range(20):
+        cost = rng.uniform(0, 100, size=shape)
+        rows, cols = solve_assignment(cost)
+        assert len(set(rows.tolist())) == len(rows) and len(set(cols.tolist())) == len(cols)
+        count, total = assigned(cost, rows, cols)
+        expected_count, expected_total = brute_force(cost)
+        assert count == expected_count
+        assert total == pytest.approx(expected_total)
+
+
+@pytest.mark.parametrize('shape', [(4, 4), (3, 6), (6, 3)])
+def test_solve_assignment_with_invalid_pairs(solver, shape):
+    rng = np.random.default_rng(len(shape) * shape[0] + shape[1])
+    for _ in range(20):
+        cost = rng.uniform(0, 100, size=shape)
+        cost[rng.random(shape) < 0.5] = INVALID_COST
+        rows, cols = solve_assignment(cost)
+        count, total = assigned(cost, rows, cols)
+        expected_count, expected_total = brute_force(cost)
+        assert count == expected_count
+        assert total == pytest.approx(expected_total)
+
+
+def test_solve_assignment_empty():
+    rows, cols = solve_assignment(np.empty((0, 3)))
+    assert len(rows) == 0 and len(cols) == 0
+
+
+def test_label_gating_never_matches_other_keyword():
+    track = Tracker(label_gating=True, cost='distance', threshold=75, disappear_seconds=None)
+    track.update([detection('key', 100, 100)], None, now=START)
+    # 同じ場所に別のキーワードの物体が出ても、既存の追跡には割り当てない
+    started, _ = track.update([detection('cup', 100, 100)], None, now=START + timedelta(seconds=1))
+    assert [obj['label'] for obj in started] == ['cup']
+    assert sorted(track.labels) == ['cup', 'key']
+    assert track.tracks()[0]['unseen_frames'] == 1
+
+
+def test_same_keyword_matches_with_new_caption():
+    track = Tracker(label_gating=True, cost='distance', threshold=75, disappear_seconds=None)
+    track.update([detection('key', 100, 100)], None, now=START)
+    started, _ = track.update([detection('silver key', 110, 100)], None, now=START + timedelta(seconds=1))
+    assert started == []
+    assert track.labels == ['silver key']
+
+
+def test_disappears_after_frame_count():
+    track = Tracker(disappear_frames=2, disappear_seconds=None)
+    track.update([detection('key', 100, 100)], None, now=START)
+    for i in range(2):
+        _, disappeared = track.update([], None, now=START + timedelta(seconds=i + 1))
+        assert disappeared == []
+    _, disappeared = track.update([], None, now=START + timedelta(seconds=3))
+    assert [obj['label'] for obj in disappeared] == ['key']
+    assert len(track) == 0
+
+
+def test_disappears_after_seconds():
+    track = Tracker(disappear_seconds=2.0, min_misses=2)
+    track.update([detection('key', 100, 100)], None, now=START)
+    # 見失った回数が多くても、2秒経つまでは消失にしない
+    for offset in (0.5, 1.0, 1.5):
+        _, disappeared = track.update([], None, now=START + timedelta(seconds=offset))
+        assert disappeared == []
+    _, disappeared = track.update([], None, now=START + timedelta(seconds=2.5))
+    assert [obj['label'] for obj in disappeared] == ['key']
+
+
+def test_seconds_need_min_misses():
+    track = Tracker(disappear_seconds=2.0, min_misses=2)
+    track.update([detection('key', 100, 100)], None, now=START)
+    # 解析の間隔が空いても、1回見失っただけでは消失にしない
+    _, disappeared = track.update([], None, now=START + timedelta(seconds=10))
+    assert disappeared == []
+    _, disappeared = track.update([], None, now=START + timedelta(seconds=10.2))
+    assert [obj['label'] for obj in disappeared] == ['key']
+
+
+def test_touch_keeps_tracks_through_skipped_frames():
+    track = Tracker(disappear_seconds=2.0, min_misses=2)
+    track.update([detection('key', 100, 100)], None, now=START)
+    # シーン変化ゲートが推論を省いた10秒間（変化が無いので、まだ見えていることにする）
+    for offset in range(1, 11):
+        track.touch(now=START + timedelta(seconds=offset))
+    # その直後に2回見失っても、最後に確かめてから2秒経つまでは消失にしない
+    for offset in (10.125, 10.25):
+        _, disappeared = track.update([], None, now=START + timedelta(seconds=offset))
+        assert disappeared == []
+    _, disappeared = track.update([], None, now=START + timedelta(seconds=12.5))
+    assert [obj['label'] for obj in disappeared] == ['key']
+    # touch は最後に検出された時刻（DBに記録する時刻）は変えない
+    assert disappeared[0]['last_seen_time'] == START
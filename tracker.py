@@ -0,0 +1,393 @@
+# tracker.py
+# 検出結果と追跡中オブジェクトの対応付け（配列ベースの追跡器）
+#
+# 追跡状態はNumPy配列で持ち、全ての 検出×追跡 の組み合わせのコスト行列を一度に計算して、
+# ハンガリアン法で最適な割り当てを求めます。
+#
+#   python tracker.py --detections 300   # マイクロベンチマーク
+
+import argparse
+import time
+from datetime import datetime
+
+import numpy as np
+
+import config
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+# 割り当て不可の組み合わせに入れるコスト
+INVALID_COST = 1e9
+
+
+def label_key(label):
+    """ラベルに含まれるホワイトリストのキーワードを返す（ラベルごとのゲートに使う）"""
+    for keyword in config.WHITELIST_KEYWORDS:
+        if keyword in label:
+            return keyword
+    return label
+
+
+def pairwise_iou(a, b):
+    """(N,4) と (M,4) のバウンディングボックスの IoU 行列 (N,M)"""
+    ix1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    iy1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    ix2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    iy2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(ix2 - ix1, 0, None) * np.clip(iy2 - iy1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+def _hungarian(cost):
+    """最小コストの割り当て（行と列の番号の配列）を返す。scipyが無い場合に使う"""
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    # u, v: ポテンシャル / p[j]: 列jに割り当てた行(1始まり) / way: 増加路をたどるための記録
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)
+    way = np.zeros(m + 1, dtype=np.int64)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            improve = free & (reduced < minv[1:])
+            minv[1:][improve] = reduced[improve]
+            way[1:][improve] = j0
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.nonzero(p[1:])[0]
+    rows = p[1:][cols] - 1
+    order = np.argsort(rows)
+    rows, cols = rows[order], cols[order]
+    if transposed:
+        rows, cols = cols, rows
+        order = np.argsort(rows)
+        rows, cols = rows[order], cols[order]
+    return rows, cols
+
+
+def _components(valid):
+    """割り当て可能な組でつながった 行・列 のまとまり（連結成分）ごとに番号を振る"""
+    n, m = valid.shape
+    big = n + m
+    row_label = np.arange(n)
+    while True:
+        col_label = np.where(valid, row_label[:, None], big).min(axis=0)
+        new_row_label = np.minimum(row_label, np.where(valid, col_label[None, :], big).min(axis=1))
+        if np.array_equal(new_row_label, row_label):
+            return row_label, col_label
+        row_label = new_row_label
+
+
+def solve_assignment(cost):
+    """コスト行列の最適割り当て (行番号, 列番号) を返す。INVALID_COST の組は割り当てない"""
+    empty = np.empty(0, dtype=np.int64)
+    if cost.size == 0:
+        return empty, empty
+    if linear_sum_assignment is not None:
+        return linear_sum_assignment(cost)
+
+    # scipyが無い場合は、つながりのある小さなまとまりごとにハンガリアン法を解く
+    valid = cost < INVALID_COST
+    row_label, col_label = _components(valid)
+    all_rows, all_cols = [empty], [empty]
+    for label in np.unique(row_label[valid.any(axis=1)]):
+        rows = np.nonzero(row_label == label)[0]
+        cols = np.nonzero(col_label == label)[0]
+        sub_rows, sub_cols = _hungarian(cost[np.ix_(rows, cols)])
+        all_rows.append(rows[sub_rows])
+        all_cols.append(cols[sub_cols])
+    return np.concatenate(all_rows), np.concatenate(all_cols)
+
+
+class Tracker:
+    """1つのストリームの追跡状態
+
+    bbox・中心座標・見失ったフレーム数はNumPy配列、ラベルなどはリストで、同じ順番に並べて持つ。
+    frame_store を渡すと、最後に見えたフレームはフレームIDで持ち、参照カウントを管理する。
+    disappear_seconds が設定されていれば、最後に見えてからの経過時間で消失を判定する
+    （解析の頻度が変わっても同じ時間で消失する）。Noneなら見失った回数 disappear_frames で判定する。
+    """
+
+    def __init__(self, threshold=None, disappear_frames=None, cost=None, label_gating=None, frame_store=None,
+                 disappear_seconds=None, min_misses=None):
+        self.threshold = config.OBJECT_TRACKING_THRESHOLD_PIXELS if threshold is None else threshold
+        self.disappear_frames = (
+            config.FRAMES_TO_CONSIDER_DISAPPEARED if disappear_frames is None else disappear_frames
+        )
+        self.disappear_seconds = (
+            config.SECONDS_TO_CONSIDER_DISAPPEARED if disappear_seconds is None else disappear_seconds
+        )
+        self.min_misses = config.DISAPPEAR_MIN_MISSES if min_misses is None else min_misses
+        self.cost = cost or config.TRACKING_COST
+        self.label_gating = config.TRACKING_LABEL_GATING if label_gating is None else label_gating
+        self.frame_store = frame_store
+        self.next_id = 0
+
+        self.ids = np.empty(0, dtype=np.int64)
+        self.bboxes = np.empty((0, 4), dtype=np.float32)
+        self.centers = np.empty((0, 2), dtype=np.float32)
+        self.unseen = np.empty(0, dtype=np.int32)
+        # 最後に見えた時刻（UNIX秒）。時間での消失判定に使う
+        self.seen_at = np.empty(0, dtype=np.float64)
+        self.labels = []
+        self.keys = []
+        self.last_seen_frames = []
+        self.last_seen_times = []
+        # 最後に見えた時の見た目の埋め込み（embedding_index.py。無ければNone）
+        self.embeddings = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def track(self, index):
+        """index番目の追跡オブジェクトを辞書で返す"""
+        return {
+            'id': int(self.ids[index]),
+            'bbox': self.bboxes[index].tolist(),
+            'center': tuple(self.centers[index].tolist()),
+            'label': self.labels[index],
+            'unseen_frames': int(self.unseen[index]),
+            'last_seen_frame': self.last_seen_frames[index],
+            'last_seen_time': self.last_seen_times[index],
+            'embedding': self.embeddings[index],
+        }
+
+    def _set_frame(self, index, frame):
+        """index番目の追跡の最終確認フレームを差し替える"""
+        old = self.last_seen_frames[index]
+        if self.frame_store is not None and old != frame:
+            self.frame_store.acquire(frame)
+            self.frame_store.release(old)
+        self.last_seen_frames[index] = frame
+
+    def _pop_disappeared(self, index):
+        """消失した追跡を辞書で返し、フレームの参照を手放す（画像は 'last_seen_image' に入れる）"""
+        obj = self.track(index)
+        if self.frame_store is not None:
+            obj['last_seen_image'] = self.frame_store.get(obj['last_seen_frame'])
+            self.frame_store.release(obj['last_seen_frame'])
+        else:
+            obj['last_seen_image'] = obj['last_seen_frame']
+        return obj
+
+    def tracks(self):
+        """追跡中のオブジェクトを辞書のリストで返す"""
+        return [self.track(i) for i in range(len(self))]
+
+    def cost_matrix(self, bboxes, centers, keys):
+        """検出(行) × 追跡(列) のコスト行列。割り当て不可の組は INVALID_COST"""
+        if self.cost == 'iou':
+            iou = pairwise_iou(bboxes, self.bboxes)
+            cost = 1.0 - iou
+            valid = iou >= config.TRACKING_MIN_IOU
+        else:
+            diff = centers[:, None, :] - self.centers[None, :, :]
+            cost = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+            valid = cost < self.threshold
+        if self.label_gating:
+            track_keys = np.asarray(self.keys, dtype=object)
+            det_keys = np.asarray(keys, dtype=object)
+            valid &= det_keys[:, None] == track_keys[None, :]
+        return np.where(valid, cost, INVALID_COST)
+
+    def touch(self, now=None):
+        """全ての追跡を now の時点でまだ見えていることにする
+
+        シーン変化ゲートが推論を省いたフレーム（前のフレームから変わっていない）で呼ぶ。
+        省いている間も時間は経つので、こうしないと次に見失った時にすぐ消失してしまう。
+        """
+        now = now or datetime.now()
+        self.seen_at[:] = now.timestamp()
+
+    def update(self, detections, frame, now=None):
+        """今回の検出結果で追跡状態を更新する
+
+        detections : {'bbox', 'label', 'center'} のリスト（'embedding' があれば最後の見た目として持つ）
+        frame      : 今回のフレーム（マッチした追跡の最終確認画像になる）。
+                     frame_store を使う場合はそのフレームID
+        戻り値     : (新しく追跡を始めたオブジェクト, 消失したオブジェクト) の辞書のリスト
+        """
+        now = now or datetime.now()
+        now_ts = now.timestamp()
+        n_det = len(detections)
+        bboxes = np.asarray([det['bbox'] for det in detections], dtype=np.float32).reshape(n_det, 4)
+        centers = np.asarray([det['center'] for det in detections], dtype=np.float32).reshape(n_det, 2)
+        keys = [label_key(det['label']) for det in detections]
+
+        # 1. 全ての 検出×追跡 のコストを一度に計算し、最適な割り当てを求める
+        matched = np.zeros(len(self), dtype=bool)
+        det_matched = np.zeros(n_det, dtype=bool)
+        if n_det and len(self):
+            cost = self.cost_matrix(bboxes, centers, keys)
+            rows, cols = solve_assignment(cost)
+            ok = cost[rows, cols] < INVALID_COST
+            rows, cols = rows[ok], cols[ok]
+            self.bboxes[cols] = bboxes[rows]
+            self.centers[cols] = centers[rows]
+            self.unseen[cols] = 0
+            self.seen_at[cols] = now_ts
+            for row, col in zip(rows.tolist(), cols.tolist()):
+                self.labels[col] = detections[row]['label']  # ラベルも最新に更新
+                self.keys[col] = keys[row]
+                self._set_frame(col, frame)
+                self.last_seen_times[col] = now
+                if detections[row].get('embedding') is not None:
+                    self.embeddings[col] = detections[row]['embedding']
+            matched[cols] = True
+            det_matched[rows] = True
+
+        # 2. 今回マッチしなかった追跡は見失った回数を増やし、一定の時間（または回数）を超えたら「消失」
+        self.unseen[~matched] += 1
+        if self.disappear_seconds is None:
+            gone = self.unseen > self.disappear_frames
+        else:
+            gone = (self.unseen >= self.min_misses) & (now_ts - self.seen_at > self.disappear_seconds)
+        disappeared = [self._pop_disappeared(i) for i in np.nonzero(gone)[0]]
+        if disappeared:
+            self._keep(~gone)
+
+        # 3. マッチしなかった検出は新しい追跡として追加する
+        new_indices = np.nonzero(~det_matched)[0]
+        started = []
+        if len(new_indices):
+            new_ids = np.arange(self.next_id, self.next_id + len(new_indices), dtype=np.int64)
+            self.next_id += len(new_indices)
+            start = len(self)
+            self.ids = np.concatenate([self.ids, new_ids])
+            self.bboxes = np.concatenate([self.bboxes, bboxes[new_indices]])
+            self.centers = np.concatenate([self.centers, centers[new_indices]])
+            self.unseen = np.concatenate([self.unseen, np.zeros(len(new_indices), dtype=np.int32)])
+            self.seen_at = np.concatenate([self.seen_at, np.full(len(new_indices), now_ts)])
+            for i in new_indices.tolist():
+                self.labels.append(detections[i]['label'])
+                self.keys.append(keys[i])
+                self.last_seen_frames.append(frame)
+                self.last_seen_times.append(now)
+                self.embeddings.append(detections[i].get('embedding'))
+                if self.frame_store is not None:
+                    self.frame_store.acquire(frame)
+            started = [self.track(i) for i in range(start, len(self))]
+
+        return started, disappeared
+
+    def _keep(self, mask):
+        """maskがTrueの追跡だけを残す"""
+        self.ids = self.ids[mask]
+        self.bboxes = self.bboxes[mask]
+        self.centers = self.centers[mask]
+        self.unseen = self.unseen[mask]
+        self.seen_at = self.seen_at[mask]
+        keep = mask.tolist()
+        self.labels = [v for v, k in zip(self.labels, keep) if k]
+        self.keys = [v for v, k in zip(self.keys, keep) if k]
+        self.last_seen_frames = [v for v, k in zip(self.last_seen_frames, keep) if k]
+        self.last_seen_times = [v for v, k in zip(self.last_seen_times, keep) if k]
+        self.embeddings = [v for v, k in zip(self.embeddings, keep) if k]
+
+
+def _legacy_update(tracked_objects, detections, image):
+    """比較用: 以前の二重ループによる貪欲な対応付け"""
+    unmatched_detections = []
+    for det in detections:
+        for tracked_obj in tracked_objects:
+            dist = np.linalg.norm(np.array(det['center']) - np.array(tracked_obj['center']))
+            if dist < config.OBJECT_TRACKING_THRESHOLD_PIXELS:
+                tracked_obj.update({'bbox': det['bbox'], 'center': det['center'], 'unseen_frames': 0})
+                tracked_obj['matched_in_frame'] = True
+                break
+        else:
+            unmatched_detections.append(det)
+    disappeared_objects = []
+    for tracked_obj in tracked_objects:
+        if not tracked_obj.get('matched_in_frame', False):
+            tracked_obj['unseen_frames'] += 1
+        if tracked_obj['unseen_frames'] > config.FRAMES_TO_CONSIDER_DISAPPEARED:
+            disappeared_objects.append(tracked_obj)
+    for obj in disappeared_objects:
+        tracked_objects.remove(obj)
+    for det in unmatched_detections:
+        tracked_objects.append(dict(det, unseen_frames=0, last_seen_image=image))
+    for tracked_obj in tracked_objects:
+        tracked_obj['matched_in_frame'] = False
+        tracked_objects.index(tracked_obj)  # 描画時の色選び
+
+
+def _random_detections(rng, n, width=1920, height=1080):
+    xy = rng.uniform(0, [width - 80, height - 80], size=(n, 2))
+    wh = rng.uniform(20, 80, size=(n, 2))
+    boxes = np.concatenate([xy, xy + wh], axis=1)
+    return [
+        {'bbox': box.tolist(), 'label': config.WHITELIST_KEYWORDS[i % len(config.WHITELIST_KEYWORDS)],
+         'center': tuple(((box[:2] + box[2:]) / 2).tolist())}
+        for i, box in enumerate(boxes)
+    ]
+
+
+def benchmark(num_detections, frames):
+    """検出数 num_detections の場面で、1フレームあたりの更新時間を計測する"""
+    rng = np.random.default_rng(0)
+    scenes = []
+    detections = _random_detections(rng, num_detections)
+    for _ in range(frames):
+        # 少しずつ動かしながら、一部を入れ替える
+        moved = []
+        for det in detections:
+            dx, dy = rng.normal(0, 5, size=2)
+            box = [det['bbox'][0] + dx, det['bbox'][1] + dy, det['bbox'][2] + dx, det['bbox'][3] + dy]
+            moved.append({'bbox': box, 'label': det['label'], 'center': ((box[0] + box[2]) / 2, (box[1] + box[3]) / 2)})
+        detections = moved[: int(num_detections * 0.9)] + _random_detections(rng, num_detections - int(num_detections * 0.9))
+        scenes.append(detections)
+
+    tracker = Tracker()
+    start = time.perf_counter()
+    for scene in scenes:
+        tracker.update(scene, None)
+    vectorized = (time.perf_counter() - start) / frames
+
+    legacy_tracks = []
+    start = time.perf_counter()
+    for scene in scenes:
+        _legacy_update(legacy_tracks, scene, None)
+    legacy = (time.perf_counter() - start) / frames
+
+    solver = 'scipy' if linear_sum_assignment is not None else 'numpy'
+    print(f"検出数 {num_detections}: Tracker({solver}) {vectorized * 1000:.2f} ms/frame, "
+          f"旧実装 {legacy * 1000:.2f} ms/frame")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="追跡器のマイクロベンチマーク")
+    parser.add_argument('--detections', type=int, nargs='+', default=[10, 100, 300])
+    parser.add_argument('--frames', type=int, default=20)
+    args = parser.parse_args()
+    for n in args.detections:
+        benchmark(n, args.frames)
@@ -1,138 +1,448 @@
 # vision.py (全面改訂版)
 
-import torch
 import time
-from PIL import ImageDraw, ImageFont
-from transformers import AutoProcessor, AutoModelForCausalLM,AutoConfig
+from PIL import Image, ImageDraw
 import numpy as np
-from datetime import datetime
-import os
 
 import config
+import metrics
+from persistence import PersistenceWriter, write_sighting
 from database import save_detection
+# backends（torch・transformers）は VLM_Detector を作る時に読み込む。
+# build_prompts などの補助関数だけを使う場合は重いimportをしない
+from scene_gate import SceneChangeGate
+from tracker import Tracker
+from frame_store import FrameStore
+from retention import RetentionScheduler, schedule_enabled
+from embedding_index import EmbeddingIndex, region_embeddings
+from image_cache import load_font
+
+# カメラを1台だけ使う場合のストリームID
+DEFAULT_STREAM_ID = 'default'
+
+# 選択できるタスクプロンプト
+SUPPORTED_TASKS = (
+    '<OD>', '<DENSE_REGION_CAPTION>', '<OPEN_VOCABULARY_DETECTION>', '<CAPTION_TO_PHRASE_GROUNDING>'
+)
+
+def build_prompts(task_prompt):
+    """タスクごとにモデルへ渡す文字列のリストを作る
+
+    <OPEN_VOCABULARY_DETECTION>   : WHITELIST_KEYWORDSのキーワードごとに1つ（1回のgenerateに束ねる）
+    <CAPTION_TO_PHRASE_GROUNDING> : 全キーワードを1つのプロンプトに詰める
+    """
+    if task_prompt not in SUPPORTED_TASKS:
+        raise ValueError(f"未対応のタスクです: {task_prompt} (選択肢: {', '.join(SUPPORTED_TASKS)})")
+    if task_prompt == '<OPEN_VOCABULARY_DETECTION>':
+        return [task_prompt + keyword for keyword in config.WHITELIST_KEYWORDS]
+    if task_prompt == '<CAPTION_TO_PHRASE_GROUNDING>':
+        return [task_prompt + '. '.join(config.WHITELIST_KEYWORDS) + '.']
+    return [task_prompt]
+
+def bgr_view(frame):
+    """OpenCVのBGRフレームを、コピーせずにRGBの並びで見るビューにする"""
+    return frame[..., ::-1]
+
+def image_size(image):
+    """PIL画像・NumPy配列(高さ, 幅, 3)のどちらでも (幅, 高さ) を返す"""
+    if isinstance(image, np.ndarray):
+        return image.shape[1], image.shape[0]
+    return image.size
+
+def crop_image(image, box):
+    """画像の (left, top, right, bottom) の範囲を切り出す。NumPy配列ならコピーしないビューを返す"""
+    if isinstance(image, np.ndarray):
+        left, top, right, bottom = box
+        return image[top:bottom, left:right]
+    return image.crop(box)
 
 def get_bbox_center(bbox):
     """バウンディングボックスの中心座標を計算する"""
     x1, y1, x2, y2 = bbox
     return ((x1 + x2) / 2, (y1 + y2) / 2)
 
+def get_padded_crop_box(bbox, image_size):
+    """バウンディングボックスの周囲に余白を付けた切り出し範囲(整数)を返す"""
+    width, height = image_size
+    x1, y1, x2, y2 = bbox
+    pad_x = max((x2 - x1) * config.ROI_PADDING_RATIO, (config.ROI_MIN_CROP_SIZE - (x2 - x1)) / 2, 0)
+    pad_y = max((y2 - y1) * config.ROI_PADDING_RATIO, (config.ROI_MIN_CROP_SIZE - (y2 - y1)) / 2, 0)
+    left = max(0, int(x1 - pad_x))
+    top = max(0, int(y1 - pad_y))
+    right = min(width, int(round(x2 + pad_x)))
+    bottom = min(height, int(round(y2 + pad_y)))
+    return (left, top, max(right, left + 1), max(bottom, top + 1))
+
+def offset_detections(detections, offset):
+    """切り出し画像上の検出結果を、元のフレームの座標に戻す"""
+    dx, dy = offset
+    if dx == 0 and dy == 0:
+        return detections
+    shifted = []
+    for det in detections:
+        x1, y1, x2, y2 = det['bbox']
+        box = [x1 + dx, y1 + dy, x2 + dx, y2 + dy]
+        shifted.append(dict(det, bbox=box, center=get_bbox_center(box)))
+    return shifted
+
+def merge_duplicate_detections(detections):
+    """切り出し範囲が重なって同じ物体が二重に検出された場合、1つにまとめる"""
+    merged = []
+    for det in detections:
+        duplicated = any(
+            np.linalg.norm(np.array(det['center']) - np.array(kept['center'])) < config.OBJECT_TRACKING_THRESHOLD_PIXELS
+            for kept in merged
+        )
+        if not duplicated:
+            merged.append(det)
+    return merged
+
+def draw_tracked_objects(image, tracked_objects):
+    """追跡中のオブジェクト（'id'・'bbox'・'label' を持つ辞書）を画像に描画する
+
+    推論サービスのクライアント（detector_service.RemoteDetector）もこれで描画する。
+    """
+    draw = ImageDraw.Draw(image)
+    for tracked_obj in tracked_objects:
+        box = tracked_obj['bbox']
+        label = tracked_obj['label']
+        color = config.COLORS[tracked_obj['id'] % len(config.COLORS)]
+        draw.rectangle(box, outline=color, width=3)
+        # フォントは1回だけ読み込む（image_cache.load_font）
+        draw.text((box[0], box[1] - 20), label, fill=color, font=load_font(16))
+    
+    return image
+
 class VLM_Detector:
-    def __init__(self):
-        """モデルの読み込みと、追跡用オブジェクトリストの初期化"""
+    def __init__(self, retention_schedule=None):
+        """モデルの読み込みと、追跡用オブジェクトリストの初期化
+
+        retention_schedule: 古い記録の自動整理を動かすか（Noneなら retention.schedule_enabled() に従う）
+        """
         print("VLMモデルの読み込みを開始します...")
-        self.dtype = torch.float16 if torch.cuda.is_available() else torch.float32
-        if torch.cuda.is_available() and torch.cuda.is_bf16_supported():
-            self.dtype = torch.bfloat16
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        print(f"使用デバイス: {self.device}, データ型: {self.dtype}")
-
-        self.model = AutoModelForCausalLM.from_pretrained(
-            config.MODEL_ID, torch_dtype=self.dtype, trust_remote_code=True
-        ).to(self.device)
-        self.processor = AutoProcessor.from_pretrained(config.MODEL_ID, trust_remote_code=True)
+        load_start = time.time()
+        from backends import create_backend
+        # モデルの読み込み方・実行方法は config.INFERENCE_BACKEND で切り替える
+        self.backend = create_backend(config.INFERENCE_BACKEND)
+        self.device, self.dtype = self.backend.device, self.backend.dtype
+        self.model = self.backend.model
+        self.processor = self.backend.processor
+        print(f"使用デバイス: {self.device}, データ型: {self.dtype}, バックエンド: {self.backend.name}")
         
-        # ★★★ 追跡中のオブジェクトを管理するリスト ★★★
-        self.tracked_objects = []
+        # ★★★ 追跡中のオブジェクトを管理するリスト（カメラ(ストリーム)ごと） ★★★
+        # 最後に見えたフレームは追跡ごとにコピーせず、ここに1回だけ保存して共有する
+        self.frame_store = FrameStore()
+        self.trackers = {DEFAULT_STREAM_ID: Tracker(frame_store=self.frame_store)}
+        # 消失したオブジェクトの保存は別スレッドで行う（推論ループを止めないため）
+        self.persistence = None
+        if config.ASYNC_PERSISTENCE:
+            self.persistence = PersistenceWriter()
+            self.persistence.start()
+        # 見た目の埋め込みの保存先（書き込みスレッドを使う場合は書き込みスレッドが持つ）
+        self.embedding_index = None
+        if config.EMBEDDING_INDEX_ENABLED and self.persistence is None:
+            self.embedding_index = EmbeddingIndex()
+        # 古い記録を定期的に削除する（サイドバー・CLI・configで有効にした場合だけ）
+        self.retention = None
+        if schedule_enabled() if retention_schedule is None else retention_schedule:
+            self.retention = RetentionScheduler()
+            self.retention.start()
+        # 段ごとの所要時間などの計測値を公開する（config.METRICS_ENABLED）
+        metrics.start()
+        # シーン変化ゲート（ストリームごと）
+        self.scene_gates = {}
+        # 全体画像で推論した回数を数えるためのカウンタ（ストリームごと）
+        self.stream_frame_counts = {}
+        # 起動から最初の検出までの時間を1回だけ報告する
+        self.first_detection_reported = False
         
-        print("モデルの読み込みが完了しました。")
+        load_seconds = time.time() - load_start
+        metrics.set_gauge('model_load_seconds', round(load_seconds, 3))
+        print(f"モデルの読み込みが完了しました。({load_seconds:.1f} 秒)")
 
-    def run_detection(self, image):
-        """画像から物体を検出し、追跡と消失検知を行う"""
-        original_image = image.copy()
-        
-        task_prompt = '<DENSE_REGION_CAPTION>'
-        inputs = self.processor(
-            text=task_prompt, images=original_image, return_tensors="pt", do_rescale=False
-        ).to(self.device, self.dtype)
+    def warm_up(self, runs=None, size=None, task_prompt=None, decoding=None):
+        """合成画像で推論を空回しする（最初のカメラフレームの推論が遅くならないように）
+
+        カーネルの選択・メモリの確保・遅延初期化をカメラを開く前に済ませる。追跡やDBには何も残さない。
+        """
+        runs = config.WARMUP_RUNS if runs is None else runs
+        if runs <= 0:
+            return
+        width, height = size or config.WARMUP_IMAGE_SIZE
+        task_prompt = task_prompt or config.TASK_PROMPT
+        # 真っ平らな画像だと生成がすぐ終わるので、明暗のある画像にする
+        gradient = np.linspace(0, 255, width, dtype=np.uint8)
+        pixels = np.stack([np.tile(gradient, (height, 1)), np.tile(gradient[::-1], (height, 1)),
+                           np.full((height, width), 128, dtype=np.uint8)], axis=-1)
+        image = Image.fromarray(pixels)
+        start = time.time()
+        for _ in range(runs):
+            self._generate([image], task_prompt, prompts=build_prompts(task_prompt), decoding=decoding)
+        warmup_seconds = time.time() - start
+        metrics.set_gauge('warmup_seconds', round(warmup_seconds, 3))
+        print(f"推論の空回しが完了しました。({warmup_seconds:.1f} 秒)")
+
+    def _report_first_detection(self):
+        """プロセスの起動から、最初のカメラフレームの解析が終わるまでの時間を報告する"""
+        self.first_detection_reported = True
+        seconds = time.time() - metrics.PROCESS_STARTED_AT
+        metrics.set_gauge('time_to_first_detection_seconds', round(seconds, 3))
+        print(f"起動から最初の検出まで {seconds:.1f} 秒")
+
+    @property
+    def tracked_objects(self):
+        """既定ストリームの追跡中オブジェクトのリスト（カメラ1台で使う場合はこれだけを見ればよい）"""
+        return self._tracker(DEFAULT_STREAM_ID).tracks()
+
+    def _tracker(self, stream_id):
+        """ストリームの追跡器（無ければ作る）"""
+        tracker = self.trackers.get(stream_id)
+        if tracker is None:
+            tracker = self.trackers[stream_id] = Tracker(frame_store=self.frame_store)
+        return tracker
+
+    def _generate(self, images, task_prompt, prompts=None, decoding=None, return_features=False):
+        """複数の画像・プロンプトをまとめて1回のgenerateに通し、後処理結果を返す
+
+        prompts を省略すると全ての画像に task_prompt を使う。指定した場合は
+        全ての画像 × 全てのプロンプトを1回に束ね、画像エンコーダは画像ごとに1回だけ実行する。
+        結果は results[画像の番号][プロンプトの番号] の形で返す。
+        return_features=True なら (結果, 画像ごとの画像特徴量) を返す（見た目の埋め込み用）。
+        """
+        from backends import get_generate_kwargs
+        prompts = prompts or [task_prompt]
+        texts = [prompt for _ in images for prompt in prompts]
+        image_index = [i for i in range(len(images)) for _ in prompts]
+        with metrics.span('preprocess'):
+            inputs = self.processor(
+                text=texts, images=images, return_tensors="pt", do_rescale=False, padding=len(prompts) > 1
+            ).to(self.device, self.dtype)
         
         # --- 推論実行 ---
-        generated_ids = self.model.generate(
-            input_ids=inputs["input_ids"], pixel_values=inputs["pixel_values"],
-            max_new_tokens=1024, num_beams=3, do_sample=False,
-        )
+        with metrics.span('generate'):
+            generated_ids = self.backend.generate(
+                inputs["input_ids"], inputs["pixel_values"],
+                attention_mask=inputs.get("attention_mask") if len(prompts) > 1 else None,
+                image_index=image_index if len(prompts) > 1 else None,
+                return_image_features=return_features,
+                **get_generate_kwargs(decoding)
+            )
+            image_features = None
+            if return_features:
+                generated_ids, image_features = generated_ids
         
-        generated_text = self.processor.batch_decode(generated_ids, skip_special_tokens=False)[0]
-        results = self.processor.post_process_generation(
-            generated_text, task=task_prompt, image_size=(original_image.width, original_image.height)
+        with metrics.span('postprocess'):
+            generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=False)
+            results = [[] for _ in images]
+            for generated_text, i in zip(generated_texts, image_index):
+                results[i].append(self.processor.post_process_generation(
+                    generated_text, task=task_prompt, image_size=image_size(images[i])
+                ))
+        if return_features:
+            return results, image_features
+        return results
+
+    def run_detection(self, image, stream_id=DEFAULT_STREAM_ID, task_prompt=None, decoding=None):
+        """画像から物体を検出し、追跡と消失検知を行う"""
+        return self.run_detection_batch([image], [stream_id], task_prompt=task_prompt, decoding=decoding)[0]
+
+    def run_detection_batch(self, images, stream_ids, task_prompt=None, decoding=None):
+        """複数カメラの画像をまとめて推論し、ストリームごとに追跡と消失検知を行う
+
+        images[i] は stream_ids[i] のカメラの最新フレーム。描画済みの画像をリストで返す。
+        task_prompt を省略すると config.TASK_PROMPT、decoding を省略すると
+        config.DECODING_PROFILE を使う（decoding にはプロファイル名か設定の辞書を渡せる）。
+        """
+        tracks_per_image = self.update_batch(images, stream_ids, task_prompt=task_prompt, decoding=decoding)
+        processed_images = []
+        for image, tracked_objects in zip(images, tracks_per_image):
+            with metrics.span('draw'):
+                # 渡された画像は最後に見えたフレームとして保存しているので、描画はコピーに行う
+                processed_images.append(draw_tracked_objects(image.copy(), tracked_objects))
+        return processed_images
+
+    def track_frame(self, frame, stream_id=DEFAULT_STREAM_ID, task_prompt=None, decoding=None):
+        """OpenCVのBGRフレームを解析し、追跡中オブジェクトのリストを返す（描画は overlay.draw_overlay で行う）"""
+        return self.track_frames([frame], [stream_id], task_prompt=task_prompt, decoding=decoding)[0]
+
+    def track_frames(self, frames, stream_ids, task_prompt=None, decoding=None):
+        """複数カメラのBGRフレームをまとめて解析し、フレームごとに追跡中オブジェクトのリストを返す
+
+        PIL画像には変換せず、RGBのビューのまま渡す。推論するフレームだけを1回コピーして
+        モデルの入力と「最後に見えたフレーム」に使うので、呼び出し側はフレームにそのまま描いてよい。
+        """
+        return self.update_batch([bgr_view(frame) for frame in frames], stream_ids, task_prompt, decoding)
+
+    def update_batch(self, images, stream_ids, task_prompt=None, decoding=None):
+        """run_detection_batch の描画しない版。画像ごとに追跡中オブジェクトのリストを返す"""
+        if len(images) != len(stream_ids):
+            raise ValueError("imagesとstream_idsの数が一致しません。")
+        if len(set(stream_ids)) != len(stream_ids):
+            raise ValueError("同じストリームのフレームを1回のバッチに複数入れることはできません。")
+        if not images:
+            return []
+
+        # シーンがほとんど変わっていないストリームは推論を省略する
+        with metrics.span('scene_gate'):
+            analyze = [self._should_analyze(image, stream_id) for image, stream_id in zip(images, stream_ids)]
+        targets = [i for i, flag in enumerate(analyze) if flag]
+        metrics.mark('frames_analyzed', len(targets))
+        metrics.inc('frames_skipped', len(images) - len(targets))
+
+        task_prompt = task_prompt or config.TASK_PROMPT
+        prompts = build_prompts(task_prompt)
+        # 推論するフレームだけを連続したRGBの配列にする（BGRのビューはここで1回だけコピーされる）
+        # PIL画像はそのまま使う（描画する run_detection_batch はコピーに描く）
+        with metrics.span('bgr_to_rgb'):
+            original_images = {
+                i: np.ascontiguousarray(images[i]) if isinstance(images[i], np.ndarray) else images[i]
+                for i in targets
+            }
+
+        # 推論に渡す画像（フレーム全体 または 追跡中オブジェクトの周囲の切り出し）を1つのバッチにまとめる
+        jobs = []  # (画像のindex, 推論する画像, 切り出しの左上座標)
+        for i in targets:
+            tracker = self._tracker(stream_ids[i])
+            if self._use_roi_pass(stream_ids[i], tracker):
+                for bbox in tracker.bboxes.tolist():
+                    crop_box = get_padded_crop_box(bbox, image_size(original_images[i]))
+                    jobs.append((i, crop_image(original_images[i], crop_box), crop_box[:2]))
+            else:
+                jobs.append((i, original_images[i], (0, 0)))
+
+        detections_per_image = {i: [] for i in targets}
+        if jobs:
+            embed = config.EMBEDDING_INDEX_ENABLED
+            results_list = self._generate(
+                [job_image for _, job_image, _ in jobs], task_prompt, prompts=prompts, decoding=decoding,
+                return_features=embed
+            )
+            if embed:
+                results_list, image_features = results_list
+            for j, ((i, job_image, offset), job_results) in enumerate(zip(jobs, results_list)):
+                detections = []
+                for results in job_results:
+                    detections.extend(self._extract_detections(results, task_prompt))
+                if embed and detections:
+                    # 推論で計算済みの画像特徴量から、検出ごとの見た目の埋め込みを作る（切り出し画像の座標で）
+                    with metrics.span('embedding'):
+                        vectors = region_embeddings(
+                            image_features[j], image_size(job_image), [det['bbox'] for det in detections]
+                        )
+                    for det, vector in zip(detections, vectors):
+                        det['embedding'] = vector
+                detections_per_image[i].extend(offset_detections(detections, offset))
+
+        tracks_per_image = []
+        for i, stream_id in enumerate(stream_ids):
+            tracker = self._tracker(stream_id)
+            if i in detections_per_image:
+                with metrics.span('tracking'):
+                    current_detections = merge_duplicate_detections(detections_per_image[i])
+                    frame_id = self.frame_store.put(original_images[i])
+                    self._update_tracking(tracker, current_detections, frame_id)
+            else:
+                # 省略した場合は追跡状態をそのまま引き継ぐ（変化が無いので、まだ見えていることにする）
+                tracker.touch()
+            tracks_per_image.append(tracker.tracks())
+        metrics.set_gauge('tracked_objects', sum(len(tracker) for tracker in self.trackers.values()))
+        if targets and not self.first_detection_reported:
+            self._report_first_detection()
+        return tracks_per_image
+
+    def detect(self, images, task_prompt=None, decoding=None, embed=False):
+        """追跡・保存をせずに、画像ごとのホワイトリスト対象の検出結果だけを返す（その場での解析・backfill.py用）
+
+        embed=True なら各検出に見た目の埋め込み 'embedding' も付ける。
+        """
+        if not images:
+            return []
+        task_prompt = task_prompt or config.TASK_PROMPT
+        results_list = self._generate(
+            images, task_prompt, prompts=build_prompts(task_prompt), decoding=decoding, return_features=embed
         )
-        
+        if embed:
+            results_list, image_features = results_list
+        detections_per_image = []
+        for i, job_results in enumerate(results_list):
+            detections = []
+            for results in job_results:
+                detections.extend(self._extract_detections(results, task_prompt))
+            if embed and detections:
+                vectors = region_embeddings(image_features[i], image_size(images[i]), [det['bbox'] for det in detections])
+                for det, vector in zip(detections, vectors):
+                    det['embedding'] = vector
+            detections_per_image.append(merge_duplicate_detections(detections))
+        return detections_per_image
+
+    def _use_roi_pass(self, stream_id, tracker):
+        """追跡中オブジェクトの切り出しだけで推論するならTrue。定期的にフレーム全体でも推論して新しい物体を探す"""
+        count = self.stream_frame_counts.get(stream_id, 0)
+        self.stream_frame_counts[stream_id] = count + 1
+        if not config.ROI_INFERENCE_ENABLED or not len(tracker):
+            return False
+        if len(tracker) > config.ROI_MAX_CROPS:
+            return False
+        return count % config.ROI_FULL_FRAME_INTERVAL != 0
+
+    def _should_analyze(self, image, stream_id):
+        """シーン変化ゲートを通し、推論が必要かどうかを返す"""
+        if not config.SCENE_GATE_ENABLED:
+            return True
+        gate = self.scene_gates.get(stream_id)
+        if gate is None:
+            gate = self.scene_gates[stream_id] = SceneChangeGate()
+        return gate.should_analyze(image)
+
+    def close(self):
+        """書き込み待ちの記録を全て保存してから、書き込みスレッドを止める"""
+        metrics.stop()
+        if self.retention is not None:
+            self.retention.close()
+        if self.persistence is not None:
+            self.persistence.close()
+            print(f"書き込みスレッド統計: {self.persistence.stats()}")
+
+    def frame_store_stats(self):
+        """共有フレーム置き場のフレーム数とメモリ使用量"""
+        return self.frame_store.stats()
+
+    def gate_stats(self):
+        """ストリームごとのシーン変化ゲートの統計（推論した数・省略した数）"""
+        return {stream_id: gate.stats() for stream_id, gate in self.scene_gates.items()}
+
+    def _extract_detections(self, results, task_prompt):
+        """後処理結果から、ホワイトリストに該当する検出だけを取り出す"""
         current_detections = []
         if task_prompt in results and isinstance(results[task_prompt], dict):
             detections = results[task_prompt]
             bboxes = detections.get('bboxes', [])
-            labels = detections.get('labels', [])
+            # 語彙指定検出(<OPEN_VOCABULARY_DETECTION>)ではラベルが 'bboxes_labels' に入る
+            labels = detections.get('labels', detections.get('bboxes_labels', []))
             for box, label in zip(bboxes, labels):   
                 # ホワイトリストに含まれるキーワードがラベルに含まれている場合のみを対象とする
                 if any(keyword in label for keyword in config.WHITELIST_KEYWORDS):
                     current_detections.append({'bbox': box, 'label': label, 'center': get_bbox_center(box)})
+        return current_detections
 
-        # ★★★ ここからがトラッキングのメインロジック ★★★
-        
-        # 1. 追跡中のオブジェクトと現在の検出結果をマッチング
-        unmatched_detections = []
-        for det in current_detections:
-            matched = False
-            for tracked_obj in self.tracked_objects:
-                dist = np.linalg.norm(np.array(det['center']) - np.array(tracked_obj['center']))
-                if dist < config.OBJECT_TRACKING_THRESHOLD_PIXELS:
-                    # マッチした場合、情報を更新して追跡を継続
-                    tracked_obj.update({
-                        'bbox': det['bbox'],
-                        'center': det['center'],
-                        'label': det['label'], # ラベルも最新に更新
-                        'unseen_frames': 0,
-                        'last_seen_image': original_image,
-                        'last_seen_time': datetime.now()
-                    })
-                    matched = True
-                    tracked_obj['matched_in_frame'] = True
-                    break
-            if not matched:
-                unmatched_detections.append(det)
-
-        # 2. 追跡中のオブジェクトで、今回マッチしなかったものを処理
-        disappeared_objects = []
-        for tracked_obj in self.tracked_objects:
-            if not tracked_obj.get('matched_in_frame', False):
-                tracked_obj['unseen_frames'] += 1
-            # 一定フレーム数見失ったら「消失」と判断
-            if tracked_obj['unseen_frames'] > config.FRAMES_TO_CONSIDER_DISAPPEARED:
-                disappeared_objects.append(tracked_obj)
-        
-        # 3. 消失したオブジェクトをDBに保存し、追跡リストから削除
+    def _update_tracking(self, tracker, current_detections, frame_id):
+        """1つのストリームの追跡状態を今回の検出結果で更新し、消失したオブジェクトを保存する"""
+        # ★★★ 対応付け・消失判定は tracker.Tracker が行う ★★★
+        started, disappeared_objects = tracker.update(current_detections, frame_id)
+
+        # 消失したオブジェクトをDBに保存
         for obj in disappeared_objects:
             print(f"  [Disappeared] {obj['label']} を最後に検出。DBに保存します。")
-            timestamp_str = obj['last_seen_time'].strftime('%Y-%m-%d %H:%M:%S')
-            image_filename = obj['last_seen_time'].strftime('%Y%m%d%H%M%S_%f') + '.jpg'
-            image_path = os.path.join(config.HISTORY_DIR, image_filename)
-            obj['last_seen_image'].save(image_path, 'JPEG')
-            save_detection(timestamp_str, image_path, obj['label'], obj['bbox'])
-            self.tracked_objects.remove(obj)
-
-        # 4. 今回新たに検出されたオブジェクトを追跡リストに追加
-        for det in unmatched_detections:
-            print(f"  [New Object] {det['label']} の追跡を開始します。")
-            self.tracked_objects.append({
-                'bbox': det['bbox'],
-                'center': det['center'],
-                'label': det['label'],
-                'unseen_frames': 0,
-                'last_seen_image': original_image,
-                'last_seen_time': datetime.now(),
-            })
-
-        # 5. 追跡中のオブジェクトを描画用に準備
-        draw = ImageDraw.Draw(image)
-        for tracked_obj in self.tracked_objects:
-            tracked_obj['matched_in_frame'] = False # 次のフレームのためにリセット
-            box = tracked_obj['bbox']
-            label = tracked_obj['label']
-            color = config.COLORS[self.tracked_objects.index(tracked_obj) % len(config.COLORS)]
-            draw.rectangle(box, outline=color, width=3)
-            try:
-                font = ImageFont.truetype("meiryo.ttc", 16)
-            except IOError:
-                font = ImageFont.load_default()
-            draw.text((box[0], box[1] - 20), label, fill=color, font=font)
-        
-        return image
\ No newline at end of file
+            if self.persistence is not None:
+                self.persistence.submit(
+                    obj['last_seen_image'], obj['label'], obj['bbox'], obj['last_seen_time'], embedding=obj['embedding']
+                )
+            else:
+                with metrics.span('image_save'):
+                    row = write_sighting(obj['last_seen_image'], obj['label'], obj['bbox'], obj['last_seen_time'])
+                detection_id = save_detection(*row)
+                if self.embedding_index is not None and obj['embedding'] is not None:
+                    self.embedding_index.add([detection_id], [obj['embedding']])
+
+        for obj in started:
+            print(f"  [New Object] {obj['label']} の追跡を開始します。")
@@ -1,32 +1,33 @@
 import cv2
-from PIL import Image
-import time
 
 import config
 import database
-from vision import VLM_Detector
-import numpy as np
+import metrics
+from camera_source import open_source
+from detector_service import create_detector
+from pipeline import VisionPipeline
+from overlay import draw_overlay
+from scheduler import AdaptiveScheduler
 
-VIDEO_STREAM_URL = 'http://192.168.11.6:8080/video'
+def open_capture():
+    """URLのカメラ、だめならローカルカメラを開く。どちらも失敗したらNoneを返す
 
-def run_vision_process():
-    """Webカメラを起動し、映像の解析とDBへの保存を続ける"""
-    database.init_db()
-    detector = VLM_Detector()
+    一度つながったカメラは、Wi-Fiが切れても camera_source がつなぎ直す。
+    """
     cap = None
     # ステップ1: URLが設定されていれば、まずURLへの接続を試みる
-    if VIDEO_STREAM_URL:
-        print(f"URLへの接続を試みます: {VIDEO_STREAM_URL}")
-        cap = cv2.VideoCapture(VIDEO_STREAM_URL)
+    if config.VIDEO_STREAM_URL:
+        print(f"URLへの接続を試みます: {config.VIDEO_STREAM_URL}")
+        cap = open_source(config.VIDEO_STREAM_URL, name='camera')
     
     # ステップ2: URLでの接続に失敗したか、URLが未設定の場合、ローカルカメラを試みる
     if not cap or not cap.isOpened():
-        if VIDEO_STREAM_URL:
+        if config.VIDEO_STREAM_URL:
             print("URLへの接続に失敗しました。ローカルカメラを試みます。")
         else:
             print("ローカルカメラへの接続を試みます。")
         
-        cap = cv2.VideoCapture(config.WEBCAM_DEVICE_ID)
+        cap = open_source(config.WEBCAM_DEVICE_ID, name='webcam')
 
     # 最終チェック: 両方の方法で接続に失敗した場合
     if not cap or not cap.isOpened():
@@ -35,38 +36,78 @@ def run_vision_process():
         print("URLとローカルカメラの両方への接続に失敗しました。")
         print("  - スマートフォンとPCの接続、またはUSBカメラの接続を確認してください。")
         print("--------------------------------------------------")
+        return None
+
+    return cap
+
+def run_vision_process():
+    """Webカメラを起動し、映像の解析とDBへの保存を続ける"""
+    database.init_db()
+    # DETECTOR_SERVICE_URL が設定されていれば、推論サービスのクライアントになる
+    detector = create_detector()
+    # カメラを開く前に推論を空回ししておく（最初のフレームの推論が遅くならないように）
+    detector.warm_up()
+    cap = open_capture()
+    if cap is None:
+        detector.close()
         return
 
     print(">>> 映像解析プロセスを開始しました。 <<<")
     print(">>> 映像ウィンドウを選択して 'q' キーを押すと終了します。 <<<")
 
+    if config.PIPELINE_MODE:
+        # 取り込み・推論・表示を別スレッドで動かす（推論の頻度は AdaptiveScheduler が決める）
+        pipeline = VisionPipeline(
+            cap, detector,
+            frame_queue_size=config.PIPELINE_FRAME_QUEUE_SIZE,
+            result_queue_size=config.PIPELINE_RESULT_QUEUE_SIZE,
+        )
+        stats = pipeline.run_display('Live Vision Feed')
+        print(f"パイプライン統計: {stats}")
+        print(f"解析頻度: {pipeline.scheduler.stats()}")
+        detector.close()
+        print(f"シーン変化ゲート統計: {detector.gate_stats()}")
+        print(f"フレーム置き場: {detector.frame_store_stats()}")
+        print(f"カメラ: {cap.stats()}")
+        print("アプリケーションを終了します。")
+        cap.release()
+        cv2.destroyAllWindows()
+        return
+
+    # 解析の頻度は物体の出入り・推論の時間・CPUの使用量に合わせて自動で決める
+    scheduler = AdaptiveScheduler()
+    tracked_objects = []
     while True:
-        ret, frame = cap.read()
+        with metrics.span('capture_read'):
+            ret, frame = cap.read()
         if not ret:
+            # 切れてもつなぎ直すまで read() が待つので、ここに来るのは諦めたときだけ
             print("エラー: フレームを読み込めませんでした。")
             break
+        metrics.mark('frames_captured')
 
-        # OpenCV(BGR)からPillow(RGB)へ画像を変換
-        pil_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-        
-        # 検出処理を実行し、描画済みの画像を受け取る
-        # vision.pyのrun_detectionは元々、描画後のimageを返す仕様になっています
-        processed_image_pil = detector.run_detection(pil_image)
+        # 解析する時刻になったフレームだけ検出処理を実行し、追跡中オブジェクトのリストを受け取る
+        # （それ以外のフレームは読み捨てて、カメラのバッファに古いフレームを溜めない）
+        if scheduler.ready():
+            tracked_objects = scheduler.run(detector.track_frame, frame)
         
-        # 表示用にPillow(RGB)からOpenCV(BGR)へ画像を変換
-        display_frame = cv2.cvtColor(np.array(processed_image_pil), cv2.COLOR_RGB2BGR)
+        with metrics.span('display'):
+            # 表示用の変換はせず、カメラのフレームに直接描く
+            draw_overlay(frame, tracked_objects)
 
-        # "Live Vision Feed"という名前のウィンドウに映像を表示
-        cv2.imshow('Live Vision Feed', display_frame)
+            # "Live Vision Feed"という名前のウィンドウに映像を表示
+            cv2.imshow('Live Vision Feed', frame)
 
         # 'q'キーが押されたらループを抜ける
         if cv2.waitKey(1) & 0xFF == ord('q'):
             break
-        
-        # 指定したFPSになるように待機 (この行は元からありますが、ループの最後に移動)
-        time.sleep(1.0 / config.PROCESSING_FPS)
 
     # 後処理
+    detector.close()
+    print(f"解析頻度: {scheduler.stats()}")
+    print(f"シーン変化ゲート統計: {detector.gate_stats()}")
+    print(f"フレーム置き場: {detector.frame_store_stats()}")
+    print(f"カメラ: {cap.stats()}")
     print("アプリケーションを終了します。")
     cap.release()
     cv2.destroyAllWindows()